@@ -0,0 +1,197 @@
+"""
+Bookkeeping for outgoing calls that are waiting on replies.
+"""
+
+from collections import namedtuple
+from concurrent.futures import Future
+
+
+CallResult = namedtuple('CallResult', ['payload', 'parts'])
+CallResult.__doc__ = """
+The outcome of a call made through a future.
+
+Attributes:
+    payload (any): The payload of the last reply
+    parts (list): Every payload received for the call, the last one included
+"""
+
+
+class CallTimeoutError(Exception):
+    """
+    Raised through a call's future when its reply or done timeout expires.
+
+    Attributes:
+        name (str): The event that was called
+        call_id (str): The id of the call message
+        stage (str): Either 'first reply' or 'done'
+    """
+
+    def __init__(self, name, call_id, stage):
+        Exception.__init__(self, 'call "{}" timed out waiting for {}'.format(name, stage))
+        self.name = name
+        self.call_id = call_id
+        self.stage = stage
+
+
+class PendingCall(object):
+    """
+    A call that has been sent out and has not received its last reply yet.
+
+    Attributes:
+        id (str): The id of the call message
+        name (str): The event that was called
+        parts (list): Every payload received so far, in order of arrival
+        reply_timer: Cancelled on the first reply, anything with cancel()
+        done_timer: Cancelled on the last reply, anything with cancel()
+        credit (int): The reply parts granted to each client, or None when
+            replies are not flow controlled
+        consumed (dict): Parts handled since credit was last granted back,
+            keyed by client id
+    """
+
+    __slots__ = (
+        'id', 'name', 'on_reply', 'on_done', 'parts', 'reply_timer', 'done_timer',
+        'credit', 'consumed',
+    )
+
+    def __init__(self, id, name, on_reply=None, on_done=None, credit=None):
+        self.id = id
+        self.name = name
+        self.on_reply = on_reply
+        self.on_done = on_done
+        self.parts = []
+        self.reply_timer = None
+        self.done_timer = None
+        self.credit = credit
+        self.consumed = {}
+
+    def cancel_timers(self):
+        if self.reply_timer is not None:
+            self.reply_timer.cancel()
+
+        if self.done_timer is not None:
+            self.done_timer.cancel()
+
+
+class PendingCalls(object):
+    """
+    The calls waiting on replies, keyed by call id.
+
+    Replies are matched with a single dict lookup and a call is removed the
+    moment its last reply or a timeout comes in, whichever is first, so its
+    callbacks can never fire after that.
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    def __len__(self):
+        return len(self.calls)
+
+    def __contains__(self, call_id):
+        return call_id in self.calls
+
+    def add(self, call_id, name, on_reply=None, on_done=None, credit=None):
+        call = PendingCall(call_id, name, on_reply, on_done, credit)
+        self.calls[call_id] = call
+        return call
+
+    def get(self, call_id):
+        return self.calls.get(call_id)
+
+    def remove(self, call_id):
+        """ Removes the call and cancels its timers, returning it if it was pending """
+        call = self.calls.pop(call_id, None)
+
+        if call is not None:
+            call.cancel_timers()
+
+        return call
+
+    def resolve(self, message):
+        """
+        Passes a reply message to the call it answers.
+
+        Returns:
+            False if no pending call matches the reply
+        """
+        to = message['to']
+        call = self.calls.get(to['id'])
+
+        if call is None:
+            return False
+
+        payload = message['payload']
+        part = message['part']
+
+        if message['done']:
+            # pop, so a timeout racing this reply cannot complete the call twice
+            if self.calls.pop(call.id, None) is None:
+                return False
+
+            call.cancel_timers()
+            call.parts.append(payload)
+
+            if callable(call.on_done):
+                call.on_done(payload, call.parts, part)
+        else:
+            if call.reply_timer is not None:
+                call.reply_timer.cancel()
+                call.reply_timer = None
+
+            call.parts.append(payload)
+
+            if callable(call.on_reply):
+                call.on_reply(payload, part)
+
+        return True
+
+    def clear(self):
+        for call in list(self.calls.values()):
+            call.cancel_timers()
+
+        self.calls.clear()
+
+
+def gather_futures(futures, return_exceptions=False):
+    """
+    Combines a dict of futures into one future of a dict with their results.
+
+    Args:
+        futures (dict): Futures keyed by anything
+        return_exceptions (bool): Whether failed futures put their exception
+            in the result instead of failing the combined future
+
+    Returns:
+        Future: Resolves once every future is done
+    """
+    combined = Future()
+    results = {}
+    remaining = len(futures)
+
+    if not futures:
+        combined.set_result(results)
+        return combined
+
+    def on_done(key, future):
+        nonlocal remaining
+
+        if combined.done():
+            return
+
+        error = future.exception()
+
+        if error is not None and not return_exceptions:
+            combined.set_exception(error)
+            return
+
+        results[key] = error if error is not None else future.result()
+        remaining -= 1
+
+        if remaining == 0:
+            combined.set_result(results)
+
+    for key, future in futures.items():
+        future.add_done_callback(lambda future, key=key: on_done(key, future))
+
+    return combined
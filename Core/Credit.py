@@ -0,0 +1,99 @@
+"""
+Credit based flow control for streamed replies.
+"""
+
+import threading
+from collections import deque
+
+
+class ReplyCredit(object):
+    """
+    The reply parts a caller has allowed to be sent for one of its calls.
+
+    Every part spends one credit. Parts submitted once the credit is spent
+    are held back, in order, until the caller grants more, so a handler can
+    keep producing without flooding the connection.
+
+    Attributes:
+        credit (int): Parts that may still be sent right away
+        held (deque): Parts waiting for credit
+    """
+
+    def __init__(self, credit, send):
+        self.credit = credit
+        self.send = send
+        self.held = deque()
+        self.closed = False
+        self.sending = False
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.held)
+
+    def submit(self, message, block=False, timeout=None):
+        """
+        Sends message, or holds it back until there is credit for it.
+
+        Args:
+            block (bool): Wait until the message can be sent instead of
+                holding it back
+            timeout (float): Seconds to wait at most when blocking
+
+        Returns:
+            bool: False if the gate was closed or the wait timed out
+        """
+        with self.condition:
+            if block:
+                self.condition.wait_for(lambda: self.closed or self.credit > len(self.held), timeout)
+
+                if not self.closed and self.credit <= len(self.held):
+                    return False
+
+            if self.closed:
+                return False
+
+            self.held.append(message)
+
+        self._pump()
+        return True
+
+    def grant(self, amount):
+        """ Adds credit and sends as many held parts as it covers """
+        with self.condition:
+            self.credit += amount
+            self.condition.notify_all()
+
+        self._pump()
+
+    def close(self):
+        """ Drops the held parts and releases anyone waiting for credit """
+        with self.condition:
+            self.closed = True
+            self.held.clear()
+            self.condition.notify_all()
+
+    def _pump(self):
+        # Only one thread sends at a time, which keeps the parts in order
+        # without holding the lock while they are queued on the socket
+        sent = False
+
+        while True:
+            with self.condition:
+                if sent:
+                    self.sending = False
+
+                if self.sending or self.closed or not self.held or self.credit <= 0:
+                    return
+
+                self.sending = True
+                self.credit -= 1
+                message = self.held.popleft()
+
+            try:
+                self.send(message)
+            except:
+                with self.condition:
+                    self.sending = False
+                raise
+
+            sent = True
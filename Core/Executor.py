@@ -0,0 +1,109 @@
+"""
+Runs the handlers of incoming calls off the server thread.
+"""
+
+import threading
+import traceback
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class HandlerExecutor(object):
+    """
+    Hands incoming calls to a bounded pool of worker threads, so a slow
+    handler cannot hold up reading from every other connection.
+
+    Calls for an event that is at its concurrency limit wait in order and are
+    picked up by the worker that finishes one of its running calls. Inline
+    events, and every event when there are no workers, run right away on the
+    calling thread.
+
+    Attributes:
+        workers (int): Size of the pool, 0 to run every handler inline
+        max_per_event (int): Calls of one event that may run at once, None
+            for no limit other than the pool size
+        limits (dict): max_per_event overrides keyed by event name
+        inline (set): Events cheap enough to run on the calling thread
+    """
+
+    def __init__(self, workers=4, max_per_event=None, limits=None, inline=None):
+        self.workers = workers
+        self.max_per_event = max_per_event
+        self.limits = dict(limits or {})
+        self.inline = inline if inline is not None else set()
+        self.pool = ThreadPoolExecutor(max_workers=workers) if workers else None
+        self.running = defaultdict(int)
+        self.waiting = defaultdict(deque)
+        self.lock = threading.Lock()
+
+    def limit(self, event):
+        return self.limits.get(event, self.max_per_event)
+
+    def submit(self, event, fn, *args):
+        """
+        Calls fn(*args) for a call of event, on a worker unless it is inline.
+        Raises RuntimeError once the pool has been shut down.
+        """
+        if self.pool is None or event in self.inline:
+            fn(*args)
+            return
+
+        with self.lock:
+            limit = self.limit(event)
+
+            if limit is not None and self.running[event] >= limit:
+                self.waiting[event].append((fn, args))
+                return
+
+            self.running[event] += 1
+
+        try:
+            self.pool.submit(self._run, event, fn, args)
+        except RuntimeError:
+            # The pool has been shut down, the caller has to answer the call
+            with self.lock:
+                self._release(event)
+            raise
+
+    def _run(self, event, fn, args):
+        while True:
+            try:
+                fn(*args)
+            except Exception:
+                traceback.print_exc()
+
+            # Keep this worker on the event while calls are waiting for it
+            with self.lock:
+                waiting = self.waiting.get(event)
+
+                if not waiting:
+                    self._release(event)
+                    return
+
+                fn, args = waiting.popleft()
+
+    def _release(self, event):
+        self.running[event] -= 1
+
+        if self.running[event] <= 0:
+            del self.running[event]
+            self.waiting.pop(event, None)
+
+    def pending(self):
+        """
+        Returns:
+            dict: The running and waiting calls of each busy event
+        """
+        with self.lock:
+            return {
+                event: {'running': count, 'waiting': len(self.waiting.get(event, ()))}
+                for event, count in self.running.items()
+            }
+
+    def shutdown(self):
+        """ Drops the waiting calls and lets the workers finish the running ones """
+        with self.lock:
+            self.waiting.clear()
+
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
@@ -0,0 +1,52 @@
+"""
+Ids for outgoing messages.
+"""
+
+import itertools
+import os
+
+
+BASE36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+# 64 random bits take at most 13 base 36 digits
+PREFIX_LENGTH = 13
+
+
+def to_base36(value):
+    digits = []
+
+    while True:
+        value, digit = divmod(value, 36)
+        digits.append(BASE36[digit])
+
+        if not value:
+            break
+
+    return ''.join(reversed(digits))
+
+
+def random_prefix():
+    """ A 'c' followed by 64 random bits, padded so ids cannot run into each other """
+    value = int.from_bytes(os.urandom(8), 'big')
+    return 'c' + to_base36(value).rjust(PREFIX_LENGTH, '0')
+
+
+def message_id_factory(prefix=None):
+    """
+    Creates a function returning a new message id on every call.
+
+    Ids are a random prefix picked when the factory is created followed by a
+    hex counter, so an id costs one string format. A new prefix is picked
+    every time the plugin is loaded, which keeps ids from different loads and
+    different editors apart. Like cuids, ids are strings starting with 'c'.
+    """
+    if prefix is None:
+        prefix = random_prefix()
+
+    counter = itertools.count()
+    template = prefix + '%x'
+
+    def create_id():
+        return template % next(counter)
+
+    return create_id
@@ -0,0 +1,225 @@
+"""
+Logging that costs next to nothing for the messages nobody will read, and
+a short history of protocol traffic to look at after the fact.
+"""
+
+import os
+import reprlib
+import tempfile
+import time
+from collections import deque
+
+from .Outgoing import ReplyMessage, CallMessage
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+# Longest text an argument is cut down to
+MAX_LENGTH = 200
+
+
+class _Repr(reprlib.Repr):
+    """ Cuts bytes down before taking their repr, which reprlib does after """
+
+    def repr_bytes(self, value, level):
+        if len(value) <= self.maxstring:
+            return repr(value)
+
+        return '{}...'.format(repr(value[:self.maxstring]))
+
+    repr_bytearray = repr_bytes
+
+
+_repr = _Repr()
+_repr.maxlevel = 3
+_repr.maxdict = 8
+_repr.maxlist = 8
+_repr.maxtuple = 8
+_repr.maxstring = 80
+_repr.maxother = 80
+
+
+def summarize(value, limit=MAX_LENGTH):
+    """
+    A short version of value for a log line. Containers and messages are
+    shown a few items and levels deep, so the cost does not grow with the
+    size of a payload.
+    """
+    if isinstance(value, (ReplyMessage, CallMessage)):
+        value = value.to_dict()
+
+    if isinstance(value, str):
+        if len(value) <= limit:
+            return value
+
+        return '{}... ({} chars)'.format(value[:limit], len(value))
+
+    if isinstance(value, (bytes, bytearray)):
+        # reprlib builds the full repr of bytes before cutting it down
+        if len(value) <= limit:
+            return repr(value)
+
+        return '{}... ({} bytes)'.format(repr(value[:limit]), len(value))
+
+    if isinstance(value, (dict, list, tuple)):
+        return _repr.repr(value)
+
+    return value
+
+
+class LevelLogger(object):
+    """
+    Drops messages below level before anything is formatted.
+
+    Messages are str.format templates. Their arguments are summarized and
+    filled in only when the message is written, so a call that is dropped
+    costs a comparison.
+
+    Attributes:
+        logger: Writes the messages, with info, warning and error methods
+        level (int): Messages below it are dropped
+    """
+
+    def __init__(self, logger, level=INFO):
+        self.logger = logger
+        self.level = level
+
+    def is_enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, message, *args):
+        if level < self.level:
+            return
+
+        if args:
+            message = message.format(*[summarize(arg) for arg in args])
+
+        if level >= ERROR:
+            self.logger.error(message)
+        elif level >= WARNING:
+            self.logger.warning(message)
+        else:
+            self.logger.info(message)
+
+    def debug(self, message, *args):
+        if DEBUG >= self.level:
+            self.log(DEBUG, message, *args)
+
+    def info(self, message, *args):
+        if INFO >= self.level:
+            self.log(INFO, message, *args)
+
+    def warning(self, message, *args):
+        self.log(WARNING, message, *args)
+
+    def error(self, message, *args):
+        self.log(ERROR, message, *args)
+
+
+def describe(message):
+    """ The type, id, event, part and done of a message, leaving its payload alone """
+    if isinstance(message, ReplyMessage):
+        return 'reply', message.id, message.template.to['event'], message.part, message.done
+
+    if isinstance(message, CallMessage):
+        return 'call', message.id, message.event, None, None
+
+    if not isinstance(message, dict):
+        return type(message).__name__, None, None, None, None
+
+    get = message.get
+    to = get('to')
+    event = get('event')
+
+    if event is None and isinstance(to, dict):
+        event = to.get('event')
+
+    return get('type'), get('id'), event, get('part'), get('done')
+
+
+class ProtocolHistory(object):
+    """
+    The latest protocol events in a ring buffer, to dump when something
+    went wrong. Only what describe() picks out of a message is kept, so the
+    buffer stays small however large the payloads are, and recording one is
+    a tuple appended to a deque.
+
+    Attributes:
+        events (deque): (time, direction, client, type, id, event, part,
+            done) tuples, oldest first
+    """
+
+    def __init__(self, size=500, clock=time.time):
+        self.clock = clock
+        self.events = deque(maxlen=size)
+
+    @property
+    def size(self):
+        return self.events.maxlen
+
+    def resize(self, size):
+        if size != self.events.maxlen:
+            self.events = deque(self.events, maxlen=size)
+
+    def record(self, direction, client, message):
+        """ direction is "in" or "out", client the id of the other side """
+        if self.events.maxlen:
+            self.events.append((self.clock(), direction, client) + describe(message))
+
+    def note(self, client, what):
+        """ Records something that is not a message, like a client closing """
+        if self.events.maxlen:
+            self.events.append((self.clock(), '-', client, what, None, None, None, None))
+
+    def clear(self):
+        self.events.clear()
+
+    def lines(self):
+        lines = []
+
+        for timestamp, direction, client, kind, message_id, event, part, done in list(self.events):
+            fields = [
+                time.strftime('%H:%M:%S', time.localtime(timestamp)) + '.{:03d}'.format(int(timestamp % 1 * 1000)),
+                '{:<3}'.format(direction),
+                str(client),
+                str(kind),
+            ]
+
+            if message_id is not None:
+                fields.append(str(message_id))
+
+            if event is not None:
+                fields.append(str(event))
+
+            if part is not None:
+                fields.append('part {}'.format(part))
+
+            if done:
+                fields.append('done')
+
+            lines.append(' '.join(fields))
+
+        return lines
+
+    def dump(self, path=None):
+        """
+        Writes the events to path, or to a new file in the temp dir.
+
+        Returns:
+            str: The path written to
+        """
+        if path is None:
+            directory = os.path.join(tempfile.gettempdir(), 'EditorConnect')
+
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            path = os.path.join(directory, 'protocol-{}.log'.format(time.strftime('%Y%m%d-%H%M%S')))
+
+        with open(path, 'w') as file:
+            file.write('\n'.join(self.lines()) + '\n')
+
+        return path
@@ -0,0 +1,95 @@
+"""
+Batches work that has to run on the editor's main thread.
+"""
+
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+
+class MainThreadDispatcher(object):
+    """
+    Gathers work items from any thread and runs them on the main thread in
+    as few scheduled callbacks as possible.
+
+    The first item queued schedules a drain. A drain runs items in the order
+    they were queued until its time budget is spent, then schedules another
+    drain for the rest, so the editor can handle input in between. Items
+    queued with a key replace a pending item with the same key, keeping its
+    place in line, so only the latest of several "update view X" runs.
+
+    Attributes:
+        schedule (callable): Runs a callback on the main thread, taking
+            (callback, delay_ms) like sublime.set_timeout
+        budget (float): Seconds a drain may spend before it yields, at least
+            one item runs per drain
+    """
+
+    def __init__(self, schedule, budget=0.008, clock=time.perf_counter):
+        self.schedule = schedule
+        self.budget = budget
+        self.clock = clock
+        self.items = OrderedDict()
+        self.scheduled = False
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Queues fn(*args) to run on the main thread.
+
+        Args:
+            key: Replaces a pending item queued with the same key
+        """
+        key = kwargs.pop('key', None)
+
+        if kwargs:
+            raise TypeError('unexpected keyword arguments {}'.format(sorted(kwargs)))
+
+        if key is None:
+            key = object()
+
+        with self.lock:
+            self.items[key] = (fn, args)
+
+            if self.scheduled:
+                return
+
+            self.scheduled = True
+
+        self.schedule(self.drain, 0)
+
+    def drain(self):
+        """ Runs queued items until the budget is spent. Called on the main thread. """
+        deadline = self.clock() + self.budget
+
+        while True:
+            with self.lock:
+                if not self.items:
+                    self.scheduled = False
+                    return
+
+                key, (fn, args) = self.items.popitem(last=False)
+
+            try:
+                fn(*args)
+            except Exception:
+                traceback.print_exc()
+
+            if self.clock() >= deadline:
+                break
+
+        with self.lock:
+            if not self.items:
+                self.scheduled = False
+                return
+
+        self.schedule(self.drain, 0)
+
+    def clear(self):
+        """ Drops every pending item """
+        with self.lock:
+            self.items.clear()
@@ -0,0 +1,160 @@
+"""
+Counters and latency histograms cheap enough to keep on in production.
+"""
+
+import threading
+import time
+
+
+# Bucket i counts durations of less than 2 ** i microseconds, the last one
+# everything longer
+BUCKETS = 28
+
+# The counters kept by each connection, and their names in a snapshot
+TRAFFIC = (
+    ('framesin', 'frames_in'),
+    ('framesout', 'frames_out'),
+    ('bytesin', 'bytes_in'),
+    ('bytesout', 'bytes_out'),
+)
+
+
+def connection_traffic(connection):
+    return {name: getattr(connection, counter) for counter, name in TRAFFIC}
+
+
+class Histogram(object):
+    """
+    Durations counted into power of two buckets of microseconds. Recording
+    one is a few integer operations, and percentiles are read back as the
+    upper bound of the bucket they fall in, so they are at most 2x high.
+
+    Not thread safe, callers recording from several threads hold a lock.
+    """
+
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+
+        if seconds > self.max:
+            self.max = seconds
+
+        bucket = int(seconds * 1000000).bit_length()
+        self.buckets[bucket if bucket < BUCKETS else BUCKETS - 1] += 1
+
+    def percentile(self, fraction, buckets=None, count=None):
+        """ The upper bound of the bucket holding the fraction, in seconds """
+        buckets = self.buckets if buckets is None else buckets
+        count = self.count if count is None else count
+        rank = fraction * count
+        seen = 0
+
+        for bucket, hits in enumerate(buckets):
+            seen += hits
+
+            if hits and seen >= rank:
+                return min((1 << bucket) / 1000000, self.max)
+
+        return self.max
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: The count, mean, p50, p99 and max, durations in milliseconds
+        """
+        # copy first, other threads may keep recording
+        buckets = list(self.buckets)
+        count = sum(buckets)
+
+        if not count:
+            return {'count': 0, 'mean_ms': None, 'p50_ms': None, 'p99_ms': None, 'max_ms': None}
+
+        return {
+            'count': count,
+            'mean_ms': self.total / max(self.count, 1) * 1000,
+            'p50_ms': self.percentile(0.5, buckets, count) * 1000,
+            'p99_ms': self.percentile(0.99, buckets, count) * 1000,
+            'max_ms': self.max * 1000,
+        }
+
+
+class ServerMetrics(object):
+    """
+    What a server has been doing since it started: its traffic, how long
+    handlers take to reply to each event, call timeouts and how long the
+    serving thread is busy on each pass through its loop.
+
+    The traffic of open connections is counted by the connections themselves
+    and added to closed when they go away.
+
+    Attributes:
+        loop (Histogram): Time the serving thread spent on each pass
+        handlers (dict): Histograms of the time from receiving a call to
+            its done reply, keyed by event
+        timeouts (dict): Outgoing calls that timed out, keyed by stage
+        closed (dict): Traffic of the connections that have closed
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started = clock()
+        self.loop = Histogram()
+        self.handlers = {}
+        self.timeouts = {}
+        self.closed = dict.fromkeys((name for counter, name in TRAFFIC), 0)
+        self.lock = threading.Lock()
+
+    def handled(self, event, seconds):
+        """ Records a call of event replied to in full, from any thread """
+        with self.lock:
+            histogram = self.handlers.get(event)
+
+            if histogram is None:
+                histogram = self.handlers[event] = Histogram()
+
+            histogram.record(seconds)
+
+    def timed_out(self, stage):
+        with self.lock:
+            self.timeouts[stage] = self.timeouts.get(stage, 0) + 1
+
+    def retire(self, connection):
+        """ Keeps the traffic of a connection that is closing """
+        with self.lock:
+            for counter, name in TRAFFIC:
+                self.closed[name] += getattr(connection, counter)
+
+    def traffic(self, connections):
+        """ The traffic of every connection so far, open or closed """
+        with self.lock:
+            totals = dict(self.closed)
+
+        for connection in connections:
+            for name, count in connection_traffic(connection).items():
+                totals[name] += count
+
+        return totals
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: Uptime, loop and handler histograms and timeout counts
+        """
+        with self.lock:
+            handlers = {event: histogram.snapshot() for event, histogram in self.handlers.items()}
+            timeouts = dict(self.timeouts)
+
+        return {
+            'uptime': self.clock() - self.started,
+            'loop': self.loop.snapshot(),
+            'handlers': handlers,
+            'timeouts': timeouts,
+        }
@@ -0,0 +1,260 @@
+"""
+A pure Python MessagePack encoder and decoder.
+
+Only the types that can come out of the JSON api are supported: None, bool,
+int, float, str, bytes, lists/tuples and dicts. Ext types are rejected.
+"""
+
+import struct
+
+
+_pack_float = struct.Struct('>d').pack
+_pack_b = struct.Struct('>B').pack
+_pack_h = struct.Struct('>H').pack
+_pack_i = struct.Struct('>I').pack
+_pack_q = struct.Struct('>Q').pack
+_pack_sb = struct.Struct('>b').pack
+_pack_sh = struct.Struct('>h').pack
+_pack_si = struct.Struct('>i').pack
+_pack_sq = struct.Struct('>q').pack
+
+
+class PackException(TypeError):
+    pass
+
+
+class UnpackException(ValueError):
+    pass
+
+
+def _pack(obj, write):
+    if obj is None:
+        write(b'\xc0')
+
+    elif obj is True:
+        write(b'\xc3')
+
+    elif obj is False:
+        write(b'\xc2')
+
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        length = len(data)
+
+        if length < 32:
+            write(_pack_b(0xa0 | length))
+        elif length < 0x100:
+            write(b'\xd9' + _pack_b(length))
+        elif length < 0x10000:
+            write(b'\xda' + _pack_h(length))
+        else:
+            write(b'\xdb' + _pack_i(length))
+
+        write(data)
+
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            write(_pack_b(obj))
+        elif -32 <= obj < 0:
+            write(_pack_sb(obj))
+        elif obj >= 0:
+            if obj < 0x100:
+                write(b'\xcc' + _pack_b(obj))
+            elif obj < 0x10000:
+                write(b'\xcd' + _pack_h(obj))
+            elif obj < 0x100000000:
+                write(b'\xce' + _pack_i(obj))
+            elif obj < 0x10000000000000000:
+                write(b'\xcf' + _pack_q(obj))
+            else:
+                raise PackException('int is too large to pack')
+        else:
+            if obj >= -0x80:
+                write(b'\xd0' + _pack_sb(obj))
+            elif obj >= -0x8000:
+                write(b'\xd1' + _pack_sh(obj))
+            elif obj >= -0x80000000:
+                write(b'\xd2' + _pack_si(obj))
+            elif obj >= -0x8000000000000000:
+                write(b'\xd3' + _pack_sq(obj))
+            else:
+                raise PackException('int is too small to pack')
+
+    elif isinstance(obj, float):
+        write(b'\xcb' + _pack_float(obj))
+
+    elif isinstance(obj, dict):
+        length = len(obj)
+
+        if length < 16:
+            write(_pack_b(0x80 | length))
+        elif length < 0x10000:
+            write(b'\xde' + _pack_h(length))
+        else:
+            write(b'\xdf' + _pack_i(length))
+
+        for key, value in obj.items():
+            _pack(key, write)
+            _pack(value, write)
+
+    elif isinstance(obj, (list, tuple)):
+        length = len(obj)
+
+        if length < 16:
+            write(_pack_b(0x90 | length))
+        elif length < 0x10000:
+            write(b'\xdc' + _pack_h(length))
+        else:
+            write(b'\xdd' + _pack_i(length))
+
+        for item in obj:
+            _pack(item, write)
+
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        length = len(obj)
+
+        if length < 0x100:
+            write(b'\xc4' + _pack_b(length))
+        elif length < 0x10000:
+            write(b'\xc5' + _pack_h(length))
+        else:
+            write(b'\xc6' + _pack_i(length))
+
+        write(bytes(obj))
+
+    else:
+        raise PackException('cannot pack object of type {}'.format(type(obj).__name__))
+
+
+def packb(obj):
+    """ Returns obj packed as bytes """
+    parts = []
+    _pack(obj, parts.append)
+    return b''.join(parts)
+
+
+_unpack_from = struct.unpack_from
+
+# (struct format, size) of the fixed width values, keyed by type byte
+_FIXED = {
+    0xca: ('>f', 4),
+    0xcb: ('>d', 8),
+    0xcc: ('>B', 1),
+    0xcd: ('>H', 2),
+    0xce: ('>I', 4),
+    0xcf: ('>Q', 8),
+    0xd0: ('>b', 1),
+    0xd1: ('>h', 2),
+    0xd2: ('>i', 4),
+    0xd3: ('>q', 8),
+}
+
+# (length format, length size) of the str, bin, array and map types
+_SIZED = {
+    0xc4: ('>B', 1),
+    0xc5: ('>H', 2),
+    0xc6: ('>I', 4),
+    0xd9: ('>B', 1),
+    0xda: ('>H', 2),
+    0xdb: ('>I', 4),
+    0xdc: ('>H', 2),
+    0xdd: ('>I', 4),
+    0xde: ('>H', 2),
+    0xdf: ('>I', 4),
+}
+
+
+def _unpack(data, offset):
+    """ Returns the object starting at offset and the offset after it """
+    code = data[offset]
+    offset += 1
+
+    if code < 0x80:
+        return code, offset
+
+    if code >= 0xe0:
+        return code - 0x100, offset
+
+    if code < 0x90:
+        length = code & 0x0f
+        kind = 0xde
+    elif code < 0xa0:
+        length = code & 0x0f
+        kind = 0xdc
+    elif code < 0xc0:
+        length = code & 0x1f
+        kind = 0xd9
+    elif code == 0xc0:
+        return None, offset
+    elif code == 0xc2:
+        return False, offset
+    elif code == 0xc3:
+        return True, offset
+    elif code in _FIXED:
+        fmt, size = _FIXED[code]
+        if offset + size > len(data):
+            raise UnpackException('truncated data')
+        return _unpack_from(fmt, data, offset)[0], offset + size
+    elif code in _SIZED:
+        fmt, size = _SIZED[code]
+        if offset + size > len(data):
+            raise UnpackException('truncated data')
+        length = _unpack_from(fmt, data, offset)[0]
+        offset += size
+        kind = code
+    else:
+        raise UnpackException('unsupported type byte 0x{:02x}'.format(code))
+
+    if kind == 0xde or kind == 0xdf:
+        result = {}
+        for _ in range(length):
+            key, offset = _unpack(data, offset)
+            value, offset = _unpack(data, offset)
+            result[key] = value
+        return result, offset
+
+    if kind == 0xdc or kind == 0xdd:
+        result = []
+        append = result.append
+        for _ in range(length):
+            item, offset = _unpack(data, offset)
+            append(item)
+        return result, offset
+
+    end = offset + length
+    if end > len(data):
+        raise UnpackException('truncated data')
+
+    if kind >= 0xd9:
+        return bytes(data[offset:end]).decode('utf-8'), end
+
+    return bytes(data[offset:end]), end
+
+
+def unpackb(data):
+    """ Returns the single object packed in data """
+    try:
+        obj, offset = _unpack(data, 0)
+    except IndexError:
+        raise UnpackException('truncated data')
+
+    if offset != len(data):
+        raise UnpackException('extra data after packed object')
+
+    return obj
+
+
+def unpack_all(data):
+    """ Returns a list of every object packed back to back in data """
+    objects = []
+    offset = 0
+    length = len(data)
+
+    try:
+        while offset < length:
+            obj, offset = _unpack(data, offset)
+            objects.append(obj)
+    except IndexError:
+        raise UnpackException('truncated data')
+
+    return objects
@@ -0,0 +1,156 @@
+"""
+Compact outgoing messages that encode without building a dict.
+
+The fields that stay the same for every message of a kind, like the origin
+block or the "to" block of every reply to one call, are encoded once and
+spliced into each message. The output is byte for byte what encoding the
+equivalent dict would give, so clients see no difference.
+"""
+
+import json
+
+from . import MsgPack
+
+
+_dumps = json.dumps
+_packb = MsgPack.packb
+
+# json fragments are used as % templates
+def _fragment(value):
+    return _dumps(value).replace('%', '%%')
+
+
+class OutgoingMessage(object):
+    """
+    Base of the outgoing messages. They can still be read like the dicts
+    they replace, with message['field'] and the to_dict() each of them
+    defines.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return self.to_dict()[key]
+
+    def get(self, key, default=None):
+        return self.to_dict().get(key, default)
+
+    def __contains__(self, key):
+        return key in self.to_dict()
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def encode_json(self):
+        return _dumps(self.to_dict())
+
+    def encode_msgpack(self):
+        return _packb(self.to_dict())
+
+
+class ReplyTemplate(object):
+    """
+    Everything the replies to one call have in common, encoded for each
+    codec the first time a part is sent with it.
+    """
+
+    __slots__ = ('origin', 'to', 'json', 'msgpack')
+
+    def __init__(self, call, origin):
+        self.origin = {'id': origin['id']}
+        self.to = {'id': call['id'], 'iid': call['iid'], 'event': call['event']}
+        self.json = None
+        self.msgpack = None
+
+    def json_template(self):
+        if self.json is None:
+            self.json = (
+                '{"id": "%s", "iid": %d, "type": "reply", "part": %d, "done": %s, '
+                '"origin": ' + _fragment(self.origin) + ', '
+                '"to": ' + _fragment(self.to) + ', '
+                '"payload": %s}'
+            )
+
+        return self.json
+
+    def msgpack_fragments(self):
+        if self.msgpack is None:
+            self.msgpack = (
+                b'\x88' + _packb('id'),
+                _packb('iid'),
+                _packb('type') + _packb('reply') + _packb('part'),
+                _packb('done'),
+                _packb('origin') + _packb(self.origin) + _packb('to') + _packb(self.to) + _packb('payload'),
+            )
+
+        return self.msgpack
+
+
+class ReplyMessage(OutgoingMessage):
+    """ One part of a reply. ids are expected to need no escaping. """
+
+    __slots__ = ('id', 'iid', 'part', 'done', 'payload', 'template')
+
+    def __init__(self, id, iid, part, done, payload, template):
+        self.id = id
+        self.iid = iid
+        self.part = part
+        self.done = done
+        self.payload = payload
+        self.template = template
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'iid': self.iid,
+            'type': 'reply',
+            'part': self.part,
+            'done': self.done,
+            'origin': dict(self.template.origin),
+            'to': dict(self.template.to),
+            'payload': self.payload,
+        }
+
+    def encode_json(self):
+        return self.template.json_template() % (
+            self.id, self.iid, self.part, 'true' if self.done else 'false', _dumps(self.payload))
+
+    def encode_msgpack(self):
+        head, iid, part, done, tail = self.template.msgpack_fragments()
+        return b''.join((
+            head, _packb(self.id),
+            iid, _packb(self.iid),
+            part, _packb(self.part),
+            done, b'\xc3' if self.done else b'\xc2',
+            tail, _packb(self.payload),
+        ))
+
+
+class CallMessage(OutgoingMessage):
+    """ A call to the clients, sent to each of them with the same encoding """
+
+    __slots__ = ('id', 'iid', 'event', 'payload', 'origin', 'credit')
+
+    def __init__(self, id, iid, event, payload, origin, credit=None):
+        self.id = id
+        self.iid = iid
+        self.event = event
+        self.payload = payload
+        self.origin = {'id': origin['id']}
+        self.credit = credit
+
+    def to_dict(self):
+        message = {
+            'id': self.id,
+            'iid': self.iid,
+            'type': 'call',
+            'event': self.event,
+            'payload': self.payload,
+            'origin': dict(self.origin),
+        }
+
+        # Replies are flow controlled only when the call grants credit
+        if self.credit is not None:
+            message['credit'] = self.credit
+
+        return message
@@ -0,0 +1,211 @@
+"""
+Runs the handlers of CPU bound calls in a pool of worker processes.
+
+Everything here is imported by the workers too, so it must not depend on
+the sublime modules.
+"""
+
+import importlib
+import itertools
+import multiprocessing
+import pickle
+import sys
+import threading
+import traceback
+
+
+PART = 'part'
+ERROR = 'error'
+
+# Set in each worker by _init_worker
+_parts = None
+
+
+def _init_worker(parts, path, modules):
+    """ Warms a worker up by importing the handler modules before any call """
+    global _parts
+    _parts = parts
+
+    for entry in path:
+        if entry not in sys.path:
+            sys.path.append(entry)
+
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            traceback.print_exc()
+
+
+class ChildReply(object):
+    """
+    The reply function handed to a handler in a worker. Parts are sent back
+    to the server process as they are produced.
+    """
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.done = False
+
+    def __call__(self, data, done=False):
+        if self.done:
+            raise Exception('reply called after done')
+
+        self.done = done
+        _parts.put((self.task_id, PART, data, done))
+
+
+def _run_task(task_id, func, payload):
+    reply = ChildReply(task_id)
+
+    try:
+        result = func(pickle.loads(payload), reply)
+
+        # Handlers may return their last part instead of replying with it
+        if not reply.done:
+            reply(result, True)
+    except Exception:
+        _parts.put((task_id, ERROR, traceback.format_exc(), True))
+
+
+class ProcessHandlers(object):
+    """
+    A persistent multiprocessing pool for handlers registered as "process".
+
+    Handlers must be module level functions taking (payload, reply), so the
+    workers can import them. A call's payload is pickled once when it is
+    submitted, and the parts a handler replies with are streamed back over a
+    queue, read by a thread that passes them to the call's own reply. A
+    handler that fails has its traceback printed, and the call is done with
+    an {"error": message} reply.
+
+    Attributes:
+        handlers (dict): Handler functions keyed by event
+        workers (int): Number of processes, None for one per core
+        max_tasks_per_child (int): Calls a worker handles before it is
+            replaced by a fresh one, None to keep workers for good
+        python (str): The interpreter workers are started with, None for
+            sys.executable
+        warm_up (list): Modules imported by every worker as it starts,
+            besides those of the handlers
+    """
+
+    def __init__(self, handlers, workers=None, max_tasks_per_child=None, python=None, warm_up=None):
+        self.handlers = handlers
+        self.workers = workers
+        self.max_tasks_per_child = max_tasks_per_child
+        self.python = python
+        self.warm_up = list(warm_up or ())
+        self.pool = None
+        self.parts = None
+        self.reader = None
+        self.tasks = {}
+        self.task_ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def __contains__(self, event):
+        return event in self.handlers
+
+    @property
+    def running(self):
+        return self.pool is not None
+
+    def start(self):
+        """ Starts the workers, unless they are running already """
+        with self.lock:
+            if self.pool is not None:
+                return
+
+            try:
+                # Forking the editor's plugin host is not safe
+                context = multiprocessing.get_context('spawn')
+            except AttributeError:
+                context = multiprocessing
+
+            if self.python is not None:
+                context.set_executable(self.python)
+
+            modules = self.warm_up + sorted(set(
+                func.__module__ for func in self.handlers.values()
+            ))
+
+            self.parts = context.Queue()
+            self.pool = context.Pool(
+                self.workers,
+                _init_worker,
+                (self.parts, list(sys.path), modules),
+                self.max_tasks_per_child,
+            )
+
+            self.reader = threading.Thread(target=self._read, args=(self.parts,))
+            self.reader.daemon = True
+            self.reader.start()
+
+    def submit(self, event, payload, reply):
+        """ Runs the event's handler in a worker, replying through reply """
+        self.start()
+
+        task_id = next(self.task_ids)
+        self.tasks[task_id] = reply
+
+        def on_error(error):
+            reply = self.tasks.pop(task_id, None)
+
+            if reply is not None:
+                traceback.print_exception(type(error), error, error.__traceback__)
+                self._fail(reply, 'process handler for "{}" failed: {}'.format(event, error))
+
+        try:
+            data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+            self.pool.apply_async(_run_task, (task_id, self.handlers[event], data),
+                                  error_callback=on_error)
+        except Exception:
+            self.tasks.pop(task_id, None)
+            raise
+
+    def _read(self, parts):
+        while True:
+            try:
+                item = parts.get()
+            except Exception:
+                # The queue is closed, or a worker was terminated halfway
+                # through writing to it
+                return
+
+            if item is None:
+                return
+
+            task_id, kind, data, done = item
+            reply = self.tasks.pop(task_id, None) if done else self.tasks.get(task_id)
+
+            if reply is None:
+                continue
+
+            if kind == ERROR:
+                # the worker's traceback, formatted over there
+                sys.stderr.write(data)
+                self._fail(reply, data.strip().splitlines()[-1])
+                continue
+
+            try:
+                reply(data, done)
+            except Exception:
+                traceback.print_exc()
+
+    def _fail(self, reply, message):
+        """ Ends a call whose handler failed, so the caller does not wait for its timeout """
+        try:
+            reply({'error': message}, True)
+        except Exception:
+            traceback.print_exc()
+
+    def shutdown(self):
+        """ Stops the workers, abandoning the calls they are running """
+        with self.lock:
+            if self.pool is None:
+                return
+
+            self.pool.terminate()
+            self.parts.put(None)
+            self.pool = None
+            self.tasks.clear()
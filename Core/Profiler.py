@@ -0,0 +1,141 @@
+"""
+Profiles the server thread while it keeps serving.
+
+Nothing here runs, or is looked up by the server, unless a profile has been
+started.
+"""
+
+import cProfile
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+
+def output_path(directory, extension, clock=time.time):
+    """ A new file in directory, or in the temp dir when it is None """
+    if directory is None:
+        directory = os.path.join(tempfile.gettempdir(), 'EditorConnect')
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    name = 'profile-{}.{}'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(clock())), extension)
+    path = os.path.join(directory, name)
+    count = 1
+
+    while os.path.exists(path):
+        path = os.path.join(directory, '{}-{}.{}'.format(name.rsplit('.', 1)[0], count, extension))
+        count += 1
+
+    return path
+
+
+def collapse(name, frame):
+    """ A frame's stack as "name;outermost;...;innermost", as flame graph tools read it """
+    stack = []
+
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{} ({}:{})'.format(
+            code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+
+    stack.append(name)
+    stack.reverse()
+
+    return ';'.join(stack)
+
+
+class StackSampler(object):
+    """
+    Takes the stacks of threads every interval seconds from a thread of its
+    own, and counts how often each stack was seen. The sampled threads run
+    untouched, at the cost of the GIL being taken once per sample.
+
+    Writes collapsed stacks, one "stack count" line each.
+
+    Attributes:
+        threads (callable): Returns the threads to sample as a dict of names
+            keyed by thread ident, asked again for every sample
+        interval (float): Seconds between samples
+        stacks (Counter): Times each collapsed stack was seen
+        samples (int): Samples taken
+    """
+
+    extension = 'collapsed'
+
+    # Starting and stopping may happen on any thread
+    on_loop = False
+
+    def __init__(self, path, threads, interval=0.005):
+        self.path = path
+        self.threads = threads
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='EditorConnect profiler', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+
+            for ident, name in self.threads().items():
+                frame = frames.get(ident)
+
+                if frame is not None:
+                    self.stacks[collapse(name, frame)] += 1
+
+            self.samples += 1
+
+            # don't hold on to the frames, or their locals, between samples
+            frames = frame = None
+
+    def stop(self):
+        self.stopped.set()
+
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def dump(self):
+        with open(self.path, 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write('{} {}\n'.format(stack, count))
+
+
+class LoopProfile(object):
+    """
+    A cProfile of everything the server thread runs, writing pstats output.
+    cProfile only sees the thread it was enabled on, so start and stop have
+    to be called on the server thread.
+    """
+
+    extension = 'pstats'
+
+    on_loop = True
+
+    def __init__(self, path):
+        self.path = path
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self):
+        self.profile.dump_stats(self.path)
+
+
+PROFILERS = {
+    'sample': StackSampler,
+    'cprofile': LoopProfile,
+}
@@ -0,0 +1,130 @@
+"""
+A hashed timer wheel for the many short lived timeouts of outgoing calls.
+"""
+
+import threading
+import time
+import traceback
+
+
+class Timeout(object):
+    """ A scheduled callback, returned by TimerWheel.schedule """
+
+    __slots__ = ('wheel', 'tick', 'callback', 'slot')
+
+    def __init__(self, wheel, tick, callback):
+        self.wheel = wheel
+        self.tick = tick
+        self.callback = callback
+        self.slot = None
+
+    @property
+    def active(self):
+        return self.slot is not None
+
+    def cancel(self):
+        """ Cancels the timeout if it has not fired yet """
+        self.wheel._remove(self)
+
+
+class TimerWheel(object):
+    """
+    Timeouts hashed into slots by the tick they expire on.
+
+    Scheduling and cancelling are O(1). Nothing runs on its own: whoever owns
+    the wheel calls advance() regularly, which fires every timeout that is due
+    on the calling thread. Timeouts fire at most one tick late.
+
+    Attributes:
+        resolution (float): Length of a tick in seconds
+    """
+
+    def __init__(self, resolution=0.05, size=512, clock=time.monotonic):
+        self.resolution = resolution
+        self.size = size
+        self.clock = clock
+        self.slots = [set() for _ in range(size)]
+        self.count = 0
+        self.lock = threading.Lock()
+        self.current = self._tick(clock())
+
+    def __len__(self):
+        return self.count
+
+    def _tick(self, now):
+        return int(now / self.resolution)
+
+    def schedule(self, delay, callback):
+        """
+        Calls callback once delay seconds have passed.
+
+        Returns:
+            Timeout: Can be cancelled
+        """
+        tick = self._tick(self.clock() + delay)
+
+        with self.lock:
+            # Never schedule into a slot that has already been swept
+            tick = max(tick, self.current + 1)
+            timeout = Timeout(self, tick, callback)
+            timeout.slot = self.slots[tick % self.size]
+            timeout.slot.add(timeout)
+            self.count += 1
+
+        return timeout
+
+    def _remove(self, timeout):
+        with self.lock:
+            if timeout.slot is not None:
+                timeout.slot.discard(timeout)
+                timeout.slot = None
+                self.count -= 1
+
+    def advance(self, now=None):
+        """
+        Fires every timeout that has expired by now.
+
+        Returns:
+            int: The number of timeouts fired
+        """
+        target = self._tick(self.clock() if now is None else now)
+
+        if target <= self.current:
+            return 0
+
+        expired = []
+
+        with self.lock:
+            if self.count:
+                # Past a full turn every slot is visited exactly once
+                start = max(self.current + 1, target - self.size + 1)
+
+                for tick in range(start, target + 1):
+                    slot = self.slots[tick % self.size]
+
+                    for timeout in [timeout for timeout in slot if timeout.tick <= target]:
+                        slot.discard(timeout)
+                        timeout.slot = None
+                        expired.append(timeout)
+
+                self.count -= len(expired)
+
+            self.current = target
+
+        # a failing callback must neither stop the others nor the thread
+        # advancing the wheel
+        for timeout in sorted(expired, key=lambda timeout: timeout.tick):
+            try:
+                timeout.callback()
+            except Exception:
+                traceback.print_exc()
+
+        return len(expired)
+
+    def clear(self):
+        with self.lock:
+            for slot in self.slots:
+                for timeout in slot:
+                    timeout.slot = None
+                slot.clear()
+            self.count = 0
@@ -0,0 +1,99 @@
+"""
+Checks that incoming messages conform to the api, one check per type.
+
+Each check assumes the message is a dict of the type it is registered for
+and gives up at the first field that does not conform.
+"""
+
+
+def is_length(value):
+    return isinstance(value, int) and value >= 0
+
+
+def is_non_empty_str(value):
+    return isinstance(value, str) and len(value) > 0
+
+
+def check_call(message):
+    origin = message.get('origin')
+    event = message.get('event')
+    message_id = message.get('id')
+
+    return (
+        isinstance(message_id, str) and len(message_id) > 0 and
+        isinstance(origin, dict) and is_non_empty_str(origin.get('id')) and
+        'payload' in message and
+        isinstance(event, str) and len(event) > 0 and
+        ('credit' not in message or is_length(message['credit']))
+    )
+
+
+def check_reply(message):
+    origin = message.get('origin')
+    to = message.get('to')
+    message_id = message.get('id')
+    part = message.get('part')
+
+    return (
+        isinstance(message_id, str) and len(message_id) > 0 and
+        isinstance(origin, dict) and is_non_empty_str(origin.get('id')) and
+        'payload' in message and
+        isinstance(part, int) and part >= 0 and
+        isinstance(message.get('done'), bool) and
+        isinstance(to, dict) and
+        is_non_empty_str(to.get('id')) and
+        is_length(to.get('iid')) and
+        is_non_empty_str(to.get('event'))
+    )
+
+
+def check_handshake(message):
+    origin = message.get('origin')
+    message_id = message.get('id')
+
+    return (
+        isinstance(message_id, str) and len(message_id) > 0 and
+        isinstance(origin, dict) and is_non_empty_str(origin.get('id')) and
+        'payload' in message
+    )
+
+
+def check_credit(message):
+    to = message.get('to')
+
+    return (
+        is_length(message.get('credit')) and
+        isinstance(to, dict) and
+        is_non_empty_str(to.get('id'))
+    )
+
+
+def check_type_only(message):
+    return True
+
+
+VALIDATORS = {
+    'call': check_call,
+    'reply': check_reply,
+    'handshake': check_handshake,
+    'credit': check_credit,
+    'ping': check_type_only,
+    'pong': check_type_only,
+}
+
+
+def lookup(table, message):
+    """
+    Returns:
+        The entry of table for the type of message, or None if the message
+        is not a dict or has no type in the table
+    """
+    if not isinstance(message, dict):
+        return None
+
+    message_type = message.get('type')
+
+    if not isinstance(message_type, str):
+        return None
+
+    return table.get(message_type)
@@ -2,19 +2,39 @@ import sublime_plugin
 import sublime
 
 import json
+import time
 import traceback
 
-from threading import Thread, Timer
-from collections import defaultdict
+from json.decoder import WHITESPACE
+
+from threading import Thread, Lock, current_thread, enumerate as all_threads
+from concurrent.futures import Future
+from collections import defaultdict, deque
 
 from SublimeTools.Settings import Settings
 from SublimeTools.EventEmitter import EventEmitter
-from SublimeTools.Utils import pluck, incremental_id_factory
-from SublimeTools.cuid import cuid
+from SublimeTools.Utils import incremental_id_factory
 from SublimeTools.Logging import Logger
 
 # https://github.com/dpallot/simple-websocket-server
-from .SimpleWebSocketServer.SimpleWebSocketServer import SimpleWebSocketServer, WebSocket
+from .SimpleWebSocketServer.SimpleWebSocketServer import SimpleWebSocketServer, WebSocket, prepareMessage
+from .SimpleWebSocketServer.AsyncioWebSocketServer import AsyncioWebSocketServer, asyncio
+from .Core import MsgPack
+from .Core.Calls import PendingCalls, CallResult, CallTimeoutError, gather_futures
+from .Core.Timers import TimerWheel
+from .Core.Credit import ReplyCredit
+from .Core.Executor import HandlerExecutor
+from .Core.Processes import ProcessHandlers
+from .Core.MainThread import MainThreadDispatcher
+from .Core.Ids import message_id_factory
+from .Core.Metrics import ServerMetrics, connection_traffic
+from .Core.Profiler import PROFILERS, StackSampler, LoopProfile, output_path
+from .Core.Log import LevelLogger, ProtocolHistory, DEBUG, INFO, summarize
+from .Core.Outgoing import OutgoingMessage, ReplyMessage, ReplyTemplate, CallMessage
+from .Core.Validators import (
+    VALIDATORS, lookup,
+    check_call, check_reply, check_handshake, check_credit, check_type_only,
+)
 
 
 SETTINGS_PATH = 'EditorConnect.sublime-settings'
@@ -39,15 +59,35 @@ ORIGIN = {
 
 HOST = '127.0.0.1'
 
+# Built in calls any client can make, answered by the server itself
+STATS_EVENT = 'self:stats'
+PROFILE_EVENT = 'self:profile'
+
+# The profile options a client may set, and the bounds of the numeric ones.
+# A client's profile always ends on its own.
+PROFILE_OPTIONS = ('mode', 'seconds', 'interval_ms', 'threads')
+PROFILE_LIMITS = {
+    'seconds': (0.1, 300),
+    'interval_ms': (1, 1000),
+}
+
 port = None
 websocket_server = None
 websocket_server_thread = None
 
 create_call_id = incremental_id_factory()
 create_reply_id = incremental_id_factory()
+create_message_id = message_id_factory()
 
 
-logger = Logger(name='EditorConnect')
+# Messages of every incoming call and reply are only logged in "dev"
+logger = LevelLogger(Logger(name='EditorConnect'))
+
+# The latest messages in and out, dumped with DumpProtocolHistoryCommand
+history = ProtocolHistory()
+
+# Sublime API work handed over from handlers, run in batched set_timeout ticks
+main_thread = MainThreadDispatcher(sublime.set_timeout)
 
 
 class Messages(object):
@@ -58,43 +98,42 @@ class Messages(object):
     HANDSHAKE_ACCEPT = 'handshake-accept'
     PING = 'ping'
     PONG = 'pong'
+    CREDIT = 'credit'
 
     @staticmethod
-    def call(name, payload, origin):
-        return {
-            'id': cuid(),
-            'iid': create_call_id(),
-            'type': Messages.CALL,
-            'event': name,
-            'payload': payload,
-            'origin': {
-                'id': origin['id'],
-            }
-        }
+    def call(name, payload, origin, credit=None):
+        return CallMessage(create_message_id(), create_call_id(), name, payload, origin, credit)
+
+    @staticmethod
+    def reply(payload, call, part, done, origin, template=None):
+        """
+        Pass the same template for every part replied to one call, so the
+        parts they have in common are only encoded once.
+        """
+        if template is None:
+            template = ReplyTemplate(call, origin)
+
+        return ReplyMessage(create_message_id(), create_reply_id(), part, done, payload, template)
 
     @staticmethod
-    def reply(payload, call, part, done, origin):
+    def credit(amount, call_id, name, origin):
         return {
-            'id': cuid(),
-            'iid': create_reply_id(),
-            'type': Messages.REPLY,
-            'part': part,
-            'done': done,
+            'id': create_message_id(),
+            'type': Messages.CREDIT,
+            'credit': amount,
             'origin': {
                 'id': origin['id'],
             },
             'to': {
-                'id': call['id'],
-                'iid': call['iid'],
-                'event': call['event'],
+                'id': call_id,
+                'event': name,
             },
-            'payload': payload,
         }
 
     @staticmethod
     def handshake(payload, origin):
         return {
-            'id': cuid(),
+            'id': create_message_id(),
             'type': 'handshake',
             'origin': {
               'id': origin['id'],
@@ -105,7 +144,7 @@ class Messages(object):
     @staticmethod
     def handshake_accept(payload, to, origin):
         return {
-            'id': cuid(),
+            'id': create_message_id(),
             'type': Messages.HANDSHAKE_ACCEPT,
             'payload': payload,
             'to': {
@@ -119,64 +158,25 @@ class Messages(object):
     @staticmethod
     def is_valid(message):
         """ Returns true if the message conforms to the api """
+        check = lookup(VALIDATORS, message)
 
-        if not isinstance(message, dict):
-            return False
-
-        return (
-                Messages.is_reply(message) or
-                Messages.is_call(message) or
-                Messages.is_handshake(message) or
-                Messages.is_ping(message) or
-                Messages.is_pong(message)
-            )
+        return check is not None and check(message)
 
     @staticmethod
     def is_handshake(message):
-        if message.get('type') != Messages.HANDSHAKE:
-            return False
-
-        origin = message.get('origin')
-
-        return all([
-            is_non_empty_str(message.get('id')),
-            isinstance(origin, dict) and is_non_empty_str(origin.get('id')),
-            'payload' in message,
-        ])
+        return message.get('type') == Messages.HANDSHAKE and check_handshake(message)
 
     @staticmethod
     def is_call(message):
-        if message.get('type') != Messages.CALL:
-            return False
-
-        origin = message.get('origin')
-
-        return all([
-            is_non_empty_str(message.get('id')),
-            isinstance(origin, dict) and is_non_empty_str(origin.get('id')),
-            'payload' in message,
-            is_non_empty_str(message.get('event'))
-        ])
+        return message.get('type') == Messages.CALL and check_call(message)
 
     @staticmethod
     def is_reply(message):
-        if message.get('type') != Messages.REPLY:
-            return False
+        return message.get('type') == Messages.REPLY and check_reply(message)
 
-        to = message.get('to')
-        origin = message.get('origin')
-
-        return all([
-            is_non_empty_str(message.get('id')),
-            isinstance(origin, dict) and is_non_empty_str(origin.get('id')),
-            'payload' in message,
-            is_length(message.get('part')),
-            isinstance(message.get('done'), bool),
-            isinstance(to, dict),
-            is_non_empty_str(to.get('id')),
-            is_length(to.get('iid')),
-            is_non_empty_str(to.get('event')),
-        ])
+    @staticmethod
+    def is_credit(message):
+        return message.get('type') == Messages.CREDIT and check_credit(message)
 
     @staticmethod
     def ping():
@@ -201,124 +201,661 @@ Messages.api_types = [
     Messages.HANDSHAKE,
     Messages.HANDSHAKE_ACCEPT,
     Messages.PING,
-    Messages.PONG
+    Messages.PONG,
+    Messages.CREDIT,
 ]
 
 
 class Parser():
     """ Parses and encodes incoming and outgoing data from the server """
 
+    name = 'json'
+
     def encode(self, data):
+        if isinstance(data, OutgoingMessage):
+            return data.encode_json() + END_OF_MESSAGE_STR
+
         return json.dumps(data) + END_OF_MESSAGE_STR
 
     def decode(self, data):
-        return [json.loads(item) for item in str(data).split(END_OF_MESSAGE_STR) if item]
+        return [json.loads(item) for item in data.split(END_OF_MESSAGE_STR) if item]
+
+    def create_decoder(self, maxsize=None):
+        """ Returns a decoder holding on to messages split across frames """
+        return StreamDecoder(maxsize)
+
+
+class StreamDecoder(object):
+    """
+    Incrementally decodes newline delimited json, one instance per connection.
+
+    Text from frames without a message boundary is held until the rest of the
+    message arrives. Messages are decoded in place with raw_decode, so the
+    frame text is never split into per-message copies.
+
+    The held text is dropped, and ValueError raised, when it grows past
+    maxsize characters, or when a frame holding a whole message of its own
+    arrives and the held text can no longer be completed, as when a client
+    sent a truncated message without a newline.
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.pending = []
+        self.held = 0
+        self.raw_decode = json.JSONDecoder().raw_decode
+
+    def decode(self, data):
+        if data.find(END_OF_MESSAGE_STR) == -1:
+            message = self.decode_complete(data)
+
+            if message is None:
+                if data:
+                    self.hold(data)
+                return []
+
+            if not self.pending:
+                return [message]
+
+            # a whole message may still be part of the held one, or follow
+            # one that was cut short
+            held = ''.join(self.pending) + data
+            message = self.decode_complete(held)
+
+            if message is None:
+                if not self.is_unfinished(held):
+                    self.reset()
+                    raise ValueError('Unfinished message dropped, the frame after it can not complete it')
+
+                self.hold(data)
+                return []
+
+            self.reset()
+            return [message]
+
+        if self.pending:
+            self.pending.append(data)
+            data = ''.join(self.pending)
+            self.reset()
+
+        try:
+            return self.decode_messages(data)
+        except Exception:
+            self.reset()
+            raise
+
+    def hold(self, data):
+        self.held += len(data)
+
+        if self.maxsize is not None and self.held > self.maxsize:
+            self.reset()
+            raise ValueError('Unfinished message dropped, it exceeded {} chars'.format(self.maxsize))
+
+        self.pending.append(data)
+
+    def reset(self):
+        self.pending = []
+        self.held = 0
+
+    def decode_messages(self, data):
+        messages = []
+        raw_decode = self.raw_decode
+        offset = 0
+        length = len(data)
+
+        while offset < length:
+            end = data.find(END_OF_MESSAGE_STR, offset)
+
+            if end == -1:
+                # Clients that do not end their last message with a newline
+                # still get it decoded, as long as it is a whole object
+                message = self.decode_complete(data, offset)
+
+                if message is None:
+                    self.hold(data[offset:])
+                else:
+                    messages.append(message)
+
+                break
+
+            start = WHITESPACE.match(data, offset, end).end()
+
+            if start < end:
+                message, stop = raw_decode(data, start)
 
+                if stop > end or WHITESPACE.match(data, stop, end).end() != end:
+                    raise ValueError('Extra data after message at {}'.format(stop))
 
-def is_length(value):
-    return isinstance(value, int) and value >= 0
+                messages.append(message)
+
+            offset = end + 1
+
+        return messages
+
+    def decode_complete(self, data, offset=0):
+        """ The message data holds from offset, or None when it is not a whole one """
+        end = len(data)
+
+        # only a frame ending in a closing brace can hold a whole object,
+        # checked without copying the frame
+        while end > offset and data[end - 1] in ' \t\r\n':
+            end -= 1
+
+        if end == offset or data[end - 1] != '}':
+            return None
+
+        try:
+            message, stop = self.raw_decode(data, WHITESPACE.match(data, offset).end())
+        except ValueError:
+            return None
+
+        return message if stop == end else None
+
+    def is_unfinished(self, data):
+        """ Whether data could still be the start of a message """
+        try:
+            self.raw_decode(data, WHITESPACE.match(data).end())
+        except ValueError as ex:
+            # a message cut short only fails at its end, or in a string it
+            # had not closed yet. Pythons before 3.5 don't tell where.
+            pos = getattr(ex, 'pos', None)
+            return pos is None or pos == len(data) or ex.msg.startswith('Unterminated string')
+
+        return False
+
+
+class MsgPackParser(Parser):
+    """
+    Encodes messages as MessagePack, which are sent as binary frames. A frame
+    may hold several messages packed back to back.
+    """
+
+    name = 'msgpack'
+
+    def encode(self, data):
+        if isinstance(data, OutgoingMessage):
+            return data.encode_msgpack()
+
+        return MsgPack.packb(data)
+
+    def decode(self, data):
+        return MsgPack.unpack_all(data)
+
+
+PARSERS = {
+    Parser.name: Parser(),
+    MsgPackParser.name: MsgPackParser(),
+}
 
-def is_non_empty_str(value):
-    return isinstance(value, str) and len(value) > 0
 
 
 class WebSocketServerRequestHandler(WebSocket):
     id = None
+    parser = None
+    stream_decoder = None
+    credits = None
+
+    def send(self, data, key=None):
+        history.record('out', self.id, data)
+        message = (self.parser or self.server.parser).encode(data)
+        self.sendPrepared(prepareMessage(message), key)
+
+    def decode(self, data):
+        """ Text frames go through the server's parser, binary frames are msgpack """
+        if isinstance(data, str):
+            if self.stream_decoder is None:
+                self.stream_decoder = self.server.parser.create_decoder(self.maxpayload)
+
+            return self.stream_decoder.decode(data)
 
-    def send(self, data):
-        message = self.server.parser.encode(data)
-        self.sendMessage(message)
+        return PARSERS[MsgPackParser.name].decode(data)
+
+    def create_reply(self, call):
+        """
+        Creates the reply function handed to listeners of an incoming call.
+
+        When the call grants credit, parts beyond it are held back until the
+        caller grants more. With block=True, reply waits for credit instead,
+        unless it is called on the server thread, which has to stay free to
+        read the caller's credit messages.
+        """
+        part = 0
+        is_done = False
+        gate = None
+        credit = call.get('credit')
+        template = None
+        received = time.perf_counter()
+
+        if credit is not None:
+            call_id = call['id']
+
+            def send_part(message):
+                self.send(message)
+
+                if message.done:
+                    self.credits.pop(call_id, None)
+
+            gate = ReplyCredit(credit, send_part)
+
+            if self.credits is None:
+                self.credits = {}
+
+            self.credits[call_id] = gate
+
+        # origin is accepted for compatibility, replies only ever carried
+        # the id of the server's own origin
+        def reply(data, done=False, origin=None, block=False):
+            nonlocal part, is_done, template
+
+            if is_done:
+                raise Exception('reply called after done')
+
+            # built on the first reply, so a call missing a field the reply
+            # needs still reaches its handler, and only replying fails
+            if template is None:
+                template = ReplyTemplate(call, ORIGIN)
+
+            is_done = done
+            message = Messages.reply(data, call, part, done, ORIGIN, template)
+            part += 1
+
+            if done:
+                self.server.metrics.handled(call['event'], time.perf_counter() - received)
+
+            if gate is None:
+                self.send(message)
+            else:
+                gate.submit(message, block and current_thread() is not self.server.loopthread)
+
+        return reply
 
     def handleMessage(self):
         # simplesocketserver swallows exceptions, so we just have to catch them all and print them out
         try:
             try:
-                messages = self.server.parser.decode(self.data)
+                messages = self.decode(self.data)
             except Exception as ex:
-                raise Exception('Could not not decode messages ' + str(self.data))
+                raise Exception('Could not not decode messages ' + str(summarize(self.data)))
 
             if not isinstance(messages, list):
                 raise Exception('parser.decode did not return a dict')
 
             for message in messages:
-                message_type = message.get('type')
-                message_id = message.get('id')
-                event = message.get('event')
-                origin = message.get('origin', {})
-                to = message.get('to')
-                payload = message.get('payload')
+                history.record('in', self.id, message)
+                route = lookup(self.routes, message)
 
-                if not Messages.is_valid(message):
-                    raise Exception('Message does not conform to api' + str(message))
+                if route is None or not route[0](message):
+                    raise Exception('Message does not conform to api ' + str(summarize(message)))
 
-                if message_type == Messages.CALL:
-                    logger.info('Received incoming call', message)
-                    origin = message
-                    part = 0
-                    is_done = False
+                route[1](self, message)
 
-                    def reply(data, done=False, origin=None):
-                        nonlocal part, is_done
+        except Exception as ex:
+            traceback.print_exc()
 
-                        send_origin = ORIGIN.copy()
+    def receive_call(self, message):
+        logger.debug('Received incoming call {}', message)
+        reply = self.create_reply(message)
+        builtin = self.builtins.get(message['event'])
 
-                        if isinstance(origin, dict) and 'id' in origin:
-                            send_origin['child'] = origin['id']
+        if builtin is not None:
+            builtin(self, message['payload'], reply)
+        else:
+            self.server.handle_call(message['event'], message['payload'], reply)
 
-                        if is_done:
-                            raise Exception('reply called after done')
+    def receive_reply(self, message):
+        logger.debug('Received incoming reply {}', message)
+        # Fire the reply callback for the specified id
+        call = self.server.pending.get(message['to']['id'])
 
-                        is_done = done
+        if self.server.pending.resolve(message) and call.credit is not None:
+            self.return_credit(call, message)
 
-                        self.send(Messages.reply(data, origin, part, done, send_origin))
+    def receive_credit(self, message):
+        gate = self.credits.get(message['to']['id']) if self.credits else None
 
-                        part += 1
+        if gate is not None:
+            gate.grant(message['credit'])
 
-                    # Emit for everyone listening to events on the server
-                    self.server.hub.emit(event, payload, reply)
+    def receive_handshake(self, message):
+        logger.info('Handshake received {}', message)
+        self.server.add_client(self, message)
 
-                elif message_type == Messages.REPLY:
-                    logger.info('Received incoming reply', message)
-                    # Fire the reply callback for the specified id
-                    self.server.api.emit('{0}:{1}'.format(Messages.REPLY, to['id']), message)
+    def receive_ping(self, message):
+        self.send(Messages.pong())
 
-                elif message_type == Messages.HANDSHAKE:
-                    # self.server.emit('handshake')
-                    logger.info('Handshake received', message)
-                    self.server.add_client(self, message)
-                elif message_type == Messages.PING:
-                    self.send(Messages.pong())
-                else:
-                    logger.info('Ya dun fucked up', message)
+    def receive_pong(self, message):
+        pass
+
+    def call_stats(self, payload, reply):
+        reply(self.server.stats(), True)
 
+    def call_profile(self, payload, reply):
+        """
+        Profiles the server with the options in the payload, replying with
+        the path of the file once it is written. {"stop": true} stops the
+        running profile instead.
+
+        Only the options in PROFILE_OPTIONS are taken, so where files are
+        written is up to the editor's own settings, and seconds and
+        interval_ms are clamped to PROFILE_LIMITS.
+        """
+        payload = payload if isinstance(payload, dict) else {}
+
+        if payload.get('stop', False):
+            reply({'path': self.server.stop_profile()}, True)
+            return
+
+        options = {key: payload[key] for key in PROFILE_OPTIONS if key in payload}
+        settings = self.server.profile_settings
+
+        for key, (low, high) in PROFILE_LIMITS.items():
+            value = options.get(key, settings.get(key))
+
+            if value is None:
+                value = high
+
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value != value:
+                reply({'error': '{} must be a number'.format(key)}, True)
+                return
+
+            options[key] = min(max(value, low), high)
+
+        try:
+            self.server.profile(on_done=lambda path: reply({'path': path}, True), **options)
         except Exception as ex:
-            traceback.print_exc()
+            reply({'error': str(ex)}, True)
+
+    # Each message type's validator and the method receiving it, looked up
+    # once per message
+    routes = {
+        Messages.CALL: (check_call, receive_call),
+        Messages.REPLY: (check_reply, receive_reply),
+        Messages.CREDIT: (check_credit, receive_credit),
+        Messages.HANDSHAKE: (check_handshake, receive_handshake),
+        Messages.PING: (check_type_only, receive_ping),
+        Messages.PONG: (check_type_only, receive_pong),
+    }
+
+    # Calls answered by the server instead of the hub's listeners
+    builtins = {
+        STATS_EVENT: call_stats,
+        PROFILE_EVENT: call_profile,
+    }
 
     def handleConnected(self):
         logger.info('Client connected')
 
+    def return_credit(self, call, message):
+        """
+        Grants credit back for the replies to one of our calls, half a window
+        at a time, so the client can keep streaming while parts are handled.
+        """
+        if message['done']:
+            call.consumed.pop(self.id, None)
+            return
+
+        consumed = call.consumed.get(self.id, 0) + 1
+
+        if consumed >= max(1, call.credit // 2):
+            self.send(Messages.credit(consumed, call.id, call.name, self.server.origin))
+            consumed = 0
+
+        call.consumed[self.id] = consumed
+
     def handleClose(self):
-        logger.info('Client<{}> closed'.format(client.id))
+        logger.info('Client<{}> closed', self.id)
+        history.note(self.id, 'close')
+        self.server.metrics.retire(self)
+
+        for gate in list((self.credits or {}).values()):
+            gate.close()
+
         self.server.remove_client(self)
 
+    def handleCongested(self):
+        logger.warning('Client<{}> send queue is over {} bytes', self.id, self.highwater)
+        history.note(self.id, 'congested')
+
+        if self.id is not None:
+            self.server.hub.emit('self:client:congested:{}'.format(self.id))
+            self.server.hub.emit('self:client:congested', self.id)
+
+    def handleDrained(self):
+        logger.info('Client<{}> send queue drained', self.id)
 
-class WebSocketServer(SimpleWebSocketServer, EventEmitter):
+        if self.id is not None:
+            self.server.hub.emit('self:client:drained:{}'.format(self.id))
+            self.server.hub.emit('self:client:drained', self.id)
+
+
+class WebSocketServerBase(EventEmitter):
+    """
+    The call/reply api on top of a websocket engine. Concrete servers mix this
+    with an engine class, which handles the sockets.
+
+    Attributes:
+        engine (class): The engine the server runs on
+    """
+
+    engine = None
 
     def __init__(self, *args, **kwargs):
 
         self.clients = []
-        self.parser = kwargs.get('parser', Parser())
-        self.api = EventEmitter()
-        self.origin = kwargs.get('origin', ORIGIN)
+        self.parser = kwargs.pop('parser', Parser())
+        self.pending = PendingCalls()
+        self.timers = TimerWheel()
+        self.metrics = ServerMetrics()
+        self.origin = kwargs.pop('origin', ORIGIN)
+        self.loop_calls = deque()
+
+        self.profile_settings = kwargs.pop('profile', None) or {}
+        self.profiler = None
+        self.profile_done = None
+        self.profile_timer = None
+        self.profile_lock = Lock()
         self.hub = server
 
+        handlers = kwargs.pop('handlers', None) or {}
+        self.inline_events = set(handlers.get('inline', ())) | self.hub.inline_events
+        self.executor = HandlerExecutor(
+            workers=handlers.get('workers', 4),
+            max_per_event=handlers.get('max_per_event'),
+            limits=handlers.get('limits'),
+            inline=self.inline_events,
+        )
+
+        processes = kwargs.pop('processes', None) or {}
+        self.processes = ProcessHandlers(
+            self.hub.process_handlers,
+            workers=processes.get('workers'),
+            max_tasks_per_child=processes.get('max_tasks_per_child'),
+            python=processes.get('python'),
+            warm_up=processes.get('warm_up'),
+        )
+
+        # Warm the workers up before the first call comes in
+        if self.hub.process_handlers:
+            self.processes.start()
+
         options = {
-            'wildcard': kwargs.get('wildcard', ':'),
+            'wildcard': kwargs.pop('wildcard', ':'),
         }
 
         EventEmitter.__init__(self, **options)
 
-        SimpleWebSocketServer.__init__(self, *args, **kwargs)
+        self.engine.__init__(self, *args, **kwargs)
+
+    def handleTick(self):
+        self.timers.advance()
+
+    def handleLoopTime(self, seconds):
+        self.metrics.loop.record(seconds)
+
+    def serveforever(self):
+        try:
+            self.engine.serveforever(self)
+        finally:
+            # Whatever was handed to the loop as it stopped, like the end
+            # of a profile
+            self._run_loop_calls()
+
+    def run_on_loop(self, fn):
+        """
+        Runs fn on the server thread, right away when called from it.
+
+        Otherwise asyncio gets it through call_soon_threadsafe. Anything else
+        waits in loop_calls, and handleTick is swapped for the method running
+        them only while some are waiting, so the loop pays nothing for this
+        the rest of the time.
+        """
+        if current_thread() is self.loopthread:
+            fn()
+        elif self.engine is AsyncioWebSocketServer and self.loop is not None:
+            self.loop.call_soon_threadsafe(fn)
+        else:
+            self.loop_calls.append(fn)
+            self.handleTick = self._run_loop_calls
+
+            if self.engine is not AsyncioWebSocketServer:
+                self._wakeup()
+
+    def _run_loop_calls(self):
+        # Back to the class's handleTick before running anything, so calls
+        # added meanwhile swap this in again
+        self.__dict__.pop('handleTick', None)
+
+        while self.loop_calls:
+            try:
+                self.loop_calls.popleft()()
+            except Exception:
+                traceback.print_exc()
+
+        self.handleTick()
+
+    def profile(self, on_done=None, **options):
+        """
+        Profiles the server thread while it keeps serving, and writes the
+        result to a new file once seconds have passed, or stop_profile() is
+        called when seconds is None. Options left out are taken from the
+        "profile" setting.
+
+        Args:
+            mode (str): "sample" counts the stacks of the sampled threads
+                every interval_ms and writes them as collapsed stacks, for
+                flame graph tools. "cprofile" runs cProfile on the server
+                thread and writes pstats.
+            seconds (float): How long to profile for
+            interval_ms (float): Time between samples
+            threads (str): "server" samples the server thread, "all" every
+                thread, including the handler workers
+            directory (str): Where the file is written, None for the temp dir
+            on_done (callable): Called with the path once the file is written
+
+        Returns:
+            str: The path the file will be written to
+        """
+        settings = dict(self.profile_settings, **options)
+        mode = settings.get('mode', 'sample')
+
+        if mode not in PROFILERS:
+            raise ValueError('Unknown profile mode "{}"'.format(mode))
+
+        with self.profile_lock:
+            if self.profiler is not None:
+                raise Exception('The server is already being profiled')
+
+            path = output_path(settings.get('directory'), PROFILERS[mode].extension)
+
+            if mode == 'sample':
+                threads = self.sampled_threads(settings.get('threads', 'server'))
+                profiler = StackSampler(path, threads, settings.get('interval_ms', 5) / 1000)
+            else:
+                profiler = LoopProfile(path)
+
+            self.profiler = profiler
+            self.profile_done = on_done
+
+            seconds = settings.get('seconds')
+
+            if seconds is not None:
+                self.profile_timer = self.timers.schedule(seconds, lambda: self.stop_profile(profiler))
+
+        if profiler.on_loop:
+            self.run_on_loop(profiler.start)
+        else:
+            profiler.start()
+
+        logger.info('Profiling the server with {} into {}', mode, path)
+
+        return path
+
+    def sampled_threads(self, threads):
+        if threads == 'all':
+            # called on the sampling thread, which leaves itself out
+            return lambda: {
+                thread.ident: thread.name for thread in all_threads() if thread is not current_thread()
+            }
+
+        return lambda: {self.loopthread.ident: 'server'} if self.loopthread is not None else {}
+
+    def stop_profile(self, profiler=None):
+        """
+        Stops profiling and writes the file, unless profiler is given and is
+        no longer the one running.
+
+        Returns:
+            str: The path of the file, or None if nothing was stopped
+        """
+        with self.profile_lock:
+            if self.profiler is None or profiler not in (None, self.profiler):
+                return None
+
+            profiler = self.profiler
+            on_done = self.profile_done
+            self.profiler = self.profile_done = None
+
+            if self.profile_timer is not None:
+                self.profile_timer.cancel()
+                self.profile_timer = None
+
+        def finish():
+            profiler.stop()
+            profiler.dump()
+            logger.info('Profile written to {}', profiler.path)
+
+            if callable(on_done):
+                on_done(profiler.path)
+
+        if profiler.on_loop:
+            self.run_on_loop(finish)
+        else:
+            finish()
+
+        return profiler.path
+
+    def _selectTimeout(self):
+        # Wake up often enough to fire call timeouts on time
+        if len(self.timers):
+            return min(self.selectInterval, self.timers.resolution)
+
+        return self.selectInterval
+
+    def handle_call(self, event, payload, reply):
+        """ Runs the handlers of an incoming call """
+        try:
+            if event in self.processes:
+                self.processes.submit(event, payload, reply)
+            else:
+                # Emit for everyone listening to events on the server, from a
+                # worker so the connection keeps being read
+                self.executor.submit(event, self.hub.emit, event, payload, reply)
+        except Exception as ex:
+            # The pools have been shut down, or the payload can't be
+            # handed to a process. Answer now rather than at the caller's
+            # timeout.
+            traceback.print_exc()
+            reply({'error': 'handler for "{}" was not run: {}'.format(event, ex)}, True)
 
     def add_client(self, client, message):
         origin = message['origin']
@@ -326,15 +863,30 @@ class WebSocketServer(SimpleWebSocketServer, EventEmitter):
         for existing_client in self.clients:
             if existing_client.id == origin['id']:
                 client.close()
-                logger.error('Client with id "{}" already exists'.format(client.id))
+                logger.error('Client with id "{}" already exists', client.id)
                 return
 
         client.id = origin['id']
-        client.send(Messages.handshake_accept(None, message, self.origin))
+
+        payload = message.get('payload')
+        codec = payload.get('codec') if isinstance(payload, dict) else None
+
+        if codec is None:
+            client.send(Messages.handshake_accept(None, message, self.origin))
+        else:
+            if codec not in PARSERS:
+                logger.warning('Client "{}" asked for unknown codec "{}"', client.id, codec)
+                codec = self.parser.name
+
+            # The accept itself still goes out with the default parser
+            client.send(Messages.handshake_accept({ 'codec': codec }, message, self.origin))
+            client.parser = PARSERS[codec]
+
         self.clients.append(client)
         self.hub.emit('self:client:accept:{}'.format(client.id))
         self.hub.emit('self:client:accept', client.id)
-        logger.info('Accepting client {}'.format(client.id))
+        logger.info('Accepting client {}', client.id)
+        history.note(client.id, 'accept')
 
     def remove_client(self, client):
         if client in self.clients:
@@ -342,14 +894,30 @@ class WebSocketServer(SimpleWebSocketServer, EventEmitter):
             self.hub.emit('self:client:close:{}'.format(client.id))
             self.hub.emit('self:client:close', client.id)
 
-    def send_all(self, data):
-        for client in self.clients:
-            client.send(data)
+    def send_all(self, data, key=None):
+        """
+        Sends data to every client. The data is encoded and framed once per
+        codec in use and the same frame bytes are queued for each client.
+
+        Args:
+            key (str): Messages with the same key replace each other in a
+                congested send queue under the coalesce policy
+        """
+        prepared = {}
+        history.record('out', '*', data)
 
-    def send_to(self, data, origin):
-        for client in self.clients:
-            if origin == self.id:
-                client.send(data)
+        for client in list(self.clients):
+            parser = client.parser or self.parser
+
+            if parser not in prepared:
+                prepared[parser] = prepareMessage(parser.encode(data))
+
+            client.sendPrepared(prepared[parser], key)
+
+    def send_to(self, data, origin, key=None):
+        for client in list(self.clients):
+            if client.id == origin:
+                client.send(data, key)
 
     def call(
             self,
@@ -360,8 +928,21 @@ class WebSocketServer(SimpleWebSocketServer, EventEmitter):
             reply_timeout=2000,
             done_timeout=2000,
             origin=None,
+            on_timeout=None,
+            credit=None,
         ):
-        """ Sends out a call to all listeners """
+        """
+        Sends out a call to all listeners
+
+        Args:
+            credit (int): The number of reply parts the client may send ahead
+                of the ones handled so far. More is granted as replies come in.
+                Only calls to a single client, named by origin, take credit,
+                since a call is done with the first done reply
+
+        Returns:
+            str: The id of the call, or False if the server is not running
+        """
 
         if websocket_server is None:
             return False
@@ -371,45 +952,176 @@ class WebSocketServer(SimpleWebSocketServer, EventEmitter):
         if isinstance(origin, dict) and 'id' in origin:
             send_origin['child'] = origin['id']
 
-        call = Messages.call(name, payload, send_origin)
-        api_event_name = '{0}:{1}'.format(Messages.REPLY, call['id'])
-        off = lambda: self.api.off(api_event_name, on_reply)
-        parts = []
+        if credit is not None and not (isinstance(credit, int) and credit > 0):
+            raise ValueError('credit must be a positive int')
 
-        def on_reply_from_call(message):
-            part, done, payload = pluck(message, 'part', 'done', 'payload')
+        # the first client to finish would end the call, and the others
+        # would never be granted credit again
+        if credit is not None and not isinstance(origin, str):
+            raise ValueError('credit needs origin to name a single client')
 
-            parts.append(payload)
-            reply_timer.cancel()
+        call = Messages.call(name, payload, send_origin, credit)
+        call_id = call.id
+        pending = self.pending.add(call_id, name, on_reply, on_done, credit)
 
-            if done:
-                done_timer.cancel()
-                off()
+        def on_call_timeout(stage):
+            if self.pending.remove(call_id) is not None:
+                self.metrics.timed_out(stage)
+                history.note(origin if isinstance(origin, str) else '*',
+                             'timeout of {} {} until {}'.format(name, call_id, stage))
 
-                if callable(on_done):
-                    on_done(payload, parts, part)
-            else:
-                # maybe asyncio will make this more consistent with the nodejs api
-                if callable(on_reply):
-                    on_reply(payload, part)
+                if callable(on_timeout):
+                    on_timeout(CallTimeoutError(name, call_id, stage))
+                else:
+                    logger.error('timeout until {} timeout has been exceeded', stage)
 
-        self.api.on(api_event_name, on_reply_from_call)
+        pending.reply_timer = self.timers.schedule(reply_timeout / 1000, lambda: on_call_timeout('first reply'))
+        pending.done_timer = self.timers.schedule(done_timeout / 1000, lambda: on_call_timeout('done'))
 
+        # A newer call to a congested client supersedes one for the same event
         if isinstance(origin, str):
-            self.send_to(call, origin)
+            self.send_to(call, origin, key=name)
         else:
-            self.send_all(call)
+            self.send_all(call, key=name)
+
+        return call_id
+
+    def call_future(self, name, payload=None, **kwargs):
+        """
+        Like call, but returns a concurrent.futures.Future. It resolves to a
+        CallResult once the done reply comes in, or fails with
+        CallTimeoutError. on_done and on_timeout, when given, are still
+        called, before the future is resolved.
+        """
+        future = Future()
+        user_on_done = kwargs.pop('on_done', None)
+        user_on_timeout = kwargs.pop('on_timeout', None)
+
+        def on_done(payload, parts, part):
+            try:
+                if callable(user_on_done):
+                    user_on_done(payload, parts, part)
+            finally:
+                if not future.done():
+                    future.set_result(CallResult(payload, parts))
+
+        def on_timeout(error):
+            try:
+                if callable(user_on_timeout):
+                    user_on_timeout(error)
+            finally:
+                if not future.done():
+                    future.set_exception(error)
+
+        kwargs['on_timeout'] = on_timeout
+
+        if self.call(name, payload, on_done=on_done, **kwargs) is False:
+            future.set_exception(Exception('server is not running'))
+
+        return future
+
+    def call_async(self, name, payload=None, **kwargs):
+        """
+        Like call_future, but returns an asyncio future for coroutines running
+        on the server's event loop. Only available on the asyncio engine.
+        """
+        if self.engine is not AsyncioWebSocketServer:
+            raise Exception('call_async requires the asyncio engine')
+
+        return asyncio.wrap_future(self.call_future(name, payload, **kwargs), loop=self.loop)
+
+    def gather(self, name, payload=None, return_exceptions=False, **kwargs):
+        """
+        Calls every connected client separately.
+
+        Returns:
+            Future: Resolves to a dict of CallResult keyed by client id. With
+                return_exceptions, clients that timed out map to their
+                CallTimeoutError instead of failing the whole gather.
+        """
+        kwargs.pop('origin', None)
+
+        futures = {
+            client.id: self.call_future(name, payload, origin=client.id, **kwargs)
+            for client in list(self.clients)
+        }
+
+        return gather_futures(futures, return_exceptions)
+
+    @property
+    def in_flight(self):
+        """ The number of calls still waiting on their last reply """
+        return len(self.pending)
+
+    def queue_depths(self):
+        """
+        Returns:
+            dict: The frames and bytes waiting in each client's send queue,
+                how many messages were dropped from it and whether it is
+                congested, keyed by client id
+        """
+        return {
+            client.id: {
+                'frames': len(client.sendq),
+                'bytes': client.sendqbytes,
+                'dropped': client.sendqdropped,
+                'congested': client.congested,
+            }
+            for client in list(self.clients)
+        }
+
+    def stats(self):
+        """
+        Returns:
+            dict: Traffic, send queues and calls in flight, how long handlers
+                take to reply to each event and the serving thread takes per
+                pass, and the number of calls that timed out. Durations are
+                in milliseconds.
+        """
+        stats = self.metrics.snapshot()
+        stats['traffic'] = self.metrics.traffic(list(self.connections.values()))
+        stats['in_flight'] = self.in_flight
+        stats['executor'] = self.executor.pending()
+        stats['clients'] = clients = {}
+
+        for client_id, sendq in self.queue_depths().items():
+            clients[client_id] = {'sendq': sendq}
+
+        for client in list(self.clients):
+            if client.id in clients:
+                clients[client.id].update(connection_traffic(client))
+
+        return stats
+
+
+class WebSocketServer(WebSocketServerBase, SimpleWebSocketServer):
+    """ Runs on a select/epoll loop in its own thread """
+
+    engine = SimpleWebSocketServer
 
-        def on_timeout(name):
-            off()
-            # raise Exception('timeout until {name} timeout has been exceeded'.format(name=name))
-            logger.error('timeout until {name} timeout has been exceeded'.format(name=name))
 
-        reply_timer = Timer(reply_timeout / 1000, lambda: on_timeout('first reply'))
-        reply_timer.start()
+class AsyncioServer(WebSocketServerBase, AsyncioWebSocketServer):
+    """ Runs on an asyncio event loop in its own thread """
 
-        done_timer = Timer(done_timeout / 1000, lambda: on_timeout('done'))
-        done_timer.start()
+    engine = AsyncioWebSocketServer
+
+
+ENGINES = {
+    'select': WebSocketServer,
+    'asyncio': AsyncioServer,
+}
+
+
+def get_server_class(engine):
+    if engine == 'asyncio' and asyncio is None:
+        logger.warning('asyncio is not available, falling back to the select engine')
+        engine = 'select'
+
+    if engine not in ENGINES:
+        logger.warning('Unknown engine "{}", falling back to the select engine', engine)
+        engine = 'select'
+
+    return ENGINES[engine]
 
 
 class Hub(EventEmitter):
@@ -419,8 +1131,15 @@ class Hub(EventEmitter):
 
     Attributes:
         is_listening (bool): Whether or not the server has been bound to a port
+        inline_events (set): Events whose handlers run on the server thread
+        process_handlers (dict): Handlers run in worker processes, by event
     """
 
+    def __init__(self, *args, **kwargs):
+        EventEmitter.__init__(self, *args, **kwargs)
+        self.inline_events = set()
+        self.process_handlers = {}
+
     @property
     def is_listening(self):
         return websocket_server_thread is not None and websocket_server_thread.is_alive()
@@ -435,7 +1154,16 @@ class Hub(EventEmitter):
         clean_up()
 
     def call(self, *args, **kwargs):
-        websocket_server.call(*args, **kwargs)
+        return websocket_server.call(*args, **kwargs)
+
+    def call_future(self, *args, **kwargs):
+        return websocket_server.call_future(*args, **kwargs)
+
+    def call_async(self, *args, **kwargs):
+        return websocket_server.call_async(*args, **kwargs)
+
+    def gather(self, *args, **kwargs):
+        return websocket_server.gather(*args, **kwargs)
 
     def send_all(self, *args, **kwargs):
         websocket_server.send_all(*args, **kwargs)
@@ -443,6 +1171,90 @@ class Hub(EventEmitter):
     def send_to(self, *args, **kwargs):
         websocket_server.send_to(*args, **kwargs)
 
+    @property
+    def in_flight(self):
+        """ The number of outgoing calls still waiting on their last reply """
+        return websocket_server.in_flight if websocket_server is not None else 0
+
+    def process(self, event, handler=None):
+        """
+        Registers the handler of an event as "process", so its calls run in
+        the pool of worker processes instead of a thread. The handler must be
+        a module level function taking (payload, reply). Its return value is
+        sent as the done reply unless it replied with done itself, and if it
+        raises, the call is done with an {"error": message} reply.
+
+        Can be used as a decorator.
+        """
+        if handler is None:
+            def decorator(handler):
+                self.process(event, handler)
+                return handler
+
+            return decorator
+
+        self.process_handlers[event] = handler
+
+        if websocket_server is not None:
+            websocket_server.processes.start()
+
+    def off_process(self, event):
+        self.process_handlers.pop(event, None)
+
+    def run_on_main(self, fn, *args, **kwargs):
+        """
+        Runs fn(*args) on the main thread, batched with other work handed
+        over from handlers. Pass key= to replace pending work with the same
+        key, so only the latest of several updates to a view runs.
+        """
+        main_thread.run(fn, *args, **kwargs)
+
+    def inline(self, event, inline=True):
+        """
+        Marks the handlers of an event as cheap enough to run on the server
+        thread instead of being handed to a worker.
+        """
+        for events in (self.inline_events, getattr(websocket_server, 'inline_events', None)):
+            if events is None:
+                continue
+
+            if inline:
+                events.add(event)
+            else:
+                events.discard(event)
+
+    def queue_depths(self):
+        return websocket_server.queue_depths() if websocket_server is not None else {}
+
+    def stats(self):
+        """ What the server has been doing since it started, see WebSocketServerBase.stats """
+        return websocket_server.stats() if websocket_server is not None else {}
+
+    def profile(self, on_done=None, **options):
+        """
+        Profiles the server thread, see WebSocketServerBase.profile. Returns
+        None if the server is not running.
+        """
+        if websocket_server is None:
+            return None
+
+        return websocket_server.profile(on_done, **options)
+
+    def stop_profile(self):
+        return websocket_server.stop_profile() if websocket_server is not None else None
+
+    def protocol_history(self):
+        """
+        Returns:
+            list: The latest messages in and out and client events, one line
+                each, oldest first
+        """
+        return history.lines()
+
+    def dump_protocol_history(self, path=None):
+        """ Writes protocol_history() to path, or a new file in the temp dir, and returns the path """
+        return history.dump(path)
+
 
 
 
@@ -456,12 +1268,25 @@ def start_server():
         return False
 
     server.emit('self:pre-start')
-    websocket_server = WebSocketServer(HOST, user_settings.get('port'), WebSocketServerRequestHandler)
+    server_class = get_server_class(user_settings.get('engine', 'select'))
+    websocket_server = server_class(
+        HOST,
+        user_settings.get('port'),
+        WebSocketServerRequestHandler,
+        deflate=user_settings.get('permessage_deflate'),
+        sendq=user_settings.get('send_queue'),
+        handlers=user_settings.get('handlers'),
+        processes=user_settings.get('processes'),
+        profile=user_settings.get('profile'),
+    )
     websocket_server_thread = Thread(target=websocket_server.serveforever, daemon=True)
     websocket_server_thread.start()
+
+    if websocket_server.profile_settings.get('enabled'):
+        websocket_server.profile()
     server.emit('self:start')
 
-    logger.info('server started on port {0}'.format(port))
+    logger.info('server started on port {}', port)
 
     return True
 
@@ -480,7 +1305,11 @@ def stop_server():
         return False
 
     server.emit('self:pre-stop')
+    # Queued ahead of the close, so a cProfile is still written
+    websocket_server.stop_profile()
     websocket_server.close()
+    websocket_server.executor.shutdown()
+    websocket_server.processes.shutdown()
     websocket_server_thread = None
     server.emit('self:stop')
     logger.info('Editor Connect server stopped')
@@ -491,9 +1320,12 @@ def clean_up():
     if websocket_server is not None:
         server.emit('self:pre-clean-up')
         websocket_server.off_all()
-        websocket_server.api.off_all()
+        websocket_server.pending.clear()
+        websocket_server.timers.clear()
         server.emit('self:clean-up')
 
+    main_thread.clear()
+
 
 class StartServerCommand(sublime_plugin.ApplicationCommand):
     """ Start the server if it isn't running """
@@ -504,6 +1336,13 @@ class StartServerCommand(sublime_plugin.ApplicationCommand):
         return not server.is_listening
 
 
+class DumpProtocolHistoryCommand(sublime_plugin.ApplicationCommand):
+    """ Write the latest protocol events to a file and open it """
+    def run(self):
+        path = history.dump()
+        sublime.active_window().open_file(path)
+
+
 # Server events and incoming calls will be emitted through this mock server
 server = Hub()
 
@@ -512,6 +1351,11 @@ def plugin_loaded():
     global user_settings, port
     user_settings = Settings(SETTINGS_PATH)
     port = user_settings.get('port')
+    main_thread.budget = user_settings.get('main_thread_budget_ms', 8) / 1000
+
+    # Every incoming call and reply is logged in dev, summarized
+    logger.level = DEBUG if user_settings.get('dev') else INFO
+    history.resize(user_settings.get('protocol_history', 500))
 
     # Setting a timeout will ensure the port is clear for reuse
     sublime.set_timeout(start_server, SERVER_START_DELAY)
@@ -0,0 +1,248 @@
+'''
+asyncio engine for the WebSocket handlers of SimpleWebSocketServer.
+
+AsyncioWebSocketServer can be used in place of SimpleWebSocketServer. Handler
+classes, the handshake and the framing are shared; only the way bytes are
+read from and written to the sockets differs.
+'''
+import socket
+import threading
+import time
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from .SimpleWebSocketServer import CLOSE
+
+__all__ = ['AsyncioWebSocketServer']
+
+_clock = time.perf_counter
+
+
+class WebSocketProtocol(object):
+   """
+       asyncio protocol feeding a single connection into a WebSocket handler.
+   """
+
+   def __init__(self, server):
+      self.server = server
+      self.transport = None
+      self.websocket = None
+
+   def connection_made(self, transport):
+      self.transport = transport
+      address = transport.get_extra_info('peername')
+      self.websocket = self.server._constructWebSocket(transport, address)
+      self.server.connections[id(self.websocket)] = self.websocket
+
+   def data_received(self, data):
+      start = _clock()
+
+      try:
+         self.websocket._feedData(data)
+      except Exception as n:
+         self.transport.abort()
+
+      self.server.handleLoopTime(_clock() - start)
+
+   def eof_received(self):
+      return False
+
+   def connection_lost(self, exc):
+      self.server._dropClient(self.websocket)
+
+   def pause_writing(self):
+      # leave frames in the sendq, where its limits apply, rather than
+      # letting the transport buffer them
+      self.server.paused.add(self.websocket)
+
+   def resume_writing(self):
+      self.server.paused.discard(self.websocket)
+      self.server._notifyWrite(self.websocket)
+
+
+class AsyncioWebSocketServer(object):
+   def __init__(self, host, port, websocketclass, selectInterval = 0.1, deflate = None, sendq = None):
+      if asyncio is None:
+         raise Exception('asyncio is not available')
+
+      self.websocketclass = websocketclass
+      self.deflate = deflate
+      self.sendqlimits = sendq
+      self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      self.serversocket.bind((host, port))
+      self.serversocket.listen(5)
+      self.selectInterval = selectInterval
+      self.connections = {}
+      self.closed = False
+
+      self.loop = None
+      self.loopthread = None
+      self.server = None
+      self.flushpending = set()
+      self.paused = set()
+
+   def _constructWebSocket(self, transport, address):
+      return self.websocketclass(self, transport, address)
+
+   def handleTick(self):
+      """
+          Called on the loop every _selectTimeout() seconds.
+      """
+      pass
+
+   def handleLoopTime(self, seconds):
+      """
+          Called on the loop with the time spent on one read, flush or
+          tick callback. The loop has no passes of its own to time.
+      """
+      pass
+
+   def _selectTimeout(self):
+      return self.selectInterval
+
+   def _tick(self):
+      start = _clock()
+
+      try:
+         self.handleTick()
+         self.handleLoopTime(_clock() - start)
+      finally:
+         self.loop.call_later(self._selectTimeout() or 0.1, self._tick)
+
+   def _dropClient(self, client):
+      if self.connections.pop(id(client), None) is None:
+         return
+
+      self.flushpending.discard(client)
+      self.paused.discard(client)
+      client._abortSendq()
+
+      # only call handleClose when we have a successful websocket connection
+      if client.handshaked:
+         try:
+            client.handleClose()
+         except:
+            pass
+
+   def _notifyWrite(self, client):
+      if self.loop is None or client in self.flushpending:
+         return
+
+      self.flushpending.add(client)
+
+      if threading.current_thread() is self.loopthread:
+         self.loop.call_soon(self._flush, client)
+      else:
+         self.loop.call_soon_threadsafe(self._flush, client)
+
+   def _flush(self, client):
+      """
+          Hand everything in the client's sendq to its transport, which
+          buffers whatever the socket does not accept right away. Small
+          frames are joined so they reach the socket in a single write.
+          Nothing is written while the transport has paused writing.
+      """
+      start = _clock()
+
+      try:
+         self._write(client)
+      finally:
+         self.handleLoopTime(_clock() - start)
+
+   def _write(self, client):
+      self.flushpending.discard(client)
+      transport = client.client
+
+      if transport.is_closing():
+         client._abortSendq()
+         return
+
+      if client in self.paused:
+         return
+
+      pending = []
+      pendingsize = 0
+      opcode = None
+      relieved = False
+
+      with client.sendqlock:
+         while client.sendq:
+            # writing may have filled the transport's own buffer
+            if client in self.paused:
+               break
+
+            opcode, header, payload, key = client.sendq.popleft()
+            size = len(header) + len(payload)
+            relieved = client._sendqConsumed(size) or relieved
+
+            if pending and pendingsize + size > client.coalescelimit:
+               transport.write(b''.join(pending))
+               pending = []
+               pendingsize = 0
+
+            if size > client.coalescelimit:
+               transport.write(header)
+               transport.write(payload)
+            else:
+               pending.append(header)
+               pending.append(payload)
+               pendingsize += size
+
+            if opcode == CLOSE:
+               break
+
+         if pending:
+            transport.write(b''.join(pending))
+
+      if opcode == CLOSE:
+         client._abortSendq()
+         transport.close()
+      elif relieved:
+         client.handleDrained()
+
+   def _shutdown(self):
+      if self.server is not None:
+         self.server.close()
+
+      for conn in list(self.connections.values()):
+         conn.close()
+         conn.client.close()
+
+      self.loop.call_soon(self.loop.stop)
+
+   def close(self):
+      self.closed = True
+
+      if self.loop is None:
+         self.serversocket.close()
+         return
+
+      try:
+         self.loop.call_soon_threadsafe(self._shutdown)
+      except RuntimeError:
+         # the loop has already been closed
+         pass
+
+   def serveforever(self):
+      self.loopthread = threading.current_thread()
+      self.loop = loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(loop)
+
+      try:
+         if self.closed:
+            return
+
+         self.server = loop.run_until_complete(
+            loop.create_server(lambda: WebSocketProtocol(self), sock=self.serversocket))
+         loop.call_soon(self._tick)
+         loop.run_forever()
+      finally:
+         if self.server is not None:
+            self.server.close()
+            loop.run_until_complete(self.server.wait_closed())
+         loop.close()
+         self.serversocket.close()
@@ -20,12 +20,23 @@ import struct
 import ssl
 import errno
 import codecs
+import threading
+import time
+import zlib
 from collections import deque
 from select import select
 
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+_clock = getattr(time, 'perf_counter', time.time)
+
 __all__ = ['WebSocket',
             'SimpleWebSocketServer',
-            'SimpleSSLWebSocketServer']
+            'SimpleSSLWebSocketServer',
+            'prepareMessage']
 
 def _check_unicode(val):
     if VER >= 3:
@@ -50,9 +61,12 @@ HANDSHAKE_STR = (
    "HTTP/1.1 101 Switching Protocols\r\n"
    "Upgrade: WebSocket\r\n"
    "Connection: Upgrade\r\n"
-   "Sec-WebSocket-Accept: %(acceptstr)s\r\n\r\n"
+   "Sec-WebSocket-Accept: %(acceptstr)s\r\n"
+   "%(extensions)s\r\n"
 )
 
+EXTENSIONS_STR = "Sec-WebSocket-Extensions: %s\r\n"
+
 GUID_STR = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
 
 STREAM = 0x0
@@ -62,16 +76,224 @@ CLOSE = 0x8
 PING = 0x9
 PONG = 0xA
 
-HEADERB1 = 1
-HEADERB2 = 3
-LENGTHSHORT = 4
-LENGTHLONG = 5
-MASK = 6
-PAYLOAD = 7
-
 MAXHEADER = 65536
 MAXPAYLOAD = 33554432
 
+# frames are coalesced into a single write up to this many bytes
+MAXCOALESCE = 65536
+MAXIOV = 512
+
+# what happens to a data message queued for a client whose sendq is over its
+# high water mark, see WebSocket.setSendqLimits()
+SENDQ_BLOCK = 'block'
+SENDQ_DROP_OLDEST = 'drop-oldest'
+SENDQ_COALESCE = 'coalesce'
+SENDQ_DISCONNECT = 'disconnect'
+SENDQ_POLICIES = (SENDQ_BLOCK, SENDQ_DROP_OLDEST, SENDQ_COALESCE, SENDQ_DISCONNECT)
+
+DEFLATE_TAIL = b'\x00\x00\xff\xff'
+
+# defaults for permessage-deflate, which is negotiated when the server is given
+# a deflate options dict; any of these can be overridden through it
+DEFLATE_OPTIONS = {
+   'enabled': True,
+   # start every outgoing message with an empty compression context
+   'server_no_context_takeover': False,
+   # ask clients to do the same, which lets us drop the inflate context
+   'client_no_context_takeover': False,
+   'server_max_window_bits': 15,
+   'client_max_window_bits': 15,
+   # messages smaller than this many bytes are sent uncompressed
+   'min_size': 1024,
+   'level': zlib.Z_DEFAULT_COMPRESSION,
+}
+
+def _headerValues(headers, name):
+   if VER >= 3:
+      return ', '.join(headers.get_all(name) or [])
+   return headers.get(name) or ''
+
+def _parseExtensions(value):
+   """
+       Parse a Sec-WebSocket-Extensions header into a list of
+       (name, {param: value}) offers. Parameters without a value map to None.
+   """
+   offers = []
+
+   for offer in value.split(','):
+      parts = [part.strip() for part in offer.split(';')]
+      if not parts[0]:
+         continue
+
+      params = {}
+      for param in parts[1:]:
+         if not param:
+            continue
+         key, sep, val = param.partition('=')
+         key = key.strip()
+         if key in params:
+            raise Exception('duplicate extension parameter %s' % key)
+         params[key] = val.strip().strip('"') if sep else None
+
+      offers.append((parts[0], params))
+
+   return offers
+
+class PerMessageDeflate(object):
+   """
+       Compression state for one connection that negotiated
+       permessage-deflate (RFC 7692). The zlib contexts are kept across
+       messages unless context takeover was turned off for that direction.
+   """
+
+   def __init__(self, options, servernotakeover, clientnotakeover, serverbits, clientbits):
+      self.minsize = options['min_size']
+      self.level = options['level']
+      self.servernotakeover = servernotakeover
+      self.clientnotakeover = clientnotakeover
+      self.serverbits = serverbits
+      self.clientbits = clientbits
+      self.compressor = None
+      self.decompressor = None
+
+   @classmethod
+   def negotiate(cls, header, options):
+      """
+          Pick the first acceptable permessage-deflate offer from the
+          client's Sec-WebSocket-Extensions header.
+
+          Returns (PerMessageDeflate, response) or (None, None).
+      """
+      if options is None or not header:
+         return None, None
+
+      config = dict(DEFLATE_OPTIONS)
+      config.update(options)
+
+      if not config['enabled']:
+         return None, None
+
+      for name, params in _parseExtensions(header):
+         if name != 'permessage-deflate':
+            continue
+
+         if not set(params) <= set(['server_no_context_takeover', 'client_no_context_takeover',
+                                    'server_max_window_bits', 'client_max_window_bits']):
+            continue
+
+         response = ['permessage-deflate']
+
+         servernotakeover = config['server_no_context_takeover'] or 'server_no_context_takeover' in params
+         if servernotakeover:
+            response.append('server_no_context_takeover')
+
+         clientnotakeover = config['client_no_context_takeover']
+         if clientnotakeover:
+            response.append('client_no_context_takeover')
+
+         try:
+            serverbits = config['server_max_window_bits']
+            if 'server_max_window_bits' in params:
+               serverbits = min(serverbits, int(params['server_max_window_bits']))
+               response.append('server_max_window_bits=%d' % serverbits)
+
+            clientbits = 15
+            if 'client_max_window_bits' in params:
+               offered = params['client_max_window_bits']
+               clientbits = min(config['client_max_window_bits'], int(offered) if offered else 15)
+               if clientbits < 15 or offered:
+                  response.append('client_max_window_bits=%d' % clientbits)
+         except ValueError:
+            continue
+
+         # zlib cannot produce a raw deflate stream with an 8 bit window
+         if not 9 <= serverbits <= 15 or not 8 <= clientbits <= 15:
+            continue
+
+         deflate = cls(config, servernotakeover, clientnotakeover, serverbits, clientbits)
+         return deflate, '; '.join(response)
+
+      return None, None
+
+   def compress(self, data):
+      if self.compressor is None or self.servernotakeover:
+         self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.serverbits)
+
+      data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+      if data.endswith(DEFLATE_TAIL):
+         data = data[:-4]
+      return data
+
+   def decompress(self, data, maxsize):
+      if self.decompressor is None or self.clientnotakeover:
+         # a full window inflates anything the client may have produced
+         self.decompressor = zlib.decompressobj(-max(self.clientbits, 9))
+
+      result = self.decompressor.decompress(bytes(data) + DEFLATE_TAIL, maxsize)
+      if self.decompressor.unconsumed_tail:
+         raise Exception('payload exceeded allowable size')
+      return bytearray(result)
+
+def _frameHeader(fin, opcode, length, compressed = False):
+   header = bytearray()
+
+   b1 = 0
+   b2 = 0
+   if fin is False:
+      b1 |= 0x80
+   if compressed:
+      b1 |= 0x40
+   b1 |= opcode
+
+   header.append(b1)
+
+   if length <= 125:
+      b2 |= length
+      header.append(b2)
+
+   elif length >= 126 and length <= 65535:
+      b2 |= 126
+      header.append(b2)
+      header.extend(struct.pack("!H", length))
+
+   else:
+      b2 |= 127
+      header.append(b2)
+      header.extend(struct.pack("!Q", length))
+
+   return bytes(header)
+
+def prepareMessage(data):
+   """
+       Frame a complete message once so it can be queued for many clients.
+
+       If data is a unicode object then the frame is sent as Text.
+       If the data is a bytearray object then the frame is sent as Binary.
+   """
+   opcode = BINARY
+   if _check_unicode(data):
+      opcode = TEXT
+      data = data.encode('utf-8')
+
+   return (opcode, _frameHeader(False, opcode, len(data)), data)
+
+def _unmask(data, mask):
+   """
+       XOR the whole payload against the repeated 4 byte mask at once by
+       treating both as one wide integer, rather than one byte at a time.
+   """
+   length = len(data)
+
+   if length == 0:
+      return bytearray()
+
+   if VER < 3:
+      return bytearray(b ^ mask[i % 4] for i, b in enumerate(data))
+
+   key = (bytes(mask) * (length // 4 + 1))[:length]
+   value = int.from_bytes(data, 'little') ^ int.from_bytes(key, 'little')
+   return bytearray(value.to_bytes(length, 'little'))
+
 class WebSocket(object):
 
    def __init__(self, server, sock, address):
@@ -89,8 +311,7 @@ class WebSocket(object):
       self.hasmask = 0
       self.maskarray = None
       self.length = 0
-      self.lengtharray = None
-      self.index = 0
+      self.recvbuffer = bytearray()
       self.request = None
       self.usingssl = False
 
@@ -98,15 +319,41 @@ class WebSocket(object):
       self.frag_type = BINARY
       self.frag_buffer = None
       self.frag_decoder = codecs.getincrementaldecoder('utf-8')(errors='strict')
+      self.frag_compressed = False
+      self.compressed = False
+      self.deflate = None
+      self.sendlock = threading.Lock()
       self.closed = False
       self.sendq = deque()
-
-      self.state = HEADERB1
+      self.sendoffset = 0
+
+      # the sendq is unbounded until setSendqLimits() is called
+      self.sendqlock = threading.Lock()
+      self.sendqdrained = threading.Condition(self.sendqlock)
+      self.sendqbytes = 0
+      self.sendqdropped = 0
+      self.highwater = None
+      self.lowwater = None
+      self.sendqpolicy = SENDQ_DISCONNECT
+      self.congested = False
+
+      # traffic counters, frame headers and the HTTP handshake included
+      self.framesin = 0
+      self.framesout = 0
+      self.bytesin = 0
+      self.bytesout = 0
+
+      limits = getattr(server, 'sendqlimits', None)
+      if limits:
+         self.setSendqLimits(limits.get('high_water'), limits.get('low_water'),
+                             limits.get('policy', SENDQ_DISCONNECT))
 
       # restrict the size of header and payload for security reasons
       self.maxheader = MAXHEADER
       self.maxpayload = MAXPAYLOAD
 
+      self.coalescelimit = MAXCOALESCE
+
    def handleMessage(self):
       """
           Called when websocket frame is received.
@@ -129,6 +376,57 @@ class WebSocket(object):
       """
       pass
 
+   def handleCongested(self):
+      """
+          Called when a message is queued while the sendq is over its high
+          water mark. Runs on whichever thread queued the message.
+      """
+      pass
+
+   def handleDrained(self):
+      """
+          Called when a congested sendq has been flushed down to its low
+          water mark. Runs on the serving thread.
+      """
+      pass
+
+   def setSendqLimits(self, highwater, lowwater = None, policy = SENDQ_DISCONNECT):
+      """
+          Bound the number of bytes waiting in the sendq.
+
+          Once highwater is reached, policy decides what happens to further
+          data messages:
+
+          block        wait until the sendq drains to lowwater. The serving
+                       thread never blocks; its messages are queued anyway.
+          drop-oldest  discard the oldest queued data messages to make room.
+          coalesce     replace a queued message sent with the same key.
+          disconnect   discard the sendq and close the connection. This is
+                       the default, since the other policies drop or hold
+                       back messages the client may be waiting on.
+
+          Control frames, message fragments and frames the compression
+          context depends on are never discarded. Connections that
+          negotiate permessage-deflate under drop-oldest or coalesce do so
+          without server context takeover, so their messages can be.
+          Whenever drop-oldest or coalesce leave more than highwater bytes
+          queued, the connection is closed as under disconnect, so the
+          sendq never holds much more than highwater plus one message.
+          lowwater defaults to a quarter of highwater.
+
+          Limits set after the handshake do not change the compression
+          context takeover that was negotiated.
+      """
+      if policy not in SENDQ_POLICIES:
+         raise ValueError('unknown sendq policy %r' % (policy,))
+
+      if highwater is not None and lowwater is None:
+         lowwater = highwater // 4
+
+      self.highwater = highwater
+      self.lowwater = lowwater
+      self.sendqpolicy = policy
+
    def _handlePacket(self):
       if self.opcode == CLOSE:
          pass
@@ -177,9 +475,11 @@ class WebSocket(object):
 
               self.frag_type = self.opcode
               self.frag_start = True
+              self.frag_compressed = self.compressed
               self.frag_decoder.reset()
 
-              if self.frag_type == TEXT:
+              # compressed fragments are kept as is and inflated once complete
+              if self.frag_type == TEXT and not self.frag_compressed:
                   self.frag_buffer = []
                   utf_str = self.frag_decoder.decode(self.data, final = False)
                   if utf_str:
@@ -192,7 +492,7 @@ class WebSocket(object):
               if self.frag_start is False:
                   raise Exception('fragmentation protocol error')
 
-              if self.frag_type == TEXT:
+              if self.frag_type == TEXT and not self.frag_compressed:
                   utf_str = self.frag_decoder.decode(self.data, final = False)
                   if utf_str:
                       self.frag_buffer.append(utf_str)
@@ -204,7 +504,17 @@ class WebSocket(object):
               if self.frag_start is False:
                   raise Exception('fragmentation protocol error')
 
-              if self.frag_type == TEXT:
+              if self.frag_compressed:
+                  self.frag_buffer.extend(self.data)
+                  self.data = self.deflate.decompress(self.frag_buffer, self.maxpayload)
+
+                  if self.frag_type == TEXT:
+                      try:
+                          self.data = self.data.decode('utf8', errors='strict')
+                      except Exception as exp:
+                          raise Exception('invalid utf-8 payload')
+
+              elif self.frag_type == TEXT:
                   utf_str = self.frag_decoder.decode(self.data, final = True)
                   self.frag_buffer.append(utf_str)
                   self.data = u''.join(self.frag_buffer)
@@ -217,6 +527,7 @@ class WebSocket(object):
               self.frag_decoder.reset()
               self.frag_type = BINARY
               self.frag_start = False
+              self.frag_compressed = False
               self.frag_buffer = None
 
           elif self.opcode == PING:
@@ -229,6 +540,9 @@ class WebSocket(object):
               if self.frag_start is True:
                   raise Exception('fragmentation protocol error')
 
+              if self.compressed:
+                  self.data = self.deflate.decompress(self.data, self.maxpayload)
+
               if self.opcode == TEXT:
                   try:
                       self.data = self.data.decode('utf8', errors='strict')
@@ -239,48 +553,70 @@ class WebSocket(object):
 
 
    def _handleData(self):
+      if self.handshaked is False:
+         data = self.client.recv(self.headertoread)
+      else:
+         data = self.client.recv(16384)
+
+      if not data:
+         raise Exception('remote socket closed')
+
+      self._feedData(data)
+
+   def _feedData(self, data):
+      """
+          Consume bytes received from the client, whichever engine read them.
+      """
+      self.bytesin += len(data)
+
       # do the HTTP header and handshake
       if self.handshaked is False:
+         # accumulate
+         self.headerbuffer.extend(data)
 
-         data = self.client.recv(self.headertoread)
-         if not data:
-            raise Exception('remote socket closed')
+         if len(self.headerbuffer) >= self.maxheader:
+            raise Exception('header exceeded allowable size')
 
-         else:
-            # accumulate
-            self.headerbuffer.extend(data)
-
-            if len(self.headerbuffer) >= self.maxheader:
-               raise Exception('header exceeded allowable size')
-
-            # indicates end of HTTP header
-            if b'\r\n\r\n' in self.headerbuffer:
-               self.request = HTTPRequest(self.headerbuffer)
-
-               # handshake rfc 6455
-               try:
-                  key = self.request.headers['Sec-WebSocket-Key']
-                  k = key.encode('ascii') + GUID_STR.encode('ascii')
-                  k_s = base64.b64encode(hashlib.sha1(k).digest()).decode('ascii')
-                  hStr = HANDSHAKE_STR % {'acceptstr': k_s}
-                  self.sendq.append((BINARY, hStr.encode('ascii')))
-                  self.handshaked = True
-                  self.handleConnected()
-               except Exception as e:
-                  raise Exception('handshake failed: %s', str(e))
+         # indicates end of HTTP header
+         end = self.headerbuffer.find(b'\r\n\r\n')
+         if end == -1:
+            return
 
-      # else do normal data
-      else:
-         data = self.client.recv(16384)
+         self.request = HTTPRequest(self.headerbuffer[:end + 4])
+
+         # handshake rfc 6455
+         try:
+            key = self.request.headers['Sec-WebSocket-Key']
+            k = key.encode('ascii') + GUID_STR.encode('ascii')
+            k_s = base64.b64encode(hashlib.sha1(k).digest()).decode('ascii')
+
+            extensions = ''
+            offer = _headerValues(self.request.headers, 'Sec-WebSocket-Extensions')
+            options = self.server.deflate
+            if options is not None and self.highwater is not None and \
+                  self.sendqpolicy in (SENDQ_DROP_OLDEST, SENDQ_COALESCE):
+               # a compressed message can only be dropped when the ones
+               # after it do not depend on it
+               options = dict(options, server_no_context_takeover=True)
+            self.deflate, accepted = PerMessageDeflate.negotiate(offer, options)
+            if accepted:
+               extensions = EXTENSIONS_STR % accepted
+
+            hStr = HANDSHAKE_STR % {'acceptstr': k_s, 'extensions': extensions}
+            self._queue(BINARY, hStr.encode('ascii'))
+            self.handshaked = True
+            self.handleConnected()
+         except Exception as e:
+            raise Exception('handshake failed: %s', str(e))
+
+         # frames that arrived along with the header
+         data = self.headerbuffer[end + 4:]
          if not data:
-            raise Exception("remote socket closed")
+            return
 
-         if VER >= 3:
-             for d in data:
-                 self._parseMessage(d)
-         else:
-             for d in data:
-                 self._parseMessage(ord(d))
+      # else do normal data
+      self.recvbuffer.extend(data)
+      self._parseFrames()
 
    def close(self, status = 1000, reason = u''):
        """
@@ -305,31 +641,147 @@ class WebSocket(object):
             self.closed = True
 
 
-   def _sendBuffer(self, buff, send_all = False):
-      size = len(buff)
-      tosend = size
-      already_sent = 0
+   def _sendBuffers(self, buffers, size):
+      """
+          Write buffers to the socket in a single sendmsg call where the
+          socket supports it. Otherwise small buffers are joined into one
+          send and large ones are sent one at a time.
 
-      while tosend > 0:
-         try:
-            # i should be able to send a bytearray
-            sent = self.client.send(buff[already_sent:])
+          Returns the number of bytes written, 0 if the socket is full.
+      """
+      sent = 0
+      try:
+         if self.usingssl is False and hasattr(self.client, 'sendmsg'):
+            sent = self.client.sendmsg(buffers)
+         elif len(buffers) > 1 and size <= self.coalescelimit:
+            sent = self.client.send(b''.join(buffers))
+         else:
+            for buff in buffers:
+               written = self.client.send(buff)
+               sent += written
+               if written < len(buff):
+                  break
+
+      except socket.error as e:
+         # if we have full buffers then wait for them to drain and try again.
+         # Whatever went out before the socket filled up is still counted,
+         # or it would be sent a second time.
+         if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+            return sent
+         raise e
+
+      return sent
+
+   def _gatherSendq(self):
+      """
+          Collect the queued frames that go out in the next write: as many
+          whole frames as fit in coalescelimit, or a single larger frame.
+          Nothing queued behind a CLOSE frame is gathered.
+      """
+      buffers = []
+      size = 0
+      offset = self.sendoffset
+      count = len(self.sendq)
+      index = 0
+
+      while index < count:
+         opcode, header, payload, key = self.sendq[index]
+         framesize = len(header) + len(payload) - offset
+
+         if index > 0 and (size + framesize > self.coalescelimit or
+                           len(buffers) + 2 > MAXIOV):
+            break
+
+         headerlength = len(header)
+         if offset < headerlength:
+            buffers.append(memoryview(header)[offset:])
+            if payload:
+               buffers.append(memoryview(payload))
+         else:
+            buffers.append(memoryview(payload)[offset - headerlength:])
+
+         size += framesize
+         offset = 0
+         index += 1
+
+         if opcode == CLOSE:
+            break
+
+      return buffers, size
+
+   def _flushSendq(self):
+      """
+          Send queued frames until the sendq is empty or the socket is full.
+          Small frames are coalesced into one write, and a partially sent
+          frame is resumed from self.sendoffset so its tail is never copied.
+
+          Returns True when the sendq was fully drained.
+      """
+      relieved = False
+
+      with self.sendqlock:
+         while self.sendq:
+            buffers, size = self._gatherSendq()
+
+            sent = self._sendBuffers(buffers, size)
             if sent == 0:
-               raise RuntimeError('socket connection broken')
+               break
 
-            already_sent += sent
-            tosend -= sent
+            # drop every frame that went out completely
+            while sent > 0:
+               opcode, header, payload, key = self.sendq[0]
+               left = len(header) + len(payload) - self.sendoffset
 
-         except socket.error as e:
-            # if we have full buffers then wait for them to drain and try again
-            if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
-               if send_all:
-                   continue
-               return buff[already_sent:]
-            else:
-               raise e
+               if sent < left:
+                  self.sendoffset += sent
+                  break
+
+               self.sendq.popleft()
+               self.sendoffset = 0
+               sent -= left
+               relieved = self._sendqConsumed(len(header) + len(payload)) or relieved
+
+               if opcode == CLOSE:
+                  raise Exception('received client close')
+
+            if self.sendoffset:
+               break
+
+         drained = not self.sendq
 
-      return None
+      if relieved:
+         self.handleDrained()
+
+      return drained
+
+   def _sendqConsumed(self, size):
+      """
+          Account for a frame written out of the sendq. Must be called
+          with sendqlock held; returns True when the sendq stopped being
+          congested.
+      """
+      self.sendqbytes -= size
+      self.framesout += 1
+      self.bytesout += size
+
+      if self.congested and self.sendqbytes <= self.lowwater:
+         self.congested = False
+         self.sendqdrained.notify_all()
+         return True
+
+      return False
+
+   def _abortSendq(self):
+      """
+          Throw away everything still queued once the connection is gone,
+          and release any sender blocked on the sendq.
+      """
+      with self.sendqlock:
+         self.sendq.clear()
+         self.sendoffset = 0
+         self.sendqbytes = 0
+         self.closed = True
+         self.sendqdrained.notify_all()
 
    def sendFragmentStart(self, data):
       """
@@ -370,211 +822,256 @@ class WebSocket(object):
           If data is a unicode object then the frame is sent as Text.
           If the data is a bytearray object then the frame is sent as Binary.
       """
-      opcode = BINARY
-      if _check_unicode(data):
-         opcode = TEXT
-      self._sendMessage(False, opcode, data)
+      self.sendPrepared(prepareMessage(data))
+
+   def sendPrepared(self, message, key = None):
+      """
+          Send a message built by prepareMessage(). The same prepared
+          message can be handed to any number of clients; it is only
+          re-framed for clients that compress it.
 
+          key identifies messages that supersede each other under the
+          coalesce sendq policy.
+      """
+      opcode, header, payload = message
 
-   def _sendMessage(self, fin, opcode, data):
+      deflate = self.deflate
+      if deflate is None or len(payload) < deflate.minsize:
+         self._queue(opcode, header, payload, key)
+         return
 
-        payload = bytearray()
+      # admitted at its uncompressed size, before taking sendlock: a sender
+      # blocked in _admit must not keep the serving thread from queueing
+      if self.highwater is not None and not self._admit(len(header) + len(payload), key):
+         return
 
-        b1 = 0
-        b2 = 0
-        if fin is False:
-           b1 |= 0x80
-        b1 |= opcode
+      # with context takeover, messages must be queued in the order they
+      # went through the compressor
+      with self.sendlock:
+         payload = deflate.compress(payload)
+         self._append(opcode, _frameHeader(False, opcode, len(payload), True), payload, key)
 
+   def _sendMessage(self, fin, opcode, data, compressed = False):
         if _check_unicode(data):
            data = data.encode('utf-8')
 
-        length = len(data)
-        payload.append(b1)
+        # the payload is queued as is rather than copied behind the header,
+        # so it must not be modified after it has been handed over
+        self._queue(opcode, _frameHeader(fin, opcode, len(data), compressed), data)
 
-        if length <= 125:
-           b2 |= length
-           payload.append(b2)
+   def _queue(self, opcode, header, payload = b'', key = None):
+      if self.highwater is not None and opcode < CLOSE:
+         if not self._admit(len(header) + len(payload), key):
+            return
 
-        elif length >= 126 and length <= 65535:
-           b2 |= 126
-           payload.append(b2)
-           payload.extend(struct.pack("!H", length))
+      self._append(opcode, header, payload, key)
 
-        else:
-           b2 |= 127
-           payload.append(b2)
-           payload.extend(struct.pack("!Q", length))
+   def _append(self, opcode, header, payload, key):
+      with self.sendqlock:
+         self.sendq.append((opcode, header, payload, key))
+         self.sendqbytes += len(header) + len(payload)
 
-        if length > 0:
-           payload.extend(data)
+      self.server._notifyWrite(self)
 
-        self.sendq.append((opcode, payload))
+   def _admit(self, size, key):
+      """
+          Apply the sendq policy to a data message of size bytes.
 
+          Returns False when the message must not be queued.
+      """
+      block = False
 
-   def _parseMessage(self, byte):
-      # read in the header
-      if self.state == HEADERB1:
+      with self.sendqlock:
+         if self.sendqbytes + size <= self.highwater:
+            return True
 
-         self.fin = byte & 0x80
-         self.opcode = byte & 0x0F
-         self.state = HEADERB2
+         policy = self.sendqpolicy
+         notify = not self.congested
+         self.congested = True
 
-         self.index = 0
-         self.length = 0
-         self.lengtharray = bytearray()
-         self.data = bytearray()
+         if policy == SENDQ_DROP_OLDEST:
+            self._discardOldest(self.sendqbytes + size - self.highwater)
+         elif policy == SENDQ_COALESCE:
+            if key is not None:
+               self._discardKey(key)
+         elif policy == SENDQ_BLOCK:
+            # the serving thread is the one that drains the sendq
+            block = threading.current_thread() is not getattr(self.server, 'loopthread', None)
 
-         rsv = byte & 0x70
-         if rsv != 0:
-            raise Exception('RSV bit must be 0')
+         # nothing left that may be dropped, and the sendq is still full
+         if policy != SENDQ_BLOCK and self.sendqbytes > self.highwater:
+            policy = SENDQ_DISCONNECT
 
-      elif self.state == HEADERB2:
-         mask = byte & 0x80
-         length = byte & 0x7F
+         if policy == SENDQ_DISCONNECT:
+            self._discardOldest(None)
 
-         if self.opcode == PING and length > 125:
-             raise Exception('ping packet is too large')
+      if notify:
+         self.handleCongested()
 
-         if mask == 128:
-            self.hasmask = True
-         else:
-            self.hasmask = False
+      if policy == SENDQ_DISCONNECT:
+         self.close(1008, u'send queue overflow')
+         return False
 
-         if length <= 125:
-            self.length = length
+      if block:
+         with self.sendqlock:
+            while self.congested and not self.closed:
+               self.sendqdrained.wait()
 
-            # if we have a mask we must read it
-            if self.hasmask is True:
-               self.maskarray = bytearray()
-               self.state = MASK
-            else:
-               # if there is no mask and no payload we are done
-               if self.length <= 0:
-                  try:
-                     self._handlePacket()
-                  finally:
-                     self.state = HEADERB1
-                     self.data = bytearray()
+      return True
 
-               # we have no mask and some payload
-               else:
-                  #self.index = 0
-                  self.data = bytearray()
-                  self.state = PAYLOAD
+   def _isDroppable(self, entry):
+      opcode, header, payload, key = entry
 
-         elif length == 126:
-            self.lengtharray = bytearray()
-            self.state = LENGTHSHORT
+      if opcode not in (TEXT, BINARY):
+         return False
 
-         elif length == 127:
-            self.lengtharray = bytearray()
-            self.state = LENGTHLONG
+      b1 = ord(header[0:1])
 
+      # a fragment, or the handshake response which is queued as raw bytes
+      if not b1 & 0x80:
+         return False
 
-      elif self.state == LENGTHSHORT:
-         self.lengtharray.append(byte)
+      # the client's inflater has already seen what was compressed before
+      if b1 & 0x40 and not self.deflate.servernotakeover:
+         return False
 
-         if len(self.lengtharray) > 2:
-            raise Exception('short length exceeded allowable size')
+      return True
+
+   def _discardOldest(self, needed):
+      """
+          Remove unsent data messages from the front of the sendq until
+          needed bytes are freed, or as many as possible when needed is
+          None. Queued pings and pongs are stepped over, anything else that
+          must be kept ends the scan. Must be called with sendqlock held.
+      """
+      sendq = self.sendq
+      kept = []
+      freed = 0
+
+      # the head frame may be partially written already
+      if self.sendoffset and sendq:
+         kept.append(sendq.popleft())
+
+      while sendq and (needed is None or freed < needed):
+         entry = sendq[0]
+
+         if self._isDroppable(entry):
+            sendq.popleft()
+            freed += len(entry[1]) + len(entry[2])
+            self.sendqdropped += 1
+         elif entry[0] in (PING, PONG):
+            kept.append(sendq.popleft())
+         else:
+            break
 
-         if len(self.lengtharray) == 2:
-            self.length = struct.unpack_from('!H', self.lengtharray)[0]
+      sendq.extendleft(reversed(kept))
+      self.sendqbytes -= freed
 
-            if self.hasmask is True:
-               self.maskarray = bytearray()
-               self.state = MASK
-            else:
-               # if there is no mask and no payload we are done
-               if self.length <= 0:
-                  try:
-                     self._handlePacket()
-                  finally:
-                     self.state = HEADERB1
-                     self.data = bytearray()
+   def _discardKey(self, key):
+      """
+          Remove the unsent data messages queued under key. Must be called
+          with sendqlock held.
+      """
+      start = 1 if self.sendoffset else 0
+      found = [index for index, entry in enumerate(self.sendq)
+               if index >= start and entry[3] == key and self._isDroppable(entry)]
 
-               # we have no mask and some payload
-               else:
-                  #self.index = 0
-                  self.data = bytearray()
-                  self.state = PAYLOAD
+      if not found:
+         return
 
-      elif self.state == LENGTHLONG:
+      for index in reversed(found):
+         entry = self.sendq[index]
+         del self.sendq[index]
+         self.sendqbytes -= len(entry[1]) + len(entry[2])
+         self.sendqdropped += 1
 
-         self.lengtharray.append(byte)
 
-         if len(self.lengtharray) > 8:
-            raise Exception('long length exceeded allowable size')
+   def _parseFrames(self):
+      """
+          Decode every complete frame in the receive buffer.
 
-         if len(self.lengtharray) == 8:
-            self.length = struct.unpack_from('!Q', self.lengtharray)[0]
+          The header is read straight out of the buffer and the payload is
+          copied with a single slice. Incomplete frames are left in the buffer
+          until more data arrives.
+      """
+      buff = self.recvbuffer
+      size = len(buff)
+      offset = 0
+
+      try:
+         while size - offset >= 2:
+            b1 = buff[offset]
+            b2 = buff[offset + 1]
+
+            opcode = b1 & 0x0F
+            rsv = b1 & 0x70
+
+            # RSV1 marks the first frame of a compressed message
+            if rsv != 0:
+               if rsv != 0x40 or self.deflate is None or opcode not in (TEXT, BINARY):
+                  raise Exception('RSV bit must be 0')
+            length = b2 & 0x7F
+            pos = offset + 2
+
+            if opcode == PING and length > 125:
+               raise Exception('ping packet is too large')
+
+            if length == 126:
+               if size - pos < 2:
+                  break
+               length = struct.unpack_from('!H', buff, pos)[0]
+               pos += 2
+
+            elif length == 127:
+               if size - pos < 8:
+                  break
+               length = struct.unpack_from('!Q', buff, pos)[0]
+               pos += 8
+
+            # if length exceeds allowable size then we except and remove the connection
+            if length >= self.maxpayload:
+               raise Exception('payload exceeded allowable size')
+
+            hasmask = b2 & 0x80 == 0x80
+            if hasmask:
+               if size - pos < 4:
+                  break
+               self.maskarray = buff[pos:pos + 4]
+               pos += 4
+
+            end = pos + length
+            if end > size:
+               break
+
+            self.fin = b1 & 0x80
+            self.opcode = opcode
+            self.compressed = rsv != 0
+            self.hasmask = hasmask
+            self.length = length
 
-            if self.hasmask is True:
-               self.maskarray = bytearray()
-               self.state = MASK
+            if hasmask:
+               self.data = _unmask(buff[pos:end], self.maskarray)
             else:
-               # if there is no mask and no payload we are done
-               if self.length <= 0:
-                  try:
-                     self._handlePacket()
-                  finally:
-                     self.state = HEADERB1
-                     self.data = bytearray()
-
-               # we have no mask and some payload
-               else:
-                  #self.index = 0
-                  self.data = bytearray()
-                  self.state = PAYLOAD
-
-      # MASK STATE
-      elif self.state == MASK:
-         self.maskarray.append(byte)
-
-         if len(self.maskarray) > 4:
-            raise Exception('mask exceeded allowable size')
-
-         if len(self.maskarray) == 4:
-            # if there is no mask and no payload we are done
-            if self.length <= 0:
-               try:
-                  self._handlePacket()
-               finally:
-                  self.state = HEADERB1
-                  self.data = bytearray()
-
-            # we have no mask and some payload
-            else:
-               #self.index = 0
-               self.data = bytearray()
-               self.state = PAYLOAD
+               self.data = buff[pos:end]
 
-      # PAYLOAD STATE
-      elif self.state == PAYLOAD:
-         if self.hasmask is True:
-            self.data.append( byte ^ self.maskarray[self.index % 4] )
-         else:
-            self.data.append( byte )
-
-         # if length exceeds allowable size then we except and remove the connection
-         if len(self.data) >= self.maxpayload:
-            raise Exception('payload exceeded allowable size')
+            offset = end
+            self.framesin += 1
 
-         # check if we have processed length bytes; if so we are done
-         if (self.index+1) == self.length:
             try:
                self._handlePacket()
             finally:
-               #self.index = 0
-               self.state = HEADERB1
                self.data = bytearray()
-         else:
-            self.index += 1
+
+      finally:
+         if offset:
+            del buff[:offset]
 
 
 class SimpleWebSocketServer(object):
-   def __init__(self, host, port, websocketclass, selectInterval = 0.1):
+   def __init__(self, host, port, websocketclass, selectInterval = 0.1, deflate = None, sendq = None):
       self.websocketclass = websocketclass
+      self.deflate = deflate
+      self.sendqlimits = sendq
       self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
       self.serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
       self.serversocket.bind((host, port))
@@ -582,22 +1079,66 @@ class SimpleWebSocketServer(object):
       self.selectInterval = selectInterval
       self.connections = {}
       self.listeners = [self.serversocket]
+      self.closed = False
+      self.passstart = _clock()
+
+      # clients with a newly non-empty sendq, picked up at the start of a tick
+      self.writeready = deque()
+      self.writers = set()
+      self.loopthread = None
+
+      self.selector = None
+      self.wakeupreader = None
+      self.wakeupwriter = None
+      self.wakeuppending = False
+
+      if selectors is not None:
+         self.selector = selectors.DefaultSelector()
+         self.selector.register(self.serversocket, selectors.EVENT_READ)
+
+         # lets other threads interrupt a blocking select as soon as
+         # something is queued, instead of waiting out selectInterval
+         if hasattr(socket, 'socketpair'):
+            self.wakeupreader, self.wakeupwriter = socket.socketpair()
+            self.wakeupreader.setblocking(0)
+            self.wakeupwriter.setblocking(0)
+            self.selector.register(self.wakeupreader, selectors.EVENT_READ)
 
    def _decorateSocket(self, sock):
       return sock
 
+   def handleTick(self):
+      """
+          Called by the serving thread after every pass through the loop.
+      """
+      pass
+
+   def handleLoopTime(self, seconds):
+      """
+          Called by the serving thread with the time one pass through the
+          loop spent handling sockets and ticking, not waiting on them.
+      """
+      pass
+
+   def _selectTimeout(self):
+      return self.selectInterval
+
    def _constructWebSocket(self, sock, address):
       return self.websocketclass(self, sock, address)
 
    def close(self):
+      self.closed = True
       self.serversocket.close()
 
-      for desc, conn in self.connections.items():
+      for desc, conn in list(self.connections.items()):
          conn.close()
          self._handleClose(conn)
 
+      self._wakeup()
+
    def _handleClose(self, client):
       client.client.close()
+      client._abortSendq()
       # only call handleClose when we have a successful websocket connection
       if client.handshaked:
          try:
@@ -605,7 +1146,136 @@ class SimpleWebSocketServer(object):
          except:
             pass
 
+   def _notifyWrite(self, client):
+      """
+          Called whenever a frame is queued for client. Write interest is
+          only registered once the loop picks the client up, so a tick never
+          has to scan every connection for pending data.
+      """
+      self.writeready.append(client)
+
+      if threading.current_thread() is not self.loopthread:
+         self._wakeup()
+
+   def _wakeup(self):
+      if self.wakeupwriter is None or self.wakeuppending:
+         return
+
+      self.wakeuppending = True
+      try:
+         self.wakeupwriter.send(b'\0')
+      except socket.error:
+         pass
+
+   def _drainWakeup(self):
+      # drain before clearing the flag. A wakeup skipped because the flag
+      # was still set queued its client before looking at it, and the next
+      # _updateWriters picks that up. Clearing first would let a byte sent
+      # in between be read here with the flag left set, and no other thread
+      # would wake the loop again.
+      try:
+         while self.wakeupreader.recv(4096):
+            pass
+      except socket.error:
+         pass
+
+      self.wakeuppending = False
+
+   def _updateWriters(self):
+      while self.writeready:
+         client = self.writeready.popleft()
+         fileno = client.client.fileno()
+
+         if not client.sendq or fileno in self.writers or fileno not in self.connections:
+            continue
+
+         self.writers.add(fileno)
+         self.selector.modify(client.client,
+                              selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+
+   def _accept(self):
+      sock = None
+      try:
+         sock, address = self.serversocket.accept()
+         newsock = self._decorateSocket(sock)
+         newsock.setblocking(0)
+         fileno = newsock.fileno()
+         client = self._constructWebSocket(newsock, address)
+         self.connections[fileno] = client
+
+         if self.selector is not None:
+            self.selector.register(newsock, selectors.EVENT_READ, client)
+         else:
+            self.listeners.append(fileno)
+
+      except Exception as n:
+         if sock is not None:
+            sock.close()
+
+   def _dropClient(self, fileno):
+      client = self.connections.pop(fileno)
+
+      if self.selector is not None:
+         self.writers.discard(fileno)
+         try:
+            self.selector.unregister(client.client)
+         except (KeyError, ValueError):
+            pass
+      else:
+         self.listeners.remove(fileno)
+
+      self._handleClose(client)
+
+   def _handleWrite(self, client):
+      """
+          Flush as much of the client's sendq as the socket accepts.
+
+          Returns True when the sendq was fully drained.
+      """
+      return client._flushSendq()
+
    def serveonce(self):
+      if self.selector is None:
+         self._serveonceSelect()
+         return
+
+      self._updateWriters()
+
+      events = self.selector.select(self._selectTimeout() or None)
+      self.passstart = _clock()
+
+      for key, mask in events:
+         sock = key.fileobj
+
+         if sock is self.serversocket:
+            self._accept()
+            continue
+
+         if sock is self.wakeupreader:
+            self._drainWakeup()
+            continue
+
+         client = key.data
+         fileno = key.fd
+
+         if mask & selectors.EVENT_WRITE:
+            try:
+               if self._handleWrite(client):
+                  self.writers.discard(fileno)
+                  self.selector.modify(client.client, selectors.EVENT_READ, client)
+            except Exception as n:
+               self._dropClient(fileno)
+               continue
+
+         if mask & selectors.EVENT_READ:
+            try:
+               client._handleData()
+            except Exception as n:
+               self._dropClient(fileno)
+
+   def _serveonceSelect(self):
+      # select() fallback for interpreters without the selectors module
+      self.writeready.clear()
       writers = []
       for fileno in self.listeners:
          if fileno == self.serversocket:
@@ -614,41 +1284,23 @@ class SimpleWebSocketServer(object):
          if client.sendq:
             writers.append(fileno)
 
-      if self.selectInterval:
-         rList, wList, xList = select(self.listeners, writers, self.listeners, self.selectInterval)
+      timeout = self._selectTimeout()
+      if timeout:
+         rList, wList, xList = select(self.listeners, writers, self.listeners, timeout)
       else:
          rList, wList, xList = select(self.listeners, writers, self.listeners)
+      self.passstart = _clock()
 
       for ready in wList:
          client = self.connections[ready]
          try:
-            while client.sendq:
-               opcode, payload = client.sendq.popleft()
-               remaining = client._sendBuffer(payload)
-               if remaining is not None:
-                   client.sendq.appendleft((opcode, remaining))
-                   break
-               else:
-                   if opcode == CLOSE:
-                      raise Exception('received client close')
-
+            self._handleWrite(client)
          except Exception as n:
-            self._handleClose(client)
-            del self.connections[ready]
-            self.listeners.remove(ready)
+            self._dropClient(ready)
 
       for ready in rList:
          if ready == self.serversocket:
-            try:
-               sock, address = self.serversocket.accept()
-               newsock = self._decorateSocket(sock)
-               newsock.setblocking(0)
-               fileno = newsock.fileno()
-               self.connections[fileno] = self._constructWebSocket(newsock, address)
-               self.listeners.append(fileno)
-            except Exception as n:
-               if sock is not None:
-                  sock.close()
+            self._accept()
          else:
             if ready not in self.connections:
                 continue
@@ -656,9 +1308,7 @@ class SimpleWebSocketServer(object):
             try:
                client._handleData()
             except Exception as n:
-               self._handleClose(client)
-               del self.connections[ready]
-               self.listeners.remove(ready)
+               self._dropClient(ready)
 
       for failed in xList:
          if failed == self.serversocket:
@@ -667,22 +1317,31 @@ class SimpleWebSocketServer(object):
          else:
             if failed not in self.connections:
                continue
-            client = self.connections[failed]
-            self._handleClose(client)
-            del self.connections[failed]
-            self.listeners.remove(failed)
+            self._dropClient(failed)
 
    def serveforever(self):
-      while True:
-         self.serveonce()
+      self.loopthread = threading.current_thread()
+
+      try:
+         while not self.closed:
+            self.serveonce()
+            self.handleTick()
+            self.handleLoopTime(_clock() - self.passstart)
+      finally:
+         if self.selector is not None:
+            self.selector.close()
+         if self.wakeupreader is not None:
+            self.wakeupreader.close()
+            self.wakeupwriter.close()
 
 class SimpleSSLWebSocketServer(SimpleWebSocketServer):
 
    def __init__(self, host, port, websocketclass, certfile,
-                keyfile, version = ssl.PROTOCOL_TLSv1, selectInterval = 0.1):
+                keyfile, version = ssl.PROTOCOL_TLSv1, selectInterval = 0.1, deflate = None,
+                sendq = None):
 
       SimpleWebSocketServer.__init__(self, host, port,
-                                        websocketclass, selectInterval)
+                                        websocketclass, selectInterval, deflate, sendq)
 
       self.context = ssl.SSLContext(version)
       self.context.load_cert_chain(certfile, keyfile)
@@ -0,0 +1,61 @@
+"""
+Pending call registry under many concurrent calls.
+
+Registers N calls at once, then answers each with a few reply parts in
+interleaved order, the way replies from many clients arrive.
+
+    python benchmarks/bench_calls.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Core.Calls import PendingCalls
+
+
+def reply(call_id, part, done):
+    return {
+        'type': 'reply',
+        'part': part,
+        'done': done,
+        'payload': part,
+        'to': {'id': call_id, 'iid': 0, 'event': 'lint'},
+    }
+
+
+def run(count, parts):
+    pending = PendingCalls()
+    completed = []
+
+    def on_done(payload, received, part):
+        completed.append(len(received))
+
+    ids = ['call{}'.format(index) for index in range(count)]
+    messages = [reply(call_id, part, part == parts - 1) for part in range(parts) for call_id in ids]
+
+    start = time.perf_counter()
+    for call_id in ids:
+        pending.add(call_id, 'lint', None, on_done)
+    peak = len(pending)
+    for message in messages:
+        pending.resolve(message)
+    elapsed = time.perf_counter() - start
+
+    assert peak == count and len(pending) == 0
+    assert completed == [parts] * count
+    return elapsed, len(messages)
+
+
+def main():
+    print('{:>10} {:>8} {:>12} {:>16}'.format('in flight', 'parts', 'total ms', 'replies/s'))
+
+    for count in (1000, 10000, 100000):
+        elapsed, replies = run(count, 4)
+        print('{:>10} {:>8} {:>12.2f} {:>16,.0f}'.format(count, 4, elapsed * 1000, replies / elapsed))
+
+
+if __name__ == '__main__':
+    main()
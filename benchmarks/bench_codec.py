@@ -0,0 +1,90 @@
+"""
+JSON against MessagePack for typical call and reply messages.
+
+Reports encode and decode cost and the encoded size of each message.
+
+    python benchmarks/bench_codec.py
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Core import MsgPack
+
+
+CALL = {
+    'id': 'cjld2cjxh0000qzrmn831i7rn',
+    'iid': 1042,
+    'type': 'call',
+    'event': 'lint:javascript',
+    'payload': {
+        'filename': '/home/user/project/src/components/editor.js',
+        'contents': 'const answer = 42;\n' * 40,
+    },
+    'origin': {'id': 'sublimetext3'},
+}
+
+REPLY = {
+    'id': 'cjld2cyuq0000t3rmniod1foy',
+    'iid': 877,
+    'type': 'reply',
+    'part': 0,
+    'done': True,
+    'origin': {'id': 'eslint-client'},
+    'to': {'id': 'cjld2cjxh0000qzrmn831i7rn', 'iid': 1042, 'event': 'lint:javascript'},
+    'payload': [
+        {
+            'line': line,
+            'column': line % 80,
+            'endLine': line,
+            'endColumn': line % 80 + 4,
+            'message': 'Missing semicolon.',
+            'ruleId': 'semi',
+            'severity': 2,
+            'fixable': True,
+        }
+        for line in range(50)
+    ],
+}
+
+PING = {'type': 'ping'}
+
+
+def json_encode(message):
+    return json.dumps(message) + '\n'
+
+
+def json_decode(data):
+    return [json.loads(item) for item in data.split('\n') if item]
+
+
+def measure(func, arg, number):
+    return min(timeit.repeat(lambda: func(arg), number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    print('{:>8} {:>8} {:>12} {:>12} {:>10}'.format('message', 'codec', 'encode us', 'decode us', 'bytes'))
+
+    for name, message, number in (('ping', PING, 20000), ('call', CALL, 5000), ('reply', REPLY, 500)):
+        encoded = json_encode(message)
+        print('{:>8} {:>8} {:>12.2f} {:>12.2f} {:>10}'.format(
+            name, 'json',
+            measure(json_encode, message, number),
+            measure(json_decode, encoded, number),
+            len(encoded.encode('utf-8'))))
+
+        packed = MsgPack.packb(message)
+        assert MsgPack.unpack_all(packed) == [message]
+        print('{:>8} {:>8} {:>12.2f} {:>12.2f} {:>10}'.format(
+            name, 'msgpack',
+            measure(MsgPack.packb, message, number),
+            measure(MsgPack.unpack_all, packed, number),
+            len(packed)))
+
+
+if __name__ == '__main__':
+    main()
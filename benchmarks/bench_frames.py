@@ -0,0 +1,218 @@
+"""
+Inbound frame decoding throughput.
+
+Feeds pre-built client frames to WebSocket._handleData through a fake socket
+that hands out data in recv() sized chunks, the same way the select loop does,
+and the same frames to the previous parser, which went through them one byte
+at a time.
+
+    python benchmarks/bench_frames.py
+"""
+
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SimpleWebSocketServer.SimpleWebSocketServer import WebSocket, BINARY
+
+
+MASK = b'\x37\xfa\x21\x3d'
+
+
+def build_frame(payload, mask=None):
+    header = bytearray([0x80 | BINARY])
+    length = len(payload)
+    maskbit = 0x80 if mask else 0
+
+    if length <= 125:
+        header.append(maskbit | length)
+    elif length <= 65535:
+        header.append(maskbit | 126)
+        header.extend(struct.pack('!H', length))
+    else:
+        header.append(maskbit | 127)
+        header.extend(struct.pack('!Q', length))
+
+    if mask:
+        header.extend(mask)
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+    return bytes(header) + payload
+
+
+class FakeSocket(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def recv(self, size):
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return chunk
+
+
+class Sink(WebSocket):
+    received = 0
+
+    def handleMessage(self):
+        self.received += len(self.data)
+
+
+HEADERB1, HEADERB2, LENGTHSHORT, LENGTHLONG, LEGACY_MASK, PAYLOAD = range(6)
+
+
+class LegacyParser(object):
+    """ The previous byte at a time state machine, minus control frames """
+
+    def __init__(self, sock, maxpayload):
+        self.client = sock
+        self.maxpayload = maxpayload
+        self.state = HEADERB1
+        self.received = 0
+
+    def _handleData(self):
+        data = self.client.recv(16384)
+        if not data:
+            raise Exception('remote socket closed')
+
+        for d in data:
+            self._parseMessage(d)
+
+    def _handlePacket(self):
+        self.received += len(self.data)
+
+    def _payloadStart(self):
+        if self.length <= 0:
+            try:
+                self._handlePacket()
+            finally:
+                self.state = HEADERB1
+                self.data = bytearray()
+        else:
+            self.data = bytearray()
+            self.state = PAYLOAD
+
+    def _lengthDone(self):
+        if self.hasmask is True:
+            self.maskarray = bytearray()
+            self.state = LEGACY_MASK
+        else:
+            self._payloadStart()
+
+    def _parseMessage(self, byte):
+        if self.state == HEADERB1:
+            self.fin = byte & 0x80
+            self.opcode = byte & 0x0F
+            self.state = HEADERB2
+
+            self.index = 0
+            self.length = 0
+            self.lengtharray = bytearray()
+            self.data = bytearray()
+
+            if byte & 0x70 != 0:
+                raise Exception('RSV bit must be 0')
+
+        elif self.state == HEADERB2:
+            length = byte & 0x7F
+            self.hasmask = byte & 0x80 == 128
+
+            if length <= 125:
+                self.length = length
+                self._lengthDone()
+
+            elif length == 126:
+                self.lengtharray = bytearray()
+                self.state = LENGTHSHORT
+
+            elif length == 127:
+                self.lengtharray = bytearray()
+                self.state = LENGTHLONG
+
+        elif self.state == LENGTHSHORT:
+            self.lengtharray.append(byte)
+
+            if len(self.lengtharray) == 2:
+                self.length = struct.unpack_from('!H', self.lengtharray)[0]
+                self._lengthDone()
+
+        elif self.state == LENGTHLONG:
+            self.lengtharray.append(byte)
+
+            if len(self.lengtharray) == 8:
+                self.length = struct.unpack_from('!Q', self.lengtharray)[0]
+                self._lengthDone()
+
+        elif self.state == LEGACY_MASK:
+            self.maskarray.append(byte)
+
+            if len(self.maskarray) == 4:
+                self._payloadStart()
+
+        elif self.state == PAYLOAD:
+            if self.hasmask is True:
+                self.data.append(byte ^ self.maskarray[self.index % 4])
+            else:
+                self.data.append(byte)
+
+            if len(self.data) >= self.maxpayload:
+                raise Exception('payload exceeded allowable size')
+
+            if (self.index + 1) == self.length:
+                try:
+                    self._handlePacket()
+                finally:
+                    self.state = HEADERB1
+                    self.data = bytearray()
+            else:
+                self.index += 1
+
+
+def run(size, count, mask, legacy=False):
+    frame = build_frame(os.urandom(size), mask)
+    sock = FakeSocket(frame * count)
+
+    if legacy:
+        websocket = LegacyParser(sock, size + 1)
+    else:
+        websocket = Sink(None, sock, ('127.0.0.1', 0))
+        websocket.handshaked = True
+        websocket.maxpayload = max(websocket.maxpayload, size + 1)
+
+    start = time.perf_counter()
+    while sock.offset < len(sock.data):
+        websocket._handleData()
+    elapsed = time.perf_counter() - start
+
+    assert websocket.received == size * count
+    return elapsed
+
+
+def main():
+    cases = [
+        (64, 2000),
+        (1024, 500),
+        (65536, 20),
+        (1048576, 2),
+    ]
+
+    print('MB/s')
+    print('{:>10} {:>8} {:>12} {:>12} {:>12} {:>12}'.format(
+        'size', 'frames', 'old plain', 'plain', 'old masked', 'masked'))
+
+    for size, count in cases:
+        total = size * count / 1048576
+        print('{:>10} {:>8} {:>12.2f} {:>12.2f} {:>12.2f} {:>12.2f}'.format(
+            size, count,
+            total / run(size, count, None, legacy=True),
+            total / run(size, count, None),
+            total / run(size, count, MASK, legacy=True),
+            total / run(size, count, MASK)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Logging an incoming call.
+
+Every incoming call and reply used to be passed to logger.info with the
+whole message, which prints it, payload and all. Compares that with the
+level gated logger when "dev" is off (dropped, plus a protocol history
+record) and on (written with the payload summarized). The log goes to an
+in-memory buffer, so only building the line is measured, not the console.
+
+    python benchmarks/bench_logging.py
+"""
+
+import io
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Core.Log import LevelLogger, ProtocolHistory, DEBUG, INFO
+
+
+class PrintLogger(object):
+    """ Writes its arguments the way print does """
+
+    def __init__(self):
+        self.out = io.StringIO()
+
+    def info(self, *args):
+        print('[info]', *args, file=self.out)
+        self.out.seek(0)
+        self.out.truncate()
+
+    warning = error = info
+
+
+def call(size):
+    return {
+        'id': 'c1a14f9b0acc03d337376', 'iid': 41, 'type': 'call', 'event': 'lint:javascript',
+        'origin': {'id': 'client1'},
+        'payload': {'file': 'app.js', 'source': 'x' * size},
+    }
+
+
+def main():
+    legacy = PrintLogger()
+    gated = LevelLogger(PrintLogger())
+    history = ProtocolHistory()
+
+    def dev_off(message):
+        history.record('in', 'client1', message)
+        gated.debug('Received incoming call {}', message)
+
+    print('us per message')
+    print('{:>10} {:>10} {:>10} {:>10}'.format('payload', 'print', 'dev off', 'dev on'))
+
+    for size in (100, 10000, 1000000):
+        message = call(size)
+        number = max(10, 2000000 // (size + 1000))
+
+        gated.level = INFO
+        before = min(timeit.repeat(lambda: legacy.info('Received incoming call', message), number=number, repeat=3))
+        off = min(timeit.repeat(lambda: dev_off(message), number=number, repeat=3))
+
+        gated.level = DEBUG
+        on = min(timeit.repeat(lambda: dev_off(message), number=number, repeat=3))
+
+        print('{:>10} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+            size, before / number * 1e6, off / number * 1e6, on / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Handing Sublime API work from handlers to the main thread.
+
+A burst of 2000 "update view" messages for 20 views, as handlers would see
+under load. Compares one set_timeout per message with the batched
+dispatcher. A fake main thread runs the scheduled callbacks in order and
+records how many there were, how many updates ran and the longest callback.
+
+    python benchmarks/bench_main_thread.py
+"""
+
+import os
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Core.MainThread import MainThreadDispatcher
+
+
+MESSAGES = 2000
+VIEWS = 20
+UPDATE_SECONDS = 0.0002
+
+
+class MainThread(object):
+    """ Stands in for sublime.set_timeout and the editor's main loop """
+
+    def __init__(self):
+        self.callbacks = deque()
+        self.scheduled = 0
+        self.longest = 0
+
+    def set_timeout(self, callback, delay=0):
+        self.scheduled += 1
+        self.callbacks.append(callback)
+
+    def run(self):
+        while self.callbacks:
+            callback = self.callbacks.popleft()
+            start = time.perf_counter()
+            callback()
+            self.longest = max(self.longest, time.perf_counter() - start)
+
+
+def main():
+    updates = [0]
+
+    def update_view(view_id, content):
+        updates[0] += 1
+        # stands in for redrawing regions
+        deadline = time.perf_counter() + UPDATE_SECONDS
+        while time.perf_counter() < deadline:
+            pass
+
+    print('{} messages for {} views, {:.1f} ms per update'.format(MESSAGES, VIEWS, UPDATE_SECONDS * 1000))
+    print('{:>12} {:>11} {:>9} {:>12} {:>9}'.format('', 'callbacks', 'updates', 'longest ms', 'total ms'))
+
+    main_thread = MainThread()
+    start = time.perf_counter()
+    for i in range(MESSAGES):
+        main_thread.set_timeout(lambda i=i: update_view(i % VIEWS, i), 0)
+    main_thread.run()
+    elapsed = time.perf_counter() - start
+    print('{:>12} {:>11} {:>9} {:>12.2f} {:>9.1f}'.format(
+        'set_timeout', main_thread.scheduled, updates[0], main_thread.longest * 1000, elapsed * 1000))
+
+    updates[0] = 0
+    main_thread = MainThread()
+    dispatcher = MainThreadDispatcher(main_thread.set_timeout)
+    start = time.perf_counter()
+    for i in range(MESSAGES):
+        dispatcher.run(update_view, i % VIEWS, i, key=('update', i % VIEWS))
+    main_thread.run()
+    elapsed = time.perf_counter() - start
+    print('{:>12} {:>11} {:>9} {:>12.2f} {:>9.1f}'.format(
+        'dispatcher', main_thread.scheduled, updates[0], main_thread.longest * 1000, elapsed * 1000))
+
+    # without keys nothing is deduplicated, but the budget still splits the
+    # work into ticks
+    updates[0] = 0
+    main_thread = MainThread()
+    dispatcher = MainThreadDispatcher(main_thread.set_timeout)
+    start = time.perf_counter()
+    for i in range(MESSAGES):
+        dispatcher.run(update_view, i % VIEWS, i)
+    main_thread.run()
+    elapsed = time.perf_counter() - start
+    print('{:>12} {:>11} {:>9} {:>12.2f} {:>9.1f}'.format(
+        'no keys', main_thread.scheduled, updates[0], main_thread.longest * 1000, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+CPU bound call handlers on threads versus worker processes.
+
+Runs a batch of calls to a pure Python handler through the handler thread
+pool and through the process pool at 1 to N workers, where N is the number of
+cores. Threads stay at single core speed because of the GIL, while processes
+should scale until they run out of cores. Workers are started and warmed up
+before the clock starts.
+
+    python benchmarks/bench_processes.py [calls]
+"""
+
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Core.Executor import HandlerExecutor
+from Core.Processes import ProcessHandlers
+
+
+LIMIT = 60000
+
+
+def count_primes(payload, reply):
+    """ A stand-in for parsing or indexing: pure Python and CPU bound """
+    count = 0
+    for n in range(2, payload['limit']):
+        for d in range(2, int(n ** 0.5) + 1):
+            if n % d == 0:
+                break
+        else:
+            count += 1
+
+    reply(count, True)
+
+
+class Batch(object):
+
+    def __init__(self, calls):
+        self.remaining = calls
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+
+    def reply(self, data, done=False):
+        if not done:
+            return
+
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.finished.set()
+
+
+def run_threads(calls, workers):
+    executor = HandlerExecutor(workers=workers)
+    batch = Batch(calls)
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        executor.submit('primes', count_primes, {'limit': LIMIT}, batch.reply)
+    batch.finished.wait()
+    elapsed = time.perf_counter() - start
+
+    executor.shutdown()
+    return elapsed
+
+
+def run_processes(calls, workers):
+    processes = ProcessHandlers({'primes': count_primes}, workers=workers)
+    processes.start()
+
+    # one call per worker, so every worker has been spawned and has imported
+    # the handler before the clock starts
+    warm = Batch(workers)
+    for _ in range(workers):
+        processes.submit('primes', {'limit': 10}, warm.reply)
+    warm.finished.wait()
+
+    batch = Batch(calls)
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        processes.submit('primes', {'limit': LIMIT}, batch.reply)
+    batch.finished.wait()
+    elapsed = time.perf_counter() - start
+
+    processes.shutdown()
+    return elapsed
+
+
+def main(calls):
+    cores = multiprocessing.cpu_count()
+    print('{} calls counting primes below {}, {} cores'.format(calls, LIMIT, cores))
+    print('{:>10} {:>8} {:>10} {:>10}'.format('', 'workers', 'seconds', 'speedup'))
+
+    baseline = run_threads(calls, 1)
+    print('{:>10} {:>8} {:>10.2f} {:>10.2f}'.format('threads', 1, baseline, 1))
+
+    elapsed = run_threads(calls, cores)
+    print('{:>10} {:>8} {:>10.2f} {:>10.2f}'.format('threads', cores, elapsed, baseline / elapsed))
+
+    workers = 1
+    while True:
+        elapsed = run_processes(calls, workers)
+        print('{:>10} {:>8} {:>10.2f} {:>10.2f}'.format('processes', workers, elapsed, baseline / elapsed))
+
+        if workers == cores:
+            break
+        workers = min(workers * 2, cores)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 16)
@@ -0,0 +1,98 @@
+"""
+Building and encoding a 10k part streamed reply.
+
+Compares the previous path, where every part copied the origin dict, built
+the full nested reply dict and encoded all of it, with slotted reply
+messages that splice the pre-encoded origin and "to" blocks of their call.
+Both produce the same bytes, for JSON and MessagePack.
+
+    python benchmarks/bench_reply.py
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Core import MsgPack
+from Core.Ids import message_id_factory
+from Core.Outgoing import ReplyMessage, ReplyTemplate
+
+
+PARTS = 10000
+
+ORIGIN = {'id': 'sublimetext3'}
+CALL = {'id': 'c1a14f9b0acc03d337376', 'iid': 41, 'event': 'lint:javascript'}
+PAYLOAD = {'line': 12, 'column': 4, 'message': 'Missing semicolon.', 'severity': 'warning'}
+
+
+def legacy_reply(create_id, payload, call, part, done, origin):
+    send_origin = origin.copy()
+
+    return {
+        'id': create_id(),
+        'iid': part,
+        'type': 'reply',
+        'part': part,
+        'done': done,
+        'origin': {
+            'id': send_origin['id'],
+        },
+        'to': {
+            'id': call['id'],
+            'iid': call['iid'],
+            'event': call['event'],
+        },
+        'payload': payload,
+    }
+
+
+def run_legacy(encode):
+    create_id = message_id_factory('c0')
+    start = time.perf_counter()
+    out = [
+        encode(legacy_reply(create_id, PAYLOAD, CALL, part, part == PARTS - 1, ORIGIN))
+        for part in range(PARTS)
+    ]
+    return time.perf_counter() - start, out
+
+
+def run_slotted(encode):
+    create_id = message_id_factory('c0')
+    start = time.perf_counter()
+    template = ReplyTemplate(CALL, ORIGIN)
+    out = [
+        encode(ReplyMessage(create_id(), part, part, part == PARTS - 1, PAYLOAD, template))
+        for part in range(PARTS)
+    ]
+    return time.perf_counter() - start, out
+
+
+def best(run, encode, repeat=5):
+    results = [run(encode) for _ in range(repeat)]
+    return min(elapsed for elapsed, out in results), results[0][1]
+
+
+def main():
+    print('{} part reply, ms to build and encode every part'.format(PARTS))
+    print('{:>10} {:>10} {:>10} {:>8}'.format('', 'dict', 'slotted', 'speedup'))
+
+    codecs = [
+        ('json', json.dumps, ReplyMessage.encode_json),
+        ('msgpack', MsgPack.packb, ReplyMessage.encode_msgpack),
+    ]
+
+    for name, encode_dict, encode_message in codecs:
+        legacy, legacy_out = best(run_legacy, encode_dict)
+        slotted, slotted_out = best(run_slotted, encode_message)
+
+        assert legacy_out == slotted_out, name
+
+        print('{:>10} {:>10.1f} {:>10.1f} {:>7.1f}x'.format(
+            name, legacy * 1000, slotted * 1000, legacy / slotted))
+
+
+if __name__ == '__main__':
+    main()
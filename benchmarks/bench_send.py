@@ -0,0 +1,161 @@
+"""
+Send path costs.
+
+A reader thread drains a socketpair in small chunks while the sending side
+flushes a 16 MB frame whenever the socket turns writable. Reports the CPU time
+spent by the sending thread and the number of send calls, for the current
+send path and for the previous copy-and-reslice one.
+
+The burst case queues many small frames at once and counts the send calls
+needed to flush them, with and without coalescing.
+
+    python benchmarks/bench_send.py
+"""
+
+import errno
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from select import select
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SimpleWebSocketServer.SimpleWebSocketServer import WebSocket, BINARY
+
+
+SIZE = 16 * 1048576
+READ_SIZE = 65536
+
+
+class CountingSocket(object):
+    """ Wraps a socket to count send calls """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def send(self, data):
+        self.calls += 1
+        return self.sock.send(data)
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        return self.sock.sendmsg(buffers)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class NullServer(object):
+
+    def _notifyWrite(self, client):
+        pass
+
+
+def legacy_frame(data):
+    # header and payload copied into one bytearray
+    payload = bytearray([0x80 | BINARY, 127])
+    payload.extend(struct.pack('!Q', len(data)))
+    payload.extend(data)
+    return payload
+
+
+def legacy_flush(sock, buff):
+    # the unsent tail is sliced off again after every partial send
+    while True:
+        try:
+            sent = sock.send(buff)
+        except socket.error as e:
+            if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                return buff
+            raise
+        if sent == len(buff):
+            return None
+        buff = buff[sent:]
+
+
+def reader(sock, total, done):
+    received = 0
+    while received < total:
+        received += len(sock.recv(READ_SIZE))
+        time.sleep(0.0001)
+    done.set()
+
+
+def run(mode, data):
+    server_sock, client_sock = socket.socketpair()
+    server_sock.setblocking(0)
+    counting = CountingSocket(server_sock)
+    done = threading.Event()
+
+    thread = threading.Thread(target=reader, args=(client_sock, len(data) + 10, done))
+    thread.start()
+
+    start = time.thread_time()
+
+    if mode == 'legacy':
+        pending = legacy_frame(data)
+        while pending is not None:
+            select([], [server_sock], [])
+            pending = legacy_flush(counting, pending)
+    else:
+        websocket = WebSocket(NullServer(), counting, None)
+        websocket.sendMessage(data)
+        while True:
+            select([], [server_sock], [])
+            if websocket._flushSendq():
+                break
+
+    cpu = time.thread_time() - start
+    done.wait()
+    thread.join()
+    server_sock.close()
+    client_sock.close()
+    return cpu, counting.calls
+
+
+def burst(coalescelimit, count=1000, size=100):
+    server_sock, client_sock = socket.socketpair()
+    server_sock.setblocking(0)
+    counting = CountingSocket(server_sock)
+
+    websocket = WebSocket(NullServer(), counting, None)
+    websocket.coalescelimit = coalescelimit
+
+    for _ in range(count):
+        websocket.sendMessage(b'x' * size)
+
+    start = time.perf_counter()
+    while not websocket._flushSendq():
+        client_sock.recv(1048576)
+    elapsed = time.perf_counter() - start
+
+    server_sock.close()
+    client_sock.close()
+    return elapsed, counting.calls
+
+
+def main():
+    data = os.urandom(SIZE)
+
+    print('16 MB frame to a slow reader')
+    print('{:>10} {:>14} {:>12}'.format('path', 'sender cpu s', 'send calls'))
+
+    for mode in ('legacy', 'current'):
+        cpu, calls = run(mode, data)
+        print('{:>10} {:>14.3f} {:>12}'.format(mode, cpu, calls))
+
+    print()
+    print('burst of 1000 x 100 B frames')
+    print('{:>10} {:>14} {:>12}'.format('coalesce', 'flush ms', 'send calls'))
+
+    for label, limit in (('off', 0), ('64 KB', 65536)):
+        elapsed, calls = burst(limit)
+        print('{:>10} {:>14.3f} {:>12}'.format(label, elapsed * 1000, calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Call timeouts for 10k concurrent outstanding calls.
+
+Each call needs a reply and a done timeout that are cancelled once the call
+completes. Compares two threading.Timer objects per call with the timer
+wheel driven by the server loop.
+
+    python benchmarks/bench_timers.py
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Core.Timers import TimerWheel
+
+
+CALLS = 10000
+
+
+def noop():
+    pass
+
+
+def run_threads():
+    start = time.perf_counter()
+    timers = []
+    for _ in range(CALLS):
+        reply_timer = threading.Timer(2, noop)
+        done_timer = threading.Timer(2, noop)
+        reply_timer.start()
+        done_timer.start()
+        timers.append((reply_timer, done_timer))
+    scheduled = time.perf_counter() - start
+    peak = threading.active_count()
+
+    start = time.perf_counter()
+    for reply_timer, done_timer in timers:
+        reply_timer.cancel()
+        done_timer.cancel()
+    for reply_timer, done_timer in timers:
+        reply_timer.join()
+        done_timer.join()
+    cancelled = time.perf_counter() - start
+
+    return scheduled, cancelled, peak
+
+
+def run_wheel():
+    wheel = TimerWheel()
+
+    start = time.perf_counter()
+    timers = [(wheel.schedule(2, noop), wheel.schedule(2, noop)) for _ in range(CALLS)]
+    scheduled = time.perf_counter() - start
+    peak = threading.active_count()
+
+    # a loop tick with nothing due
+    tick_start = time.perf_counter()
+    wheel.advance()
+    tick = time.perf_counter() - tick_start
+
+    start = time.perf_counter()
+    for reply_timer, done_timer in timers:
+        reply_timer.cancel()
+        done_timer.cancel()
+    cancelled = time.perf_counter() - start
+
+    assert len(wheel) == 0
+    return scheduled, cancelled, peak, tick
+
+
+def main():
+    print('{} calls, 2 timeouts each'.format(CALLS))
+    print('{:>16} {:>14} {:>14} {:>10}'.format('', 'schedule ms', 'cancel ms', 'threads'))
+
+    scheduled, cancelled, peak = run_threads()
+    print('{:>16} {:>14.1f} {:>14.1f} {:>10}'.format('threading.Timer', scheduled * 1000, cancelled * 1000, peak))
+
+    scheduled, cancelled, peak, tick = run_wheel()
+    print('{:>16} {:>14.1f} {:>14.1f} {:>10}'.format('TimerWheel', scheduled * 1000, cancelled * 1000, peak))
+    print('idle wheel tick with {} timeouts pending: {:.3f} ms'.format(CALLS * 2, tick * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Payload unmasking throughput, per-byte XOR against the bulk routine.
+
+    python benchmarks/bench_unmask.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SimpleWebSocketServer.SimpleWebSocketServer import _unmask
+
+
+MASK = bytearray(b'\x37\xfa\x21\x3d')
+
+
+def unmask_per_byte(data, mask):
+    result = bytearray()
+    for index, byte in enumerate(data):
+        result.append(byte ^ mask[index % 4])
+    return result
+
+
+def measure(func, data, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(data, MASK)
+    elapsed = time.perf_counter() - start
+    return len(data) * repeat / 1048576 / elapsed
+
+
+def main():
+    cases = [
+        (1024, 2000, 2000),
+        (65536, 30, 2000),
+        (8388608, 1, 20),
+    ]
+
+    print('{:>10} {:>16} {:>16} {:>10}'.format('size', 'per-byte MB/s', 'bulk MB/s', 'speedup'))
+
+    for size, slow_repeat, fast_repeat in cases:
+        data = bytearray(os.urandom(size))
+        assert _unmask(data, MASK) == unmask_per_byte(data, MASK)
+
+        before = measure(unmask_per_byte, data, slow_repeat)
+        after = measure(_unmask, data, fast_repeat)
+        print('{:>10} {:>16.2f} {:>16.2f} {:>9.0f}x'.format(size, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Validating and routing incoming messages.
+
+Compares the previous path, where Messages.is_valid tried every type's check
+in turn, each building a list of all its predicates, and handleMessage then
+compared the type again, with a single lookup in a table of short-circuiting
+checks that also yields the method to call.
+
+    python benchmarks/bench_validate.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Core.Validators import (
+    lookup, is_length, is_non_empty_str,
+    check_call, check_reply, check_handshake, check_credit, check_type_only,
+)
+
+
+NUMBER = 200000
+
+
+def legacy_is_handshake(message):
+    if message.get('type') != 'handshake':
+        return False
+
+    origin = message.get('origin')
+
+    return all([
+        is_non_empty_str(message.get('id')),
+        isinstance(origin, dict) and is_non_empty_str(origin.get('id')),
+        'payload' in message,
+    ])
+
+
+def legacy_is_call(message):
+    if message.get('type') != 'call':
+        return False
+
+    origin = message.get('origin')
+
+    return all([
+        is_non_empty_str(message.get('id')),
+        isinstance(origin, dict) and is_non_empty_str(origin.get('id')),
+        'payload' in message,
+        is_non_empty_str(message.get('event')),
+        'credit' not in message or is_length(message['credit']),
+    ])
+
+
+def legacy_is_reply(message):
+    if message.get('type') != 'reply':
+        return False
+
+    to = message.get('to')
+    origin = message.get('origin')
+
+    return all([
+        is_non_empty_str(message.get('id')),
+        isinstance(origin, dict) and is_non_empty_str(origin.get('id')),
+        'payload' in message,
+        is_length(message.get('part')),
+        isinstance(message.get('done'), bool),
+        isinstance(to, dict),
+        is_non_empty_str(to.get('id')),
+        is_length(to.get('iid')),
+        is_non_empty_str(to.get('event')),
+    ])
+
+
+def legacy_is_credit(message):
+    if message.get('type') != 'credit':
+        return False
+
+    to = message.get('to')
+
+    return all([
+        is_length(message.get('credit')),
+        isinstance(to, dict),
+        is_non_empty_str(to.get('id')),
+    ])
+
+
+def legacy_route(message):
+    valid = isinstance(message, dict) and (
+        legacy_is_reply(message) or
+        legacy_is_call(message) or
+        legacy_is_handshake(message) or
+        message.get('type') == 'ping' or
+        message.get('type') == 'pong' or
+        legacy_is_credit(message)
+    )
+
+    if not valid:
+        return None
+
+    message_type = message.get('type')
+
+    if message_type == 'call':
+        return 'call'
+    elif message_type == 'reply':
+        return 'reply'
+    elif message_type == 'credit':
+        return 'credit'
+    elif message_type == 'handshake':
+        return 'handshake'
+    elif message_type == 'ping':
+        return 'ping'
+    else:
+        return 'pong'
+
+
+ROUTES = {
+    'call': (check_call, 'call'),
+    'reply': (check_reply, 'reply'),
+    'credit': (check_credit, 'credit'),
+    'handshake': (check_handshake, 'handshake'),
+    'ping': (check_type_only, 'ping'),
+    'pong': (check_type_only, 'pong'),
+}
+
+
+def route(message):
+    entry = lookup(ROUTES, message)
+
+    if entry is None or not entry[0](message):
+        return None
+
+    return entry[1]
+
+
+MESSAGES = [
+    ('valid call', {
+        'id': 'c1', 'iid': 0, 'type': 'call', 'event': 'lint', 'payload': None,
+        'origin': {'id': 'client'},
+    }),
+    ('valid reply', {
+        'id': 'r1', 'type': 'reply', 'part': 0, 'done': False, 'payload': [1, 2],
+        'origin': {'id': 'client'}, 'to': {'id': 'c1', 'iid': 0, 'event': 'lint'},
+    }),
+    ('valid ping', {'type': 'ping'}),
+    ('call without event', {
+        'id': 'c1', 'iid': 0, 'type': 'call', 'payload': None, 'origin': {'id': 'client'},
+    }),
+    ('reply without id', {
+        'type': 'reply', 'part': 0, 'done': False, 'payload': None,
+        'origin': {'id': 'client'}, 'to': {'id': 'c1', 'iid': 0, 'event': 'lint'},
+    }),
+    ('unknown type', {'id': 'x', 'type': 'bogus', 'payload': None}),
+]
+
+
+def main():
+    print('{} messages each, ns per message'.format(NUMBER))
+    print('{:>20} {:>10} {:>10} {:>8}'.format('', 'legacy', 'table', 'speedup'))
+
+    for name, message in MESSAGES:
+        assert legacy_route(message) == route(message), name
+
+        legacy = min(timeit.repeat(lambda: legacy_route(message), number=NUMBER, repeat=3))
+        table = min(timeit.repeat(lambda: route(message), number=NUMBER, repeat=3))
+
+        print('{:>20} {:>10.0f} {:>10.0f} {:>7.1f}x'.format(
+            name, legacy / NUMBER * 1e9, table / NUMBER * 1e9, legacy / table))
+
+
+if __name__ == '__main__':
+    main()
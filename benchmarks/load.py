@@ -0,0 +1,467 @@
+"""
+Loopback load generator for the call and reply protocol.
+
+Runs the plugin's WebSocketServer outside Sublime Text. The sublime,
+sublime_plugin and SublimeTools imports are replaced with small stand-ins.
+The server listens on 127.0.0.1, and N clients connect to it, each from its
+own thread. Each client does the handshake, then loops until the run is
+over:
+
+    call  a "bench:echo" call, answered by the server in --parts reply parts,
+          timed until the done part arrives
+    ping  a ping, timed until the pong arrives
+
+Reports messages and bytes per second over all clients, plus p50, p99 and
+p999 latency for each operation. With --json, the results are also written
+to a file. Pass an earlier result with --compare to see the change between
+two commits.
+
+The clients share the interpreter with the server. Treat absolute numbers
+as a lower bound, and only compare runs made on the same machine. Calls are
+answered from worker threads unless --inline is given, so a call tail that
+sits at the server's selectInterval (100 ms) means the loop was not woken
+up when a reply was queued.
+
+    python benchmarks/load.py --clients 8 --duration 5 --json after.json
+    python benchmarks/load.py --codec msgpack --compare after.json
+"""
+
+import argparse
+import collections
+import importlib
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from Core.MsgPack import packb, unpack_all
+
+from wsclient import WebSocketClient, TEXT, BINARY
+
+
+PACKAGE = 'EditorConnect'
+PERCENTILES = (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+
+
+# Stand-ins for the modules Sublime Text provides
+
+class Settings(object):
+    values = {}
+
+    def __init__(self, path):
+        pass
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+
+class EventEmitter(object):
+
+    def __init__(self, **options):
+        self._listeners = collections.defaultdict(list)
+
+    def on(self, event, listener=None):
+        if listener is None:
+            def decorator(listener):
+                self.on(event, listener)
+                return listener
+
+            return decorator
+
+        self._listeners[event].append(listener)
+
+    def off(self, event, listener):
+        if listener in self._listeners.get(event, ()):
+            self._listeners[event].remove(listener)
+
+    def off_all(self, event=None):
+        if event is None:
+            self._listeners.clear()
+        else:
+            self._listeners.pop(event, None)
+
+    def emit(self, event, *args):
+        for listener in list(self._listeners.get(event, ())):
+            listener(*args)
+
+
+class Logger(object):
+    """ Logging every message would measure the console, not the server """
+
+    def __init__(self, name=None):
+        self.name = name
+
+    def info(self, *args):
+        pass
+
+    def warning(self, *args):
+        print('[warning]', *args, file=sys.stderr)
+
+    def error(self, *args):
+        print('[error]', *args, file=sys.stderr)
+
+
+def incremental_id_factory():
+    counter = iter(range(sys.maxsize))
+    return lambda: next(counter)
+
+
+def set_timeout(fn, delay=0):
+    threading.Timer(delay / 1000, fn).start()
+
+
+def install_stubs():
+    def module(name, **attrs):
+        stub = types.ModuleType(name)
+        stub.__dict__.update(attrs)
+        sys.modules[name] = stub
+        return stub
+
+    module('sublime', version=lambda: '3000', platform=platform.system().lower,
+           set_timeout=set_timeout, set_timeout_async=set_timeout)
+    module('sublime_plugin', ApplicationCommand=object)
+    module('SublimeTools', __path__=[])
+    module('SublimeTools.Settings', Settings=Settings)
+    module('SublimeTools.EventEmitter', EventEmitter=EventEmitter)
+    module('SublimeTools.Utils', incremental_id_factory=incremental_id_factory)
+    module('SublimeTools.Logging', Logger=Logger)
+
+    # Server.py uses relative imports, so load it as part of a package
+    module(PACKAGE, __path__=[ROOT])
+
+
+def load_server():
+    install_stubs()
+    return importlib.import_module(PACKAGE + '.Server')
+
+
+# Clients
+
+class CountingClient(WebSocketClient):
+    """ Counts the bytes sent and received, frame headers included """
+
+    def __init__(self, *args, **kwargs):
+        self.bytes = 0
+        WebSocketClient.__init__(self, *args, **kwargs)
+
+    def _fill(self):
+        size = len(self.buffer)
+        WebSocketClient._fill(self)
+        self.bytes += len(self.buffer) - size
+
+    def send(self, opcode, payload, fin=True, rsv1=False):
+        frame = self.frame(opcode, payload, fin, rsv1)
+        self.bytes += len(frame)
+        self.sock.sendall(frame)
+
+
+class LoadClient(object):
+
+    def __init__(self, index, port, options):
+        self.id = 'bench{}'.format(index)
+        self.port = port
+        self.options = options
+        self.msgpack = options.codec == 'msgpack'
+        self.pending = collections.deque()
+        self.messages = 0
+        self.calls = 0
+        self.latencies = collections.defaultdict(list)
+        self.error = None
+
+        data = 'x' * options.payload
+        self.call_payload = {'parts': options.parts, 'data': data}
+
+    def send(self, message):
+        self.messages += 1
+
+        if self.msgpack:
+            self.client.send(BINARY, packb(message))
+        else:
+            self.client.send(TEXT, json.dumps(message) + '\n')
+
+    def receive(self):
+        while not self.pending:
+            opcode, payload, _ = self.client.recv()
+
+            if opcode == BINARY:
+                messages = unpack_all(payload)
+            else:
+                messages = [json.loads(line) for line in payload.decode('utf-8').split('\n') if line]
+
+            self.messages += len(messages)
+            self.pending.extend(messages)
+
+        return self.pending.popleft()
+
+    def handshake(self):
+        start = time.perf_counter()
+        self.client = CountingClient('127.0.0.1', self.port)
+
+        payload = {'codec': 'msgpack'} if self.msgpack else None
+
+        # the handshake always goes out as JSON
+        self.messages += 1
+        self.client.send(TEXT, json.dumps({
+            'id': self.id + 'h',
+            'type': 'handshake',
+            'origin': {'id': self.id},
+            'payload': payload,
+        }) + '\n')
+
+        accept = self.receive()
+        assert accept['type'] == 'handshake-accept', accept
+
+        self.latencies['handshake'].append(time.perf_counter() - start)
+
+    def call(self):
+        self.calls += 1
+        call_id = '{}c{}'.format(self.id, self.calls)
+
+        start = time.perf_counter()
+        self.send({
+            'id': call_id,
+            'iid': self.calls,
+            'type': 'call',
+            'event': 'bench:echo',
+            'origin': {'id': self.id},
+            'payload': self.call_payload,
+        })
+
+        parts = 0
+        while True:
+            message = self.receive()
+            assert message['type'] == 'reply' and message['to']['id'] == call_id, message
+            parts += 1
+
+            if message['done']:
+                break
+
+        self.latencies['call'].append(time.perf_counter() - start)
+        assert parts == self.options.parts, parts
+
+    def ping(self):
+        start = time.perf_counter()
+        self.send({'type': 'ping'})
+
+        message = self.receive()
+        assert message['type'] == 'pong', message
+
+        self.latencies['ping'].append(time.perf_counter() - start)
+
+    def run(self, ready, go, deadline):
+        try:
+            self.handshake()
+            ready.release()
+            go.wait()
+
+            while time.perf_counter() < deadline[0]:
+                self.call()
+                self.ping()
+
+        except Exception as ex:
+            self.error = ex
+            ready.release()
+
+        finally:
+            if hasattr(self, 'client'):
+                self.client.close()
+
+
+# Server
+
+def echo(payload, reply):
+    data = payload['data']
+
+    for _ in range(payload['parts'] - 1):
+        reply(data)
+
+    reply(data, True)
+
+
+def start_server(Server, options):
+    Settings.values = {
+        'port': 0,
+        'engine': options.engine,
+        'handlers': {'workers': options.workers},
+        # profiles the whole run, the file is written when the server stops
+        'profile': {'enabled': options.profile is not None, 'mode': options.profile, 'seconds': None},
+    }
+
+    Server.user_settings = Settings(None)
+    Server.server.on('bench:echo', echo)
+    Server.server.inline('bench:echo', options.inline)
+    Server.start_server()
+
+    return Server.websocket_server.serversocket.getsockname()[1]
+
+
+def stop_server(Server):
+    thread = Server.websocket_server_thread
+    Server.stop_server()
+    Server.server.off('bench:echo', echo)
+    thread.join(5)
+
+    # stop_server leaves the old instance in place, start_server would
+    # refuse to run again
+    Server.websocket_server = None
+
+
+# Results
+
+def percentiles(samples):
+    samples = sorted(samples)
+    summary = {'count': len(samples)}
+
+    for name, fraction in PERCENTILES:
+        # nearest rank
+        index = min(len(samples) - 1, max(0, int(math.ceil(fraction * len(samples))) - 1))
+        summary[name] = samples[index] * 1000 if samples else None
+
+    summary['max'] = samples[-1] * 1000 if samples else None
+
+    return summary
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(Server, options):
+    port = start_server(Server, options)
+    clients = [LoadClient(index, port, options) for index in range(options.clients)]
+
+    ready = threading.Semaphore(0)
+    go = threading.Event()
+    deadline = [float('inf')]
+    threads = [
+        threading.Thread(target=client.run, args=(ready, go, deadline), daemon=True)
+        for client in clients
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    for _ in clients:
+        ready.acquire()
+
+    # time from the moment every client is connected
+    start = time.perf_counter()
+    messages = sum(client.messages for client in clients)
+    wire = sum(client.client.bytes for client in clients if hasattr(client, 'client'))
+    deadline[0] = start + options.duration
+    go.set()
+
+    for thread in threads:
+        thread.join(options.duration + 30)
+
+    elapsed = time.perf_counter() - start
+    stop_server(Server)
+
+    errors = [repr(client.error) for client in clients if client.error is not None]
+    messages = sum(client.messages for client in clients) - messages
+    wire = sum(client.client.bytes for client in clients if hasattr(client, 'client')) - wire
+
+    latencies = collections.defaultdict(list)
+    for client in clients:
+        for name, samples in client.latencies.items():
+            latencies[name].extend(samples)
+
+    return {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'engine': options.engine,
+        'codec': options.codec,
+        'clients': options.clients,
+        'parts': options.parts,
+        'payload': options.payload,
+        'workers': options.workers,
+        'inline': options.inline,
+        'profile': options.profile,
+        'duration': elapsed,
+        'calls': len(latencies['call']),
+        'messages': messages,
+        'bytes': wire,
+        'messages_per_sec': messages / elapsed,
+        'bytes_per_sec': wire / elapsed,
+        'latency_ms': {name: percentiles(samples) for name, samples in sorted(latencies.items())},
+        'errors': errors,
+    }
+
+
+def report(result, previous=None):
+    def change(value, key, lower_is_better=False, source=None):
+        old = (source or previous or {}).get(key) if previous else None
+
+        if not old or value is None:
+            return ''
+
+        ratio = value / old
+        better = ratio < 1 if lower_is_better else ratio > 1
+
+        return '  ({:+.1f}% {})'.format((ratio - 1) * 100, 'better' if better else 'worse')
+
+    print('{engine} engine, {codec}, {clients} clients, {parts} parts of {payload} bytes, '
+          'commit {commit}'.format(**result))
+    print('{:>14} {:>14.0f}{}'.format(
+        'messages/s', result['messages_per_sec'], change(result['messages_per_sec'], 'messages_per_sec')))
+    print('{:>14} {:>14.0f}{}'.format(
+        'bytes/s', result['bytes_per_sec'], change(result['bytes_per_sec'], 'bytes_per_sec')))
+
+    print('{:>14} {:>8} {:>9} {:>9} {:>9} {:>9}'.format('latency ms', 'count', 'p50', 'p99', 'p999', 'max'))
+
+    for name, summary in result['latency_ms'].items():
+        print('{:>14} {:>8} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}{}'.format(
+            name, summary['count'], summary['p50'], summary['p99'], summary['p999'], summary['max'],
+            change(summary['p99'], 'p99', True, (previous or {}).get('latency_ms', {}).get(name))))
+
+    for error in result['errors']:
+        print('client failed:', error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--engine', default='select', choices=('select', 'asyncio'))
+    parser.add_argument('--codec', default='json', choices=('json', 'msgpack'))
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5, help='seconds')
+    parser.add_argument('--parts', type=int, default=10, help='reply parts per call')
+    parser.add_argument('--payload', type=int, default=64, help='bytes per reply part')
+    parser.add_argument('--workers', type=int, default=4, help='handler worker threads')
+    parser.add_argument('--inline', action='store_true', help='run the handler on the server thread')
+    parser.add_argument('--profile', choices=('sample', 'cprofile'), help='profile the server while it runs')
+    parser.add_argument('--json', metavar='PATH', help='write the results to PATH')
+    parser.add_argument('--compare', metavar='PATH', help='show the change from an earlier result')
+    options = parser.parse_args()
+
+    Server = load_server()
+    result = run(Server, options)
+
+    previous = None
+    if options.compare:
+        with open(options.compare) as file:
+            previous = json.load(file)
+
+    report(result, previous)
+
+    if options.json:
+        with open(options.json, 'w') as file:
+            json.dump(result, file, indent=2, sort_keys=True)
+
+    sys.exit(1 if result['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+"""
+Loopback conformance run shared by every server engine.
+
+Starts an echo server on 127.0.0.1 for each engine, drives it with a real
+client and checks the handshake, framing, control frames, cross thread sends
+and the close handshake. Exits non-zero if any engine fails.
+
+    python benchmarks/loopback.py [select|asyncio ...]
+"""
+
+import os
+import json
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SimpleWebSocketServer.SimpleWebSocketServer import SimpleWebSocketServer, WebSocket
+from SimpleWebSocketServer.AsyncioWebSocketServer import AsyncioWebSocketServer, asyncio
+
+from wsclient import WebSocketClient, TEXT, BINARY, STREAM, CLOSE, PING, PONG
+
+
+ENGINES = {
+    'select': SimpleWebSocketServer,
+    'asyncio': AsyncioWebSocketServer,
+}
+
+
+class Echo(WebSocket):
+
+    def handleMessage(self):
+        self.sendMessage(self.data)
+
+    def handleConnected(self):
+        self.server.events.append('connected')
+        self.server.handlers.append(self)
+
+    def handleClose(self):
+        self.server.events.append('closed')
+
+    def handleCongested(self):
+        self.server.events.append('congested')
+
+    def handleDrained(self):
+        self.server.events.append('drained')
+
+
+def start(engine):
+    deflate = {'min_size': 64}
+    server = ENGINES[engine]('127.0.0.1', 0, Echo, selectInterval=5, deflate=deflate)
+    server.events = []
+    server.handlers = []
+    thread = threading.Thread(target=server.serveforever, daemon=True)
+    thread.start()
+    return server, thread, server.serversocket.getsockname()[1]
+
+
+def wait_for(predicate, timeout=2):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.005)
+    return False
+
+
+def check_text(server, client):
+    client.send_text(u'héllo')
+    assert client.recv() == (TEXT, u'héllo'.encode('utf-8'), False)
+
+
+def check_binary(server, client):
+    for size in (0, 125, 126, 65535, 65536, 3000000):
+        payload = os.urandom(size)
+        client.send(BINARY, payload)
+        assert client.recv() == (BINARY, payload, False), size
+
+
+def check_fragments(server, client):
+    client.send(TEXT, b'one ', fin=False)
+    client.send(PING, b'mid')
+    client.send(STREAM, b'two ', fin=False)
+    client.send(STREAM, b'three', fin=True)
+    assert client.recv() == (PONG, b'mid', False)
+    assert client.recv() == (TEXT, b'one two three', False)
+
+
+def check_pipelined(server, client):
+    client.sock.sendall(b''.join(client.frame(TEXT, str(i)) for i in range(200)))
+    for i in range(200):
+        assert client.recv() == (TEXT, str(i).encode('ascii'), False)
+
+
+def check_cross_thread(server, client):
+    assert wait_for(lambda: server.handlers)
+    start = time.time()
+    server.handlers[-1].sendMessage(u'pushed')
+    assert client.recv() == (TEXT, b'pushed', False)
+    # selectInterval is 5s, so anything slow means the wakeup did not happen
+    assert time.time() - start < 1
+
+
+def stall(server, client, policy):
+    """ Fill the sendq of a client that is not reading """
+    assert wait_for(lambda: server.handlers)
+    handler = server.handlers[-1]
+    handler.setSendqLimits(262144, 65536, policy)
+
+    payload = b'x' * 4096
+    deepest = 0
+    for i in range(1000):
+        handler.sendMessage(bytearray(struct.pack('!I', i) + payload))
+        deepest = max(deepest, handler.sendqbytes)
+
+    return handler, deepest
+
+
+def check_slow_consumer(server, client):
+    client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    handler, deepest = stall(server, client, 'drop-oldest')
+
+    assert deepest <= 262144 + 4106, deepest
+    assert handler.sendqdropped > 0
+    assert 'congested' in server.events
+
+    # the newest messages survive, in order
+    last = -1
+    while last != 999:
+        opcode, payload, _ = client.recv()
+        assert opcode == BINARY
+        index = struct.unpack('!I', payload[:4])[0]
+        assert index > last
+        last = index
+
+    assert wait_for(lambda: 'drained' in server.events)
+    assert handler.sendqbytes == 0 and not handler.congested
+
+
+def check_overflow_disconnect(server, client):
+    client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    handler, deepest = stall(server, client, 'disconnect')
+
+    assert handler.closed
+    while True:
+        opcode, payload, _ = client.recv()
+        if opcode == CLOSE:
+            break
+    assert struct.unpack('!H', payload[:2])[0] == 1008
+    assert wait_for(lambda: handler not in server.connections.values())
+
+
+def check_close(server, client):
+    client.send(CLOSE, struct.pack('!H', 1000))
+    opcode, payload, _ = client.recv()
+    assert opcode == CLOSE and struct.unpack('!H', payload[:2])[0] == 1000
+    assert wait_for(lambda: 'closed' in server.events)
+    assert wait_for(lambda: not server.connections)
+
+
+def check_deflate(server, client):
+    client.sock.close()
+    port = server.serversocket.getsockname()[1]
+    offer = 'permessage-deflate; client_max_window_bits'
+    client = WebSocketClient('127.0.0.1', port, headers={'Sec-WebSocket-Extensions': offer})
+    assert 'Sec-WebSocket-Extensions: permessage-deflate' in client.response
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    decompressor = zlib.decompressobj(-15)
+
+    def compress(data):
+        return (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+    def decompress(data):
+        return decompressor.decompress(data + b'\x00\x00\xff\xff')
+
+    # both contexts are carried over between messages
+    for _ in range(3):
+        message = json.dumps({'payload': ['lint error'] * 200}).encode('utf-8')
+        client.send(TEXT, compress(message), rsv1=True)
+        opcode, payload, rsv1 = client.recv()
+        assert opcode == TEXT and rsv1 and len(payload) < len(message)
+        assert decompress(payload) == message
+
+    # fragmented compressed message
+    compressed = compress(b'fragmented ' * 100)
+    client.send(TEXT, compressed[:10], fin=False, rsv1=True)
+    client.send(STREAM, compressed[10:], fin=True)
+    opcode, payload, rsv1 = client.recv()
+    assert rsv1 and decompress(payload) == b'fragmented ' * 100
+
+    # below min_size goes out uncompressed
+    client.send_text(u'short')
+    assert client.recv() == (TEXT, b'short', False)
+
+    client.sock.close()
+
+
+def deflate_client(server, offer='permessage-deflate'):
+    port = server.serversocket.getsockname()[1]
+    connected = len(server.handlers)
+    client = WebSocketClient('127.0.0.1', port, headers={'Sec-WebSocket-Extensions': offer})
+    assert wait_for(lambda: len(server.handlers) > connected)
+    return client, server.handlers[-1]
+
+
+def check_deflate_block(server, client):
+    client.sock.close()
+    client, handler = deflate_client(server)
+    handler.setSendqLimits(65536, 16384, 'block')
+
+    # a small send buffer on the server side, so the client can read at
+    # full speed once it starts
+    sock = handler.client
+    if hasattr(sock, 'get_extra_info'):
+        sock = sock.get_extra_info('socket')
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16384)
+    decompressor = zlib.decompressobj(-15)
+
+    def push():
+        for i in range(1000):
+            handler.sendMessage(bytearray(struct.pack('!I', i) + os.urandom(4096)))
+
+    pusher = threading.Thread(target=push, daemon=True)
+    pusher.start()
+    assert wait_for(lambda: handler.congested)
+
+    # the serving thread compresses its echo while the pusher is blocked
+    echo = b'e' * 100
+    client.send(BINARY, echo)
+
+    received = []
+    while len(received) < 1001:
+        opcode, payload, rsv1 = client.recv()
+        if rsv1:
+            payload = decompressor.decompress(payload + b'\x00\x00\xff\xff')
+        received.append(payload)
+
+    assert echo in received
+    pushed = [struct.unpack('!I', payload[:4])[0] for payload in received if payload != echo]
+    assert pushed == list(range(1000))
+    pusher.join(2)
+    client.sock.close()
+
+
+def check_deflate_bound(server, client):
+    client.sock.close()
+
+    # limits known at the handshake turn off server context takeover, so
+    # compressed messages can be dropped
+    server.sendqlimits = {'high_water': 262144, 'low_water': 65536, 'policy': 'drop-oldest'}
+    try:
+        client, handler = deflate_client(server)
+        client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    finally:
+        server.sendqlimits = None
+
+    assert 'server_no_context_takeover' in client.response
+    deepest = 0
+    for i in range(4000):
+        handler.sendMessage(bytearray(struct.pack('!I', i) + os.urandom(4096)))
+        deepest = max(deepest, handler.sendqbytes)
+
+    assert deepest <= 262144 + 4200, deepest
+    assert handler.sendqdropped > 0 and not handler.closed
+    client.sock.close()
+
+    # set afterwards, the compressed messages can't be dropped, so the
+    # connection is closed instead of growing past the limit
+    client, handler = deflate_client(server)
+    client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    assert 'server_no_context_takeover' not in client.response
+    handler.setSendqLimits(262144, 65536, 'drop-oldest')
+    deepest = 0
+    for i in range(4000):
+        handler.sendMessage(bytearray(struct.pack('!I', i) + os.urandom(4096)))
+        deepest = max(deepest, handler.sendqbytes)
+
+    assert deepest <= 262144 + 4200, deepest
+    assert handler.closed
+    client.sock.close()
+
+
+CHECKS = [
+    check_text,
+    check_binary,
+    check_fragments,
+    check_pipelined,
+    check_cross_thread,
+    check_deflate,
+    check_deflate_block,
+    check_deflate_bound,
+    check_slow_consumer,
+    check_overflow_disconnect,
+    check_close,
+]
+
+
+def run(engine):
+    server, thread, port = start(engine)
+    failures = 0
+
+    try:
+        for check in CHECKS:
+            client = WebSocketClient('127.0.0.1', port)
+            try:
+                check(server, client)
+                print('  ok    {}'.format(check.__name__))
+            except Exception:
+                failures += 1
+                print('  FAIL  {}'.format(check.__name__))
+                traceback.print_exc()
+            finally:
+                client.sock.close()
+    finally:
+        server.close()
+        thread.join(2)
+
+    if thread.is_alive():
+        failures += 1
+        print('  FAIL  server thread did not stop')
+
+    return failures
+
+
+def main(engines):
+    failures = 0
+
+    for engine in engines:
+        if engine == 'asyncio' and asyncio is None:
+            print('{}: skipped, asyncio is not available'.format(engine))
+            continue
+
+        print('{}:'.format(engine))
+        failures += run(engine)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:] or sorted(ENGINES)))
@@ -0,0 +1,119 @@
+"""
+Regression checks for the per-connection JSON stream decoder.
+
+Feeds batches of messages to StreamDecoder in random slices and checks that
+every run decodes the same messages in order, then that a broken or
+oversized unfinished message is dropped instead of holding up the
+connection. Exits non-zero if any check fails.
+
+    python benchmarks/stream_decoder.py
+"""
+
+import json
+import random
+import sys
+import traceback
+
+from load import load_server
+
+
+Server = load_server()
+
+StreamDecoder = Server.StreamDecoder
+END_OF_MESSAGE_STR = Server.END_OF_MESSAGE_STR
+
+
+def messages(count):
+    return [
+        {'type': 'call', 'id': str(i), 'event': 'lint', 'payload': {'text': 'x' * (i % 50), 'line': i}}
+        for i in range(count)
+    ]
+
+
+def check_random_slices():
+    expected = messages(500)
+    text = ''.join(json.dumps(message) + END_OF_MESSAGE_STR for message in expected)
+    rng = random.Random(9)
+
+    for run in range(50):
+        decoder = StreamDecoder()
+        decoded = []
+        offset = 0
+
+        while offset < len(text):
+            size = rng.randint(1, 400)
+            decoded.extend(decoder.decode(text[offset:offset + size]))
+            offset += size
+
+        assert decoded == expected, run
+        assert not decoder.pending
+
+
+def check_last_message_without_newline():
+    decoder = StreamDecoder()
+    assert decoder.decode('{"type": "ping"}') == [{'type': 'ping'}]
+    assert decoder.decode('{"type": "pi') == []
+    assert decoder.decode('ng"}') == []
+    assert decoder.decode('\n') == [{'type': 'ping'}]
+
+    # a slice that ends a nested object is not mistaken for a whole message
+    assert decoder.decode('{"type": "call", "payload": ') == []
+    assert decoder.decode('{"line": 1}') == []
+    assert decoder.decode('}\n') == [{'type': 'call', 'payload': {'line': 1}}]
+
+
+def check_truncated_frame():
+    decoder = StreamDecoder()
+    assert decoder.decode('{"type": "pi') == []
+
+    try:
+        decoder.decode('{"type": "ping"}')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('the unfinished message was not dropped')
+
+    assert decoder.held == 0
+    assert decoder.decode('{"type": "ping"}') == [{'type': 'ping'}]
+
+
+def check_maxsize():
+    decoder = StreamDecoder(100)
+    assert decoder.decode('{"payload": "' + 'x' * 60) == []
+
+    try:
+        decoder.decode('x' * 60)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('held text grew past maxsize')
+
+    assert decoder.held == 0
+    assert decoder.decode('{"type": "ping"}\n') == [{'type': 'ping'}]
+
+
+CHECKS = [
+    check_random_slices,
+    check_last_message_without_newline,
+    check_truncated_frame,
+    check_maxsize,
+]
+
+
+def main():
+    failures = 0
+
+    for check in CHECKS:
+        try:
+            check()
+            print('  ok    {}'.format(check.__name__))
+        except Exception:
+            failures += 1
+            print('  FAIL  {}'.format(check.__name__))
+            traceback.print_exc()
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Minimal blocking WebSocket client used by the benchmarks and loopback checks.
+"""
+
+import base64
+import os
+import socket
+import struct
+
+
+TEXT = 0x1
+BINARY = 0x2
+STREAM = 0x0
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+
+class WebSocketClient(object):
+
+    def __init__(self, host, port, headers=None, timeout=10):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = bytearray()
+        self.response = self._handshake(host, port, headers or {})
+
+    def _handshake(self, host, port, headers):
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        lines = [
+            'GET / HTTP/1.1',
+            'Host: {}:{}'.format(host, port),
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            'Sec-WebSocket-Key: {}'.format(key),
+            'Sec-WebSocket-Version: 13',
+        ]
+        lines.extend('{}: {}'.format(name, value) for name, value in headers.items())
+        self.sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode('ascii'))
+
+        while b'\r\n\r\n' not in self.buffer:
+            self._fill()
+
+        end = self.buffer.index(b'\r\n\r\n') + 4
+        response = bytes(self.buffer[:end]).decode('ascii')
+        del self.buffer[:end]
+
+        if not response.startswith('HTTP/1.1 101'):
+            raise Exception('handshake failed: ' + response)
+
+        return response
+
+    def _fill(self):
+        data = self.sock.recv(262144)
+        if not data:
+            raise EOFError('server closed the connection')
+        self.buffer.extend(data)
+
+    def _read(self, size):
+        while len(self.buffer) < size:
+            self._fill()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def frame(self, opcode, payload, fin=True, rsv1=False):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+
+        length = len(payload)
+        header = bytearray([(0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode])
+
+        if length <= 125:
+            header.append(0x80 | length)
+        elif length <= 65535:
+            header.append(0x80 | 126)
+            header.extend(struct.pack('!H', length))
+        else:
+            header.append(0x80 | 127)
+            header.extend(struct.pack('!Q', length))
+
+        mask = os.urandom(4)
+        header.extend(mask)
+
+        if length:
+            key = (mask * (length // 4 + 1))[:length]
+            value = int.from_bytes(payload, 'little') ^ int.from_bytes(key, 'little')
+            payload = value.to_bytes(length, 'little')
+
+        return bytes(header) + payload
+
+    def send(self, opcode, payload, fin=True, rsv1=False):
+        self.sock.sendall(self.frame(opcode, payload, fin, rsv1))
+
+    def send_text(self, text):
+        self.send(TEXT, text)
+
+    def recv(self):
+        """ Returns (opcode, payload, rsv1) for the next frame """
+        b1, b2 = self._read(2)
+        length = b2 & 0x7F
+
+        if length == 126:
+            length = struct.unpack('!H', self._read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._read(8))[0]
+
+        return b1 & 0x0F, self._read(length), bool(b1 & 0x40)
+
+    def close(self):
+        try:
+            self.send(CLOSE, struct.pack('!H', 1000))
+        except OSError:
+            pass
+        self.sock.close()